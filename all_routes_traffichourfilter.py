@@ -1,129 +1,90 @@
-import pandas as pd
+from functools import partial
 import folium
-import os
-from datetime import datetime
-from folium.plugins import MousePosition
-import numpy as np
-
-def filter_df_by_hour(df, hour):
-    df['hour_filter'] = pd.to_datetime(df['est_time'], format='%H:%M:%S', errors='coerce').dt.hour
-    print(df.head())  # Check if est_time is correctly converted
-    return df[df['hour_filter'] == hour]
-
-def get_color_for_condition(condition):
-    if condition <= 0:
-        return '#808080'  # Gray for unavailable data
-    elif condition <= 1:
-        return '#00FF00'  # Green for excellent; no traffic congestion
-    elif condition <= 2:
-        return '#7FFF00'  # Chartreuse for good; minor traffic congestion
-    elif condition <= 3:
-        return '#FFFF00'  # Yellow for average; moderate traffic congestion
-    elif condition <= 4:
-        return '#FF7F00'  # Orange for below average; moderate-heavy traffic congestion
-    else:
-        return '#FF0000'  # Red for poor quality; heavy traffic congestion
-
-def describe_congestion(num):
-    if num <= 1:
-        return "No Traffic Congestion"
-    elif num <= 2:
-        return "Minor Traffic Congestion"
-    elif num <= 3:
-        return "Moderate Traffic Congestion"
-    elif num <= 4:
-        return "Moderate-Heavy Traffic Congestion"
-    else:
-        return "Heavy Traffic Congestion"
-
-def create_route_layer(df, route_name, map_object, hour=None):
+import build_maps
+from client_layers import hour_bundle_payload, route_payload
+from route_classify import TRAFFIC
+from route_loader import load_route
+from route_lod import LOD_LEVELS, lod_tolerance
+from route_match import matched_bins
+from route_segments import add_run_lines, route_run_lines
+from route_time_index import RouteTimeIndex
+
+def filter_df_by_hour(time_index, hour):
+    # Slice of the precomputed hour index; the loaded data is never modified
+    return time_index.hour(hour)
+
+SCALE = TRAFFIC
+get_color_for_condition = TRAFFIC.color
+describe_congestion = TRAFFIC.label
+
+def run_popup(route_name, df, values, start, stop):
+    est_time = df['est_time']
+    return f"{route_name}, {est_time.iat[start]} - {est_time.iat[stop]}, {describe_congestion(values[start])}"
+
+def route_layer_lines(job):
+    # (csv path, route name, hour) -> PolyLine arguments; runs in a worker process
+    path, route_name, hour = job
+    df = load_route(path)
     if hour is not None:
-        df = filter_df_by_hour(df, hour)
+        df = filter_df_by_hour(RouteTimeIndex(df), hour)
     
+    # One line per run of same-colored segments, simplified for the initial zoom
+    return route_run_lines(df, 'traffic_congestion', TRAFFIC, partial(run_popup, route_name),
+                           tolerance=lod_tolerance(16))
+
+def route_layer_payload(job):
+    # (csv path, route name, hour) -> client_layers payload for the compact output;
+    # popup text comes from the run's times and code, looked up client-side when clicked
+    path, route_name, hour = job
+    df = load_route(path)
+    if hour is not None:
+        df = filter_df_by_hour(RouteTimeIndex(df), hour)
+    return route_payload(df, route_name, ['traffic_congestion'], LOD_LEVELS, with_times=True)
+
+def route_bundle_payload(job):
+    # (csv path, route name) -> every hour's runs of the route for the hour bundle,
+    # simplified like route_layer_lines
+    path, route_name = job
+    return hour_bundle_payload(load_route(path), route_name, 'traffic_congestion', lod_tolerance(16))
+
+def binned_popup(route_name, df, values, start, stop):
+    along = df['along_m']
+    count = df['count'].iloc[start:stop].sum()
+    return (f"{route_name}, {along.iat[start]:.0f} - {along.iat[stop]:.0f} m along the route, "
+            f"{describe_congestion(values[start])} ({count} readings)")
+
+def binned_route_frame(df, hour):
+    # The route's fixed-length bins (route_match.matched_bins) as a drawable trace, each
+    # bin colored by its mean over every pass in the hour, or over all hours
+    bins, matched = matched_bins(df)
+    table = bins.aggregate(matched, ['traffic_congestion'], by_hour=hour is not None)
+    return bins.route_frame(table, 'traffic_congestion', hour)
+
+def route_binned_lines(job):
+    # (csv path, route name, hour) -> PolyLine arguments like route_layer_lines, but one
+    # line per run of same-colored bins instead of every overlapping pass
+    path, route_name, hour = job
+    df = binned_route_frame(load_route(path), hour)
+    return route_run_lines(df, 'traffic_congestion', TRAFFIC, partial(binned_popup, route_name),
+                           tolerance=lod_tolerance(16))
+
+def route_binned_payload(job):
+    # (csv path, route name, hour) -> client_layers payload of the bins for the compact output
+    path, route_name, hour = job
+    return route_payload(binned_route_frame(load_route(path), hour), route_name, ['traffic_congestion'], LOD_LEVELS)
+
+def create_route_layer(lines, route_name, map_object):
     feature_group = folium.FeatureGroup(name=route_name)
-    
-    # Drop rows with missing lat/lon and sort by time
-    df = df.dropna(subset=['latitude', 'longitude']).sort_values('time')
-    
-    for i in range(len(df) - 1):
-        start_row = df.iloc[i]
-        end_row = df.iloc[i + 1]
-        
-        # Draw the line segment
-        folium.PolyLine(
-            locations=[[start_row['latitude'], start_row['longitude']],
-                       [end_row['latitude'], end_row['longitude']]],
-            color=get_color_for_condition(start_row['traffic_congestion']),
-            weight=7,
-            opacity=0.7,
-            popup=f"{route_name}, {start_row['est_time']}, {describe_congestion(start_row['traffic_congestion'])}"
-        ).add_to(feature_group)
-    
+    add_run_lines(feature_group, lines)
     feature_group.add_to(map_object)
     return feature_group
 
-# Load the data
-blue_df = pd.read_csv("real_data/blue_traffic.csv")
-red_df = pd.read_csv("real_data/red_traffic.csv")
-green_df = pd.read_csv("real_data/green_traffic.csv")
-gold_df = pd.read_csv("real_data/gold_traffic.csv")
-
-# Initialize the map
-center_lat = np.mean([df['latitude'].mean() for df in [blue_df, red_df, green_df, gold_df]])
-center_lon = np.mean([df['longitude'].mean() for df in [blue_df, red_df, green_df, gold_df]])
-map_ = folium.Map(location=[center_lat, center_lon], zoom_start=16)
-
-# Create layers for each route
-blue_layer = create_route_layer(blue_df, 'Blue Route', map_)
-red_layer = create_route_layer(red_df, 'Red Route', map_)
-green_layer = create_route_layer(green_df, 'Green Route', map_)
-gold_layer = create_route_layer(gold_df, 'Gold Route', map_)
-
-# Add XOR-style layer control
-folium.LayerControl(collapsed=False).add_to(map_)
-
-# Add mouse position
-formatter = "function(num) {return L.Util.formatNum(num, 5);};"
-MousePosition(
-    position='topright',
-    separator=' | ',
-    empty_string='NaN',
-    lng_first=True,
-    num_digits=20,
-    prefix='Coordinates:',
-    lat_formatter=formatter,
-    lng_formatter=formatter,
-).add_to(map_)
-
-hour_filter_html = """
-<div id="hour-filter" style="
-    position: absolute;
-    top: 140px;
-    right: 10px;
-    z-index: 1000;
-    background: white;
-    padding: 10px;
-    border-radius: 5px;
-    box-shadow: 0 0 15px rgba(0,0,0,0.2);">
-    <label for="hour-select">Filter by Hour:</label>
-    <select id="hour-select">
-        <option value="">All Hours</option>
-        <option value="7">7 AM</option>
-        <option value="8">8 AM</option>
-        <option value="9">9 AM</option>
-        <option value="10">10 AM</option>
-        <option value="11">11 AM</option>
-        <option value="12">12 PM</option>
-        <option value="13">1 PM</option>
-        <option value="14">2 PM</option>
-        <option value="15">3 PM</option>
-        <option value="16">4 PM</option>
-        <option value="17">5 PM</option>
-        <option value="18">6 PM</option>
-        <option value="19">7 PM</option>
-    </select>
-</div>
-"""
+ROUTE_FILES = {
+    'Blue Route': "real_data/blue_traffic.csv",
+    'Red Route': "real_data/red_traffic.csv",
+    'Green Route': "real_data/green_traffic.csv",
+    'Gold Route': "real_data/gold_traffic.csv",
+}
 
 xor_js = """
 <script type="text/javascript">
@@ -156,46 +117,9 @@ document.addEventListener("DOMContentLoaded", function() {
 </script>
 """
 
-hour_filter_js = """
-<script>
-document.addEventListener("DOMContentLoaded", function() {
-    var hourSelect = document.getElementById('hour-select');
-    hourSelect.addEventListener('change', function() {
-        var selectedHour = this.value;
-        console.log("Selected Hour:", selectedHour); // Debugging the selected hour
-        var layers = document.getElementsByClassName("leaflet-control-layers-selector");
-        layers.forEach((layer, index) => {
-            if (index > 0) {  // Skip the first checkbox (OpenStreetMap)
-                var layerName = layer.nextSibling.textContent.trim();
-                console.log("Layer Name:", layerName); // Debugging layer name
-                if (layer.checked) {
-                    // Remove existing layer
-                    map.removeLayer(window[layerName.toLowerCase().replace(' ', '_') + '_layer']);
-                    // Add new filtered layer
-                    window[layerName.toLowerCase().replace(' ', '_') + '_layer'] = 
-                        create_route_layer(window[layerName.toLowerCase().replace(' ', '_') + '_df'], 
-                                           layerName, map, selectedHour ? parseInt(selectedHour) : null);
-                }
-            }
-        });
-    });
-});
-</script>
-"""
-
-# Save map to HTML file
-viz_dir = "C:/temp/bus_maps"
-if not os.path.exists(viz_dir):
-    os.makedirs(viz_dir)
-timenow = datetime.now().strftime("%Y%m%d%H%M%S")
-output_path = os.path.join(viz_dir, f"all_routes_map_{timenow}.html")
-
-map_.save(output_path)
-
-# Add XOR JavaScript and hour filter to the saved HTML file
-with open(output_path, 'r') as file:
-    content = file.read()
-    content = content.replace('</body>', hour_filter_html + xor_js + hour_filter_js + '</body>')
+def main(argv=None):
+    # Built by build_maps.py, which caches each route's layer between runs
+    build_maps.script_main('traffic', 'all_routes_map', argv)
 
-with open(output_path, 'w') as file:
-    file.write(content)
\ No newline at end of file
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,315 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+from functools import partial
+import folium
+import numpy as np
+import pandas as pd
+from all_routes_traffichourfilter import filter_df_by_hour, run_popup
+from build_maps import build_maps
+from client_layers import ClientRoutes, HourBundleRoutes, bundle_script, hour_bundle_payload, route_payload
+from route_bins import RouteBins
+from route_classify import ROAD, TRAFFIC
+from route_compress import compress_stationary
+from route_loader import cache_dir_for, load_route_csv, route_version
+from route_match import RouteCenterline, match_route
+from route_raster import render_tiles
+from route_lod import LOD_LEVELS, lod_tolerance
+from route_segments import add_route_runs
+from route_stream import render_streamed
+from route_time_index import RouteTimeIndex
+from route_travel import RouteTravelTimes, route_kinematics
+from summary_cube import SummaryCube
+from synthetic_routes import write_synthetic_csv
+
+try:
+    import bus_routes_app
+    import streamlit.logger
+    # Outside `streamlit run` every cached call warns that there is no script context
+    streamlit.logger.set_log_level('error')
+except ImportError:
+    # The app's stages need streamlit and streamlit-folium
+    bus_routes_app = None
+
+# Times every stage a route goes through on its way to a map, on synthetic routes of
+# several sizes, including the two entry points end to end (build_maps.py and the app's
+# render_route), and compares the numbers against the baseline committed beside this
+# file. Timings only compare on one machine, so record a baseline on the machine that
+# runs the comparison:
+#   python benchmark_routes.py --save-baseline
+#   python benchmark_routes.py            # exits 1 on any regression or without a baseline
+# Default sizes; pass --rows 1000000 10000000 for the large ones, where the full-detail
+# runs_* stages take minutes
+BENCH_SIZES = (10_000, 100_000)
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'benchmark_baseline.json')
+# Views app_render builds: all hours and one hour
+APP_HOURS = (None, 8)
+# Maps build_maps_all writes: the hour bundle, one binned hour and the raster tiles
+BUILD_MAPS = ({'variant': 'traffic'}, {'variant': 'hourly', 'hours': [8]}, {'variant': 'density'})
+# A stage regresses when it is this much slower (or bigger) than the baseline...
+TOLERANCE = 0.25
+# ...and, for times, also slower by at least this many seconds, so that timer noise on
+# millisecond stages does not fail the run
+MIN_SLOWDOWN_S = 0.01
+# HTML output is deterministic for a seed, so its size gets a much tighter bound
+HTML_TOLERANCE = 0.01
+ROUTE_NAME = 'Benchmark Route'
+
+def runs_map(df):
+    # The app's create_route_layer: one PolyLine per same-colored run, at full detail
+    m = folium.Map(location=[df['latitude'].mean(), df['longitude'].mean()], zoom_start=16)
+    feature_group = folium.FeatureGroup(name=ROUTE_NAME)
+    add_route_runs(feature_group, df, 'traffic_congestion', TRAFFIC, partial(run_popup, ROUTE_NAME))
+    feature_group.add_to(m)
+    return m
+
+def client_map(df):
+    # all_routes_viz: geometry as typed arrays, drawn in the browser per level of detail
+    m = folium.Map(location=[df['latitude'].mean(), df['longitude'].mean()], zoom_start=16)
+    layer = folium.FeatureGroup(name=ROUTE_NAME).add_to(m)
+    payload = route_payload(df, ROUTE_NAME, ['road_condition'], LOD_LEVELS)
+    ClientRoutes([payload], [layer], ROAD.palette, popup_label='Avg Road Condition').add_to(m)
+    return m
+
+def compact_runs_map(df):
+    # build_maps --compact: the runs map's popups and colors looked up client-side
+    m = folium.Map(location=[df['latitude'].mean(), df['longitude'].mean()], zoom_start=16)
+    layer = folium.FeatureGroup(name=ROUTE_NAME).add_to(m)
+    payload = route_payload(df, ROUTE_NAME, ['traffic_congestion'], LOD_LEVELS, with_times=True)
+    ClientRoutes([payload], [layer], TRAFFIC.palette, descriptions=TRAFFIC.labels).add_to(m)
+    return m
+
+def hour_bundle_map(df):
+    # build_maps traffic: every hour's runs in one bundle script beside the page
+    m = folium.Map(location=[df['latitude'].mean(), df['longitude'].mean()], zoom_start=16)
+    layer = folium.FeatureGroup(name=ROUTE_NAME).add_to(m)
+    payload = hour_bundle_payload(df, ROUTE_NAME, 'traffic_congestion', lod_tolerance(16))
+    HourBundleRoutes([layer], TRAFFIC.palette, TRAFFIC.labels).add_to(m)
+    return m, bundle_script([payload])
+
+def summary_cube(state):
+    cube = SummaryCube('traffic_congestion')
+    cube.add(ROUTE_NAME, state['load_cached'])
+    return cube
+
+def load_cache_build(state):
+    shutil.rmtree(cache_dir_for(state['path']), ignore_errors=True)
+    return load_route_csv(state['path'])
+
+def raster_tiles(state):
+    # build_maps density: every zoom level's PNG tiles, next to the CSV
+    return render_tiles(state['load_cached'], 'traffic_congestion', state['path'] + '.tiles', TRAFFIC.palette)
+
+def route_bins(state):
+    df = state['load_cached']
+    bins = RouteBins.from_route(df)
+    return bins.aggregate(df, ['traffic_congestion', 'road_condition'])
+
+def build_maps_all(state):
+    # python build_maps.py for BUILD_MAPS from scratch (no layer cache), in this process
+    config = {'output_dir': state['path'] + '.maps',
+              'maps': [dict(spec, routes={ROUTE_NAME: state['path']}) for spec in BUILD_MAPS]}
+    with contextlib.redirect_stdout(io.StringIO()):
+        return build_maps(config, workers=1, force=True)
+
+def app_render(state, binned):
+    # bus_routes_app.render_route for APP_HOURS from cold caches: loading, the hour
+    # index, binning (when binned) and the map with its stats, plus the map's HTML as
+    # st_folium receives it
+    bus_routes_app.st.cache_resource.clear()
+    version = ((ROUTE_NAME, state['path'], route_version(state['path'])),)
+    maps = [bus_routes_app.render_route(ROUTE_NAME, hour, version, binned)[0] for hour in APP_HOURS]
+    return ''.join(m.get_root().render() for m in maps)
+
+APP_STAGES = [
+    ('app_render_html', (), partial(app_render, binned=False)),
+    ('app_binned_html', (), partial(app_render, binned=True)),
+] if bus_routes_app is not None else []
+
+# (name, stages it reads, function of the state); each result is stored under its name
+STAGES = [
+    ('load_csv', (), lambda state: load_route_csv(state['path'], use_cache=False)),
+    ('load_cache_build', (), load_cache_build),
+    ('load_cached', ('load_cache_build',), lambda state: load_route_csv(state['path'])),
+    ('time_index', ('load_cached',), lambda state: RouteTimeIndex(state['load_cached'])),
+    ('hour_filter', ('time_index',), lambda state: [filter_df_by_hour(state['time_index'], hour) for hour in range(24)]),
+    ('compress_stationary', ('load_cached',), lambda state: compress_stationary(state['load_cached'])),
+    ('runs_layer', ('load_cached',), lambda state: runs_map(state['load_cached'])),
+    ('runs_html', ('runs_layer',), lambda state: state['runs_layer'].get_root().render()),
+    ('compact_runs_layer', ('load_cached',), lambda state: compact_runs_map(state['load_cached'])),
+    ('compact_runs_html', ('compact_runs_layer',), lambda state: state['compact_runs_layer'].get_root().render()),
+    ('hour_bundle_layer', ('load_cached',), lambda state: hour_bundle_map(state['load_cached'])),
+    # Page and bundle together
+    ('hour_bundle_html', ('hour_bundle_layer',),
+     lambda state: state['hour_bundle_layer'][0].get_root().render() + state['hour_bundle_layer'][1]),
+    ('stream_map', (), lambda state: render_streamed({ROUTE_NAME: state['path']}, state['path'] + '.stream.html')),
+    ('client_layer', ('load_cached',), lambda state: client_map(state['load_cached'])),
+    ('client_html', ('client_layer',), lambda state: state['client_layer'].get_root().render()),
+    ('raster_tiles', ('load_cached',), raster_tiles),
+    ('route_bins', ('load_cached',), route_bins),
+    ('centerline', ('load_cached',), lambda state: RouteCenterline.from_traces(state['load_cached'])),
+    ('map_match', ('load_cached', 'centerline'), lambda state: match_route(state['load_cached'], state['centerline'])),
+    ('kinematics', ('load_cached',), lambda state: route_kinematics(state['load_cached'])),
+    ('travel_times', ('load_cached', 'kinematics'),
+     lambda state: RouteTravelTimes(RouteBins.from_route(state['load_cached']), state['kinematics'])),
+    ('summary_cube', ('load_cached',), summary_cube),
+    ('cube_query', ('summary_cube',), lambda state: [state['summary_cube'].summary(hours=[hour]) for hour in range(24)]),
+    ('build_maps', (), build_maps_all),
+] + APP_STAGES
+STAGE_NAMES = [name for name, _, _ in STAGES]
+
+def measure(function, state, repeat):
+    # Best of `repeat` timed runs, then one more under tracemalloc for the peak of
+    # Python and NumPy allocations (memory-mapped columns are not counted)
+    seconds = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        value = function(state)
+        seconds.append(time.perf_counter() - start)
+    tracemalloc.start()
+    try:
+        function(state)
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    return value, {'seconds': min(seconds), 'peak_bytes': peak}
+
+def run_size(rows, seed, repeat, workdir, stages=STAGE_NAMES):
+    path = os.path.join(workdir, f'synthetic_{rows}_{seed}.csv')
+    write_synthetic_csv(path, rows, seed)
+    # Stages that are only needed as inputs run once, untimed
+    needed = set(stages)
+    for name, requires, _ in reversed(STAGES):
+        if name in needed:
+            needed.update(requires)
+
+    state = {'path': path}
+    results = {}
+    for name, _, function in STAGES:
+        if name not in needed:
+            continue
+        if name in stages:
+            state[name], results[name] = measure(function, state, repeat)
+            if name.endswith('_html'):
+                results[name]['html_bytes'] = len(state[name].encode('utf-8'))
+        else:
+            state[name] = function(state)
+    return results
+
+def environment():
+    return {
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'pandas': pd.__version__,
+        'folium': folium.__version__,
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+    }
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Regression messages for every (size, stage, metric) present in both runs
+    regressions = []
+    for rows, stages in results['sizes'].items():
+        for stage, metrics in stages.items():
+            base = baseline['sizes'].get(rows, {}).get(stage)
+            if base is None:
+                continue
+            for metric, value in metrics.items():
+                if metric not in base:
+                    continue
+                limit = base[metric] * (1 + (HTML_TOLERANCE if metric == 'html_bytes' else tolerance))
+                if metric == 'seconds':
+                    limit = max(limit, base[metric] + MIN_SLOWDOWN_S)
+                if value > limit:
+                    regressions.append(f"{stage} @ {rows} rows: {metric} {value:,.4g} vs baseline {base[metric]:,.4g} "
+                                       f"({value / base[metric] - 1:+.0%})")
+    return regressions
+
+def format_table(results, baseline=None):
+    lines = [f"{'rows':>10}  {'stage':<17}{'seconds':>10}{'baseline':>10}{'change':>8}{'peak MB':>10}{'html KB':>10}"]
+    for rows, stages in results['sizes'].items():
+        for stage, metrics in stages.items():
+            base = (baseline or {}).get('sizes', {}).get(rows, {}).get(stage, {})
+            base_seconds = f"{base['seconds']:.4f}" if 'seconds' in base else ''
+            change = f"{metrics['seconds'] / base['seconds'] - 1:+.0%}" if base.get('seconds') else ''
+            html = f"{metrics['html_bytes'] / 1024:,.0f}" if 'html_bytes' in metrics else ''
+            lines.append(f"{int(rows):>10,}  {stage:<17}{metrics['seconds']:>10.4f}"
+                         f"{base_seconds:>10}{change:>8}"
+                         f"{metrics['peak_bytes'] / 2 ** 20:>10.1f}{html:>10}")
+    return "\n".join(lines)
+
+def load_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+def write_json(path, data):
+    with open(path, 'w') as file:
+        json.dump(data, file, indent=2, sort_keys=True)
+        file.write("\n")
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=list(BENCH_SIZES),
+                        help="synthetic route sizes to run (10k to 10M rows)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--repeat', type=int, default=3, help="timed runs per stage; the best one is kept")
+    parser.add_argument('--stages', nargs='+', choices=STAGE_NAMES, default=STAGE_NAMES)
+    parser.add_argument('--workdir', help="where to write the synthetic CSVs (default: a temporary directory)")
+    parser.add_argument('--output', help="also write this run's results to a JSON file")
+    parser.add_argument('--baseline', default=BASELINE_PATH)
+    parser.add_argument('--save-baseline', action='store_true', help="store this run as the baseline")
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="allowed slowdown/growth before a stage counts as a regression")
+    args = parser.parse_args(argv)
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix='busmap_bench_')
+    try:
+        results = {
+            'environment': environment(),
+            'seed': args.seed,
+            'repeat': args.repeat,
+            'sizes': {str(rows): run_size(rows, args.seed, args.repeat, workdir, args.stages) for rows in args.rows},
+        }
+    finally:
+        if not args.workdir:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if args.output:
+        write_json(args.output, results)
+
+    if args.save_baseline:
+        print(format_table(results))
+        write_json(args.baseline, results)
+        print(f"Saved baseline to {args.baseline}")
+        return 0
+
+    if not os.path.exists(args.baseline):
+        print(format_table(results))
+        print(f"No baseline at {args.baseline}; run with --save-baseline to record one")
+        return 1
+
+    baseline = load_json(args.baseline)
+    print(format_table(results, baseline))
+    if baseline.get('environment') != results['environment']:
+        print(f"Warning: the baseline was recorded in a different environment: {baseline.get('environment')}")
+    if baseline.get('seed') != results['seed']:
+        print(f"Warning: the baseline used seed {baseline.get('seed')}, this run seed {results['seed']}")
+    regressions = compare(results, baseline, args.tolerance)
+    if regressions:
+        print(f"\nREGRESSIONS ({len(regressions)}):")
+        for regression in regressions:
+            print(f"  {regression}")
+        return 1
+    print("No regressions against the baseline")
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
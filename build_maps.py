@@ -0,0 +1,484 @@
+import argparse
+import ast
+import gzip
+import hashlib
+import importlib
+import json
+import os
+from datetime import datetime
+import folium
+from folium.plugins import MousePosition
+import numpy as np
+from client_layers import ClientRoutes, HourBundleRoutes, bundle_script
+from history_store import route_dir_name
+from parallel_build import add_worker_argument, build_fragments, payload_fragment, stabilize_ids
+from route_loader import STATIONARY_PREFIX, load_route, route_version
+from route_lod import LOD_LEVELS
+from route_raster import route_tile_layer
+from stage_timing import add_profile_arguments, profiling, stage
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# One entry point for every map variant. Each route's layer is built once per
+# (input file content, parameters, code version) and kept as a JSON fragment under
+# <output dir>/.layers/, so rebuilding after one CSV changes only re-renders that route,
+# and a map whose layers and code are all unchanged is not written again.
+#
+#   python build_maps.py                     # every variant into DEFAULT_OUTPUT_DIR
+#   python build_maps.py road hourly --output-dir maps
+#   python build_maps.py --config maps.json
+#   python build_maps.py traffic --compact   # small pages plus .gz/.br for static hosting
+#
+# A config file is {"output_dir": ..., "compact": false, "stationary": false, "maps":
+# [{"variant": ..., "routes": {name: csv}, "output": file stem, "hours": [...]}, ...]};
+# every key but "variant" is optional. With "stationary" (--stationary), routes are
+# read with their stationary runs collapsed (route_compress).
+#
+# In compact mode the hourly run maps are drawn like the others, from typed
+# arrays with color and popup text looked up client-side, instead of one PolyLine per
+# run with its own style and popup; every map also gets precompressed .gz (and, when
+# the brotli package is installed, .br) siblings.
+#
+# The traffic map's hour filter works offline: every route's runs for every hour are
+# built in one pass and written to <page>.bundle.js beside the page, and choosing an
+# hour only slices that bundle in the browser (client_layers.HourBundleRoutes).
+#
+# The hourly maps are drawn from each route's fixed-length bins (route_bins, matched
+# with route_match), one line per run of same-colored bins averaged over every pass in
+# the hour, instead of every overlapping pass.
+#
+# The density map draws no vectors: each route's fixes are rasterized into PNG tiles
+# under <output dir>/tiles/<output>/<route>/ (route_raster), loaded as TileLayers, so
+# months of traces cost the browser no more than one day's.
+#
+# Every route is loaded whole. Routes too large for that are drawn by the separate
+# route_stream command, which sorts and renders them in bounded memory into the same
+# page skeleton (add_controls, render_html); build_maps does not call it.
+DEFAULT_OUTPUT_DIR = "C:/temp/bus_maps"
+LAYER_CACHE_DIR = '.layers'
+class ClientMap:
+    # Geometry as typed arrays drawn in the browser (all_routes_viz, all_routes_timeseries)
+
+    def __init__(self, module, columns, popup_label, attribute_labels=None, head=(), body=('xor_js',)):
+        self.module = module
+        self.columns = columns
+        self.popup_label = popup_label
+        self.attribute_labels = attribute_labels
+        self.head = head
+        self.body = body
+
+    def outputs(self, spec):
+        return [(spec.get('output', spec['variant']), {})]
+
+    def job(self, path, route_name, params):
+        return payload_fragment, (path, route_name, self.columns, LOD_LEVELS)
+
+    def side_outputs(self, file_name, params, route_names):
+        return []
+
+    def add_layers(self, map_, module, route_names, fragments, params):
+        layers = [folium.FeatureGroup(name=route_name).add_to(map_) for route_name in route_names]
+        ClientRoutes(
+            fragments,
+            layers,
+            palette=module.SCALE.palette,
+            attribute_labels=self.attribute_labels(module) if self.attribute_labels else (),
+            popup_label=self.popup_label,
+        ).add_to(map_)
+
+class RunsMap:
+    # One PolyLine per same-colored run, optionally for a single hour; binned, runs of the
+    # route's fixed-length bins instead of every pass (all_routes_traffichourfilter)
+
+    def __init__(self, module, hourly=False, binned=False, body=('xor_js',)):
+        self.module = module
+        self.hourly = hourly
+        self.binned = binned
+        self.body = body
+        self.head = ()
+
+    def outputs(self, spec):
+        stem = spec.get('output', spec['variant'])
+        if not self.hourly:
+            return [(stem, {'hour': spec.get('hour')})]
+        return [(f"{stem}_{hour:02d}", {'hour': hour}) for hour in spec.get('hours', range(7, 20))]
+
+    def job(self, path, route_name, params):
+        module = importlib.import_module(self.module)
+        if self.binned:
+            build = module.route_binned_payload if params['compact'] else module.route_binned_lines
+        else:
+            build = module.route_layer_payload if params['compact'] else module.route_layer_lines
+        return build, (path, route_name, params['hour'])
+
+    def side_outputs(self, file_name, params, route_names):
+        return []
+
+    def add_layers(self, map_, module, route_names, fragments, params):
+        if params['compact']:
+            layers = [folium.FeatureGroup(name=route_name).add_to(map_) for route_name in route_names]
+            ClientRoutes(
+                fragments,
+                layers,
+                palette=module.SCALE.palette,
+                descriptions=module.SCALE.labels,
+            ).add_to(map_)
+            return
+        for route_name, lines in zip(route_names, fragments):
+            module.create_route_layer(lines, route_name, map_)
+
+class BundleMap:
+    # Every hour's runs of every route precomputed into one <page>.bundle.js beside the
+    # page, which an hour selector slices in the browser (all_routes_traffichourfilter)
+
+    def __init__(self, module, body=('xor_js',)):
+        self.module = module
+        self.body = body
+        self.head = ()
+
+    def outputs(self, spec):
+        return [(spec.get('output', spec['variant']), {})]
+
+    def job(self, path, route_name, params):
+        module = importlib.import_module(self.module)
+        return module.route_bundle_payload, (path, route_name)
+
+    def side_outputs(self, file_name, params, route_names):
+        return [os.path.splitext(file_name)[0] + '.bundle.js']
+
+    def add_layers(self, map_, module, route_names, fragments, params):
+        bundle_name, = self.side_outputs(params['file_name'], params, route_names)
+        bundle_path = os.path.join(params['output_dir'], bundle_name)
+        with stage('save_bundle') as timed:
+            data = bundle_script(fragments).encode('utf-8')
+            timed.output_bytes = len(data)
+            write_output(bundle_path, data, params['compact'])
+        # Loaded in <head>, so the bundle is in place before the map's script runs
+        map_.get_root().header.add_child(folium.JavascriptLink(bundle_name), name='hour_bundle')
+        layers = [folium.FeatureGroup(name=route_name).add_to(map_) for route_name in route_names]
+        HourBundleRoutes(layers, palette=module.SCALE.palette, descriptions=module.SCALE.labels).add_to(map_)
+
+class RasterMap:
+    # Pre-rendered PNG tiles per route, optionally for a single hour (route_raster)
+
+    def __init__(self, module, column='traffic_congestion'):
+        self.module = module
+        self.column = column
+        self.head = ()
+        self.body = ()
+
+    def outputs(self, spec):
+        stem = spec.get('output', spec['variant'])
+        if 'hours' not in spec:
+            return [(stem, {'hour': spec.get('hour'), 'tiles': f"tiles/{stem}"})]
+        return [(f"{stem}_{hour:02d}", {'hour': hour, 'tiles': f"tiles/{stem}_{hour:02d}"}) for hour in spec['hours']]
+
+    def job(self, path, route_name, params):
+        module = importlib.import_module(self.module)
+        tiles_url = f"{params['tiles']}/{route_dir_name(route_name)}"
+        return route_tile_layer, (path, self.column, params['hour'], module.SCALE.palette,
+                                  os.path.join(params['output_dir'], *tiles_url.split('/')), tiles_url)
+
+    def side_outputs(self, file_name, params, route_names):
+        return [f"{params['tiles']}/{route_dir_name(route_name)}" for route_name in route_names]
+
+    def add_layers(self, map_, module, route_names, fragments, params):
+        for route_name, layer in zip(route_names, fragments):
+            folium.TileLayer(
+                tiles=layer['url'],
+                attr='Bus traces',
+                name=route_name,
+                overlay=True,
+                min_zoom=layer['min_zoom'],
+                max_native_zoom=layer['max_zoom'],
+                max_zoom=20,
+            ).add_to(map_)
+
+VARIANTS = {
+    'road': ClientMap('all_routes_viz', ['road_condition'], 'Avg Road Condition'),
+    'timeseries': ClientMap('all_routes_timeseries', [f'road_condition_{phase}' for phase in range(1, 6)],
+                            'Ride Quality', lambda module: [module.get_time_of_day(phase) for phase in module.PHASES],
+                            head=('phase_css',)),
+    'traffic': BundleMap('all_routes_traffichourfilter'),
+    'hourly': RunsMap('all_routes_traffichourfilter', hourly=True, binned=True),
+    'density': RasterMap('all_routes_traffichourfilter'),
+}
+
+_code_versions = {}
+
+def code_files(module_names, here):
+    # The modules' source files and those of every module of this directory they import,
+    # at any depth (imports inside functions included), sorted
+    files = set()
+    pending = [name + '.py' for name in module_names]
+    while pending:
+        name = pending.pop()
+        if name in files or not os.path.exists(os.path.join(here, name)):
+            continue
+        files.add(name)
+        with open(os.path.join(here, name), 'rb') as file:
+            tree = ast.parse(file.read(), name)
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                pending.extend(alias.name + '.py' for alias in node.names)
+            elif isinstance(node, ast.ImportFrom) and node.module and not node.level:
+                pending.append(node.module + '.py')
+    return sorted(files)
+
+def code_version(module_name):
+    # Hash of every source file a layer of the module can depend on: build_maps, the
+    # variant module and all they import from this directory
+    if module_name not in _code_versions:
+        digest = hashlib.sha256()
+        here = os.path.dirname(os.path.abspath(__file__))
+        for name in code_files(['build_maps', module_name], here):
+            with open(os.path.join(here, name), 'rb') as file:
+                digest.update(name.encode() + b'\0' + file.read())
+        _code_versions[module_name] = digest.hexdigest()
+    return _code_versions[module_name]
+
+def content_key(*parts):
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+def layer_fragment(job):
+    # (build, build job, csv path) -> the built layer plus the route's center; runs in a
+    # worker. The route is loaded once and handed to build in place of its source.
+    build, build_job, path = job
+    df = load_route(path)
+    return {
+        'center': [float(df['latitude'].mean()), float(df['longitude'].mean())],
+        'layer': build((df,) + tuple(build_job[1:])),
+    }
+
+def read_json(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def write_json(path, data):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as file:
+        json.dump(data, file, separators=(',', ':'))
+    os.replace(tmp_path, path)
+
+def plan_maps(config, timestamp=False):
+    # Every output map with its variant, routes and per-route layer keys
+    plans = []
+    versions = {}
+    timenow = datetime.now().strftime("%Y%m%d%H%M%S")
+    compact = bool(config.get('compact', False))
+    output_dir = config.get('output_dir', DEFAULT_OUTPUT_DIR)
+    for spec in config['maps']:
+        variant = VARIANTS[spec['variant']]
+        module = importlib.import_module(variant.module)
+        routes = spec.get('routes') or module.ROUTE_FILES
+        if config.get('stationary'):
+            routes = {route_name: STATIONARY_PREFIX + path for route_name, path in routes.items()}
+        for stem, params in variant.outputs(spec):
+            params['compact'] = compact
+            params['output_dir'] = output_dir
+            layers = []
+            for route_name, path in routes.items():
+                if path not in versions:
+                    versions[path] = route_version(path)
+                build, build_job = variant.job(path, route_name, params)
+                key = content_key(spec['variant'], route_name, versions[path], build.__name__, build_job[1:],
+                                  code_version(variant.module))
+                layers.append((route_name, key, (build, build_job, path)))
+            plans.append({
+                'variant': variant,
+                'module': module,
+                'file_name': f"{stem}_{timenow}.html" if timestamp else f"{stem}.html",
+                'params': params,
+                'layers': layers,
+                'key': content_key(spec['variant'], stem, [key for _, key, _ in layers], code_version(variant.module),
+                                   compact),
+            })
+    return plans
+
+def layer_files_exist(fragment):
+    # Layers that write files besides their fragment (route_raster tiles) list them
+    layer = fragment['layer']
+    return not isinstance(layer, dict) or all(os.path.exists(path) for path in layer.get('files', ()))
+
+def map_outputs(plan):
+    # The page and the files it loads (bundle, tiles), relative to the output directory
+    return [plan['file_name']] + plan['variant'].side_outputs(
+        plan['file_name'], plan['params'], [route_name for route_name, _, _ in plan['layers']])
+
+def load_layers(plans, cache_dir, workers=None, force=False):
+    # Layer fragments by key: cached ones from disk, the rest built (in parallel) and saved.
+    # A cached layer whose files are gone is built again.
+    fragments = {}
+    missing = {}
+    for plan in plans:
+        for _, key, job in plan['layers']:
+            if key in fragments or key in missing:
+                continue
+            cached = None if force else read_json(os.path.join(cache_dir, key + '.json'))
+            if cached is None or not layer_files_exist(cached):
+                missing[key] = job
+            else:
+                fragments[key] = cached
+    with stage('build_layers', rows=len(missing)):
+        built = build_fragments(layer_fragment, missing.values(), workers) if missing else []
+    for key, fragment in zip(missing, built):
+        # Round-trip through JSON so fresh and cached fragments are identical
+        fragment = json.loads(json.dumps(fragment))
+        write_json(os.path.join(cache_dir, key + '.json'), fragment)
+        fragments[key] = fragment
+    return fragments, len(missing)
+
+def inject(html, snippets, tag):
+    return html.replace(tag, ''.join(snippets) + tag)
+
+COMPRESSED_SUFFIXES = ('.gz', '.br')
+
+def write_compressed(path, data):
+    # Precompressed siblings for servers that send path.gz / path.br as-is
+    with stage('compress') as timed:
+        compressed = {'.gz': gzip.compress(data, compresslevel=9, mtime=0)}
+        if brotli is not None:
+            compressed['.br'] = brotli.compress(data, quality=11)
+        for suffix in COMPRESSED_SUFFIXES:
+            if suffix not in compressed and os.path.exists(path + suffix):
+                os.remove(path + suffix)
+        for suffix, payload in compressed.items():
+            with open(path + suffix, 'wb') as file:
+                file.write(payload)
+        timed.output_bytes = sum(len(payload) for payload in compressed.values())
+
+def write_output(path, data, compact):
+    # Writes a page or bundle, with precompressed siblings in compact mode; otherwise any
+    # siblings left by an earlier compact build are removed, so a server that prefers
+    # them does not keep sending the old content
+    with open(path, 'wb') as file:
+        file.write(data)
+    if compact:
+        write_compressed(path, data)
+        return
+    for suffix in COMPRESSED_SUFFIXES:
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+def add_controls(map_):
+    # Add XOR-style layer control
+    folium.LayerControl(collapsed=False).add_to(map_)
+
+    # Add mouse position
+    formatter = "function(num) {return L.Util.formatNum(num, 5);};"
+    MousePosition(
+        position='topright',
+        separator=' | ',
+        empty_string='NaN',
+        lng_first=True,
+        num_digits=20,
+        prefix='Coordinates:',
+        lat_formatter=formatter,
+        lng_formatter=formatter,
+    ).add_to(map_)
+
+def render_html(map_, module, head, body):
+    # The map document with the variant's CSS and JavaScript snippets added
+    stabilize_ids(map_.get_root())
+    html = map_.get_root().render()
+    html = inject(html, [getattr(module, name) for name in head], '</head>')
+    return inject(html, [getattr(module, name) for name in body], '</body>')
+
+def render_map(plan, fragments, output_path):
+    variant, module = plan['variant'], plan['module']
+    route_fragments = [fragments[key] for _, key, _ in plan['layers']]
+    center = np.mean([fragment['center'] for fragment in route_fragments], axis=0)
+    map_ = folium.Map(location=list(center), zoom_start=16)
+    variant.add_layers(map_, module, [route_name for route_name, _, _ in plan['layers']],
+                       [fragment['layer'] for fragment in route_fragments],
+                       dict(plan['params'], file_name=plan['file_name']))
+    add_controls(map_)
+
+    with stage('save') as timed:
+        data = render_html(map_, module, variant.head, variant.body).encode('utf-8')
+        timed.output_bytes = len(data)
+        write_output(output_path, data, plan['params']['compact'])
+
+def build_maps(config, workers=None, force=False, timestamp=False):
+    # Returns the paths of the maps written; unchanged maps are skipped unless forced
+    output_dir = config.get('output_dir', DEFAULT_OUTPUT_DIR)
+    cache_dir = os.path.join(output_dir, LAYER_CACHE_DIR)
+    os.makedirs(cache_dir, exist_ok=True)
+    built_path = os.path.join(cache_dir, 'maps.json')
+    built_maps = read_json(built_path) or {}
+
+    with stage('plan'):
+        plans = plan_maps(config, timestamp)
+    stale = [plan for plan in plans
+             if force or timestamp or built_maps.get(plan['file_name']) != plan['key']
+             or not all(os.path.exists(os.path.join(output_dir, name)) for name in map_outputs(plan))]
+    fragments, rebuilt = load_layers(stale, cache_dir, workers, force)
+    print(f"{len(plans) - len(stale)} of {len(plans)} maps up to date; rebuilt {rebuilt} route layers")
+
+    written = []
+    for plan in stale:
+        output_path = os.path.join(output_dir, plan['file_name'])
+        render_map(plan, fragments, output_path)
+        if not timestamp:
+            built_maps[plan['file_name']] = plan['key']
+        written.append(output_path)
+        print(f"Wrote {output_path}")
+    write_json(built_path, built_maps)
+    return written
+
+def add_build_arguments(parser):
+    add_worker_argument(parser)
+    add_profile_arguments(parser)
+    parser.add_argument('--output-dir', help=f"where maps are written (default: {DEFAULT_OUTPUT_DIR})")
+    parser.add_argument('--force', action='store_true', help="rebuild every layer and map, ignoring the cache")
+    parser.add_argument('--compact', action='store_true',
+                        help="draw run maps from typed arrays and write .gz/.br siblings of every map")
+    parser.add_argument('--stationary', action='store_true',
+                        help="collapse runs of fixes where the bus stood still before drawing")
+    return parser
+
+def main(argv=None):
+    parser = add_build_arguments(argparse.ArgumentParser())
+    parser.add_argument('variants', nargs='*', metavar='variant',
+                        help=f"map variants to build: {', '.join(VARIANTS)} (default: all, or the maps in --config)")
+    parser.add_argument('--config', help="JSON file listing the maps to build")
+    parser.add_argument('--timestamp', action='store_true',
+                        help="write new timestamped files instead of updating <variant>.html")
+    args = parser.parse_args(argv)
+    unknown = [variant for variant in args.variants if variant not in VARIANTS]
+    if unknown:
+        parser.error(f"unknown variants: {', '.join(unknown)}")
+
+    config = read_json(args.config) if args.config else {}
+    if args.config and config is None:
+        parser.error(f"cannot read config {args.config}")
+    if args.variants or 'maps' not in config:
+        config['maps'] = [{'variant': variant} for variant in args.variants or VARIANTS]
+    if args.output_dir:
+        config['output_dir'] = args.output_dir
+    if args.compact:
+        config['compact'] = True
+    if args.stationary:
+        config['stationary'] = True
+
+    with profiling(args.profile, args.profile_sort):
+        build_maps(config, args.workers, args.force, args.timestamp)
+
+def script_main(variant, output, argv=None):
+    # Entry point kept for the per-variant scripts: a new timestamped map per run
+    args = add_build_arguments(argparse.ArgumentParser()).parse_args(argv)
+    config = {'maps': [{'variant': variant, 'output': output}], 'compact': args.compact,
+              'stationary': args.stationary}
+    if args.output_dir:
+        config['output_dir'] = args.output_dir
+    with profiling(args.profile, args.profile_sort):
+        build_maps(config, args.workers, args.force, timestamp=True)
+
+if __name__ == '__main__':
+    main()
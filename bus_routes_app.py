@@ -1,102 +1,251 @@
+import os
+import threading
 import streamlit as st
 import pandas as pd
 import folium
 from streamlit_folium import st_folium
 import numpy as np
+from route_classify import TRAFFIC
+from route_loader import STATIONARY_PREFIX, load_route, route_version
+from route_match import matched_bins
+from route_segments import add_route_runs
+from route_spatial import RouteSpatialIndex
+from summary_cube import SummaryCube
+from route_time_index import RouteTimeIndex
+import stage_timing
+from stage_timing import stage
 
-@st.cache_data
-def filter_df_by_hour(df, hour):
-    df['hour_filter'] = pd.to_datetime(df['est_time'], format='%H:%M:%S', errors='coerce').dt.hour
-    return df[df['hour_filter'] == hour]
-
-def get_color_for_condition(condition):
-    if condition <= 0:
-        return '#808080'  # Gray for unavailable data
-    elif condition <= 1:
-        return '#00FF00'  # Green for excellent; no traffic congestion
-    elif condition <= 2:
-        return '#7FFF00'  # Chartreuse for good; minor traffic congestion
-    elif condition <= 3:
-        return '#FFFF00'  # Yellow for average; moderate traffic congestion
-    elif condition <= 4:
-        return '#FF7F00'  # Orange for below average; moderate-heavy traffic congestion
-    else:
-        return '#FF0000'  # Red for poor quality; heavy traffic congestion
-
-def describe_congestion(num):
-    if num <= 1:
-        return "No Traffic Congestion"
-    elif num <= 2:
-        return "Minor Traffic Congestion"
-    elif num <= 3:
-        return "Moderate Traffic Congestion"
-    elif num <= 4:
-        return "Moderate-Heavy Traffic Congestion"
-    else:
-        return "Heavy Traffic Congestion"
+def filter_df_by_hour(time_index, hour):
+    # Slice of the precomputed hour index; the cached data is never modified
+    return time_index.hour(hour)
 
-def create_route_layer(df, route_name, hour=None):
-    if hour is not None:
-        df = filter_df_by_hour(df, hour)
+get_color_for_condition = TRAFFIC.color
+describe_congestion = TRAFFIC.label
+
+def create_route_layer(time_index, route_name, hour=None):
+    df = filter_df_by_hour(time_index, hour) if hour is not None else time_index.df
     
     feature_group = folium.FeatureGroup(name=route_name)
     
-    df = df.dropna(subset=['latitude', 'longitude']).sort_values('time')
+    def popup_for(df, values, start, stop):
+        est_time = df['est_time']
+        return f"{route_name}, {est_time.iat[start]} - {est_time.iat[stop]}, {describe_congestion(values[start])}"
     
-    for i in range(len(df) - 1):
-        start_row = df.iloc[i]
-        end_row = df.iloc[i + 1]
-        
-        folium.PolyLine(
-            locations=[[start_row['latitude'], start_row['longitude']],
-                       [end_row['latitude'], end_row['longitude']]],
-            color=get_color_for_condition(start_row['traffic_congestion']),
-            weight=7,
-            opacity=0.7,
-            popup=f"{route_name}, {start_row['est_time']}, {describe_congestion(start_row['traffic_congestion'])}"
-        ).add_to(feature_group)
+    add_route_runs(feature_group, df, 'traffic_congestion', TRAFFIC, popup_for)
     
     return feature_group
 
-# Load the data
-@st.cache_data
-def load_data():
+def create_binned_layer(bins, table, route_name, hour=None):
+    # One line per run of same-colored bins, drawn from the aggregated table instead of
+    # every overlapping trace
+    df = bins.route_frame(table, 'traffic_congestion', hour)
+
+    feature_group = folium.FeatureGroup(name=route_name)
+
+    def popup_for(df, values, start, stop):
+        along = df['along_m']
+        count = df['count'].iloc[start:stop].sum()
+        return (f"{route_name}, {along.iat[start]:.0f} - {along.iat[stop]:.0f} m along the route, "
+                f"{describe_congestion(values[start])} ({count} readings)")
+
+    add_route_runs(feature_group, df, 'traffic_congestion', TRAFFIC, popup_for)
+
+    return feature_group
+
+def binned_stats(table, hour=None):
+    if hour is not None:
+        table = table[table['hour'] == hour]
+    # Each bin's mean is over its readings with a value, so it weighs that many
+    weights = table['traffic_congestion_count'].to_numpy()
+    means = table['traffic_congestion_mean'].to_numpy()
+    finite = weights > 0
     return {
-        "Blue Route": pd.read_csv("real_data/blue_traffic_mini.csv"),
-        "Red Route": pd.read_csv("real_data/red_traffic_mini.csv"),
-        "Green Route": pd.read_csv("real_data/green_traffic_merged.csv"),
-        "Gold Route": pd.read_csv("real_data/gold_traffic_merged.csv")
+        'count': int(table['count'].sum()),
+        'mean': np.average(means[finite], weights=weights[finite]) if finite.any() else np.nan,
+        'max': table['traffic_congestion_max'].max(),
+        'min': table['traffic_congestion_min'].min(),
+        'bins': len(table),
     }
 
-data = load_data()
+ROUTE_FILES = {
+    "Blue Route": "real_data/blue_traffic_mini.csv",
+    "Red Route": "real_data/red_traffic_mini.csv",
+    "Green Route": "real_data/green_traffic_merged.csv",
+    "Gold Route": "real_data/gold_traffic_merged.csv"
+}
+HOUR_OPTIONS = ["All Hours"] + list(range(0, 24))
+# Every (route, hour) combination fits, binned and raw, so a warmed cache never evicts
+RENDER_CACHE_SIZE = 2 * len(ROUTE_FILES) * len(HOUR_OPTIONS)
+CLICK_RADIUS_M = 50.0
+
+# With BUSMAP_HISTORY set to a history store, routes are read from it for a chosen
+# range of service dates instead of from ROUTE_FILES
+HISTORY_ROOT = os.environ.get("BUSMAP_HISTORY")
+# With BUSMAP_STATIONARY=1, runs of fixes where a bus stood still are collapsed on load
+STATIONARY = os.environ.get("BUSMAP_STATIONARY") == "1"
+
+def route_sources(start=None, end=None):
+    if HISTORY_ROOT:
+        query = ''.join(f"&{key}={value}" for key, value in (('start', start), ('end', end)) if value)
+        sources = {name: f"history:{HISTORY_ROOT}?route={name}{query}" for name in ROUTE_FILES}
+    else:
+        sources = ROUTE_FILES
+    if STATIONARY:
+        sources = {name: STATIONARY_PREFIX + source for name, source in sources.items()}
+    return sources
 
-st.title("Georgia Tech Traffic Congestion")
+def data_version(sources):
+    # (route, source, content version) per route; changes whenever any route's data (or
+    # the date range) changes, invalidating every cached render
+    return tuple((name, source, route_version(source)) for name, source in sources.items())
 
-# Sidebar for controls
-st.sidebar.header("Map Controls")
-selected_route = st.sidebar.radio("Select Route", list(data.keys()))
-selected_hour = st.sidebar.selectbox("Filter by Hour", ["All Hours"] + list(range(0, 24)))
+# Load the data; the frames are memory-mapped and never modified, so share them
+@st.cache_resource(max_entries=1)
+def load_data(version):
+    return {name: load_route(source) for name, source, _ in version}
 
-# Initialize the map
-center_lat = np.mean([df['latitude'].mean() for df in data.values()])
-center_lon = np.mean([df['longitude'].mean() for df in data.values()])
-m = folium.Map(location=[center_lat, center_lon], zoom_start=16)
+# Parse est_time once per route; reruns only slice these indexes
+@st.cache_resource(max_entries=1)
+def load_time_indexes(version):
+    return {name: RouteTimeIndex(df) for name, df in load_data(version).items()}
 
-# Add the selected route layer
-hour = int(selected_hour) if selected_hour != "All Hours" else None
-route_layer = create_route_layer(data[selected_route], selected_route, hour)
-route_layer.add_to(m)
+@st.cache_resource(max_entries=1)
+def map_center(version):
+    indexes = load_time_indexes(version)
+    center_lat = np.mean([index.df['latitude'].mean() for index in indexes.values()])
+    center_lon = np.mean([index.df['longitude'].mean() for index in indexes.values()])
+    return center_lat, center_lon
 
-# Add layer control
-folium.LayerControl(collapsed=False).add_to(m)
+@st.cache_resource(max_entries=len(ROUTE_FILES))
+def spatial_index(route_name, version):
+    return RouteSpatialIndex(load_data(version)[route_name])
 
-# Display the map
-st_folium(m, width=700, height=500)
+# 25 m bins along the route's map-matched centerline with per-hour and all-hours
+# tables, every fix binned by its distance along the centerline; None when the route
+# is too short to bin
+@st.cache_resource(max_entries=len(ROUTE_FILES))
+def route_bins(route_name, version):
+    df = load_time_indexes(version)[route_name].df
+    try:
+        bins, matched = matched_bins(df)
+    except ValueError:
+        return None
+    columns = ['traffic_congestion', 'road_condition']
+    return bins, bins.aggregate(matched, columns), bins.aggregate(matched, columns, by_hour=False)
+
+# Count, mean, min, max and percentiles of every (route, weekday, hour) cell, so the
+# stats panel never rescans rows
+@st.cache_resource(max_entries=1)
+def summary_cube(version):
+    cube = SummaryCube('traffic_congestion')
+    for name, df in load_data(version).items():
+        cube.add(name, df)
+    return cube
+
+# Built map and stats for one view; LRU-bounded and shared across sessions
+@st.cache_resource(max_entries=RENDER_CACHE_SIZE)
+def render_route(route_name, hour, version, binned=False):
+    time_index = load_time_indexes(version)[route_name]
+    m = folium.Map(location=list(map_center(version)), zoom_start=16)
+    aggregated = route_bins(route_name, version) if binned else None
+    if aggregated is not None:
+        bins, hourly, overall = aggregated
+        table = hourly if hour is not None else overall
+        create_binned_layer(bins, table, route_name, hour).add_to(m)
+        folium.LayerControl(collapsed=False).add_to(m)
+        return m, binned_stats(table, hour)
+
+    create_route_layer(time_index, route_name, hour).add_to(m)
+    folium.LayerControl(collapsed=False).add_to(m)
+    return m, summary_cube(version).summary([route_name], None if hour is None else [hour])
+
+def warm_render_cache(version):
+    for route_name in ROUTE_FILES:
+        for option in HOUR_OPTIONS:
+            render_route(route_name, None if option == "All Hours" else option, version, True)
+
+# Optionally build every view in the background once per data version
+@st.cache_resource(max_entries=1)
+def start_render_cache_warmer(version):
+    thread = threading.Thread(target=warm_render_cache, args=(version,), daemon=True)
+    thread.start()
+    return thread
+
+def show_app():
+    # Sidebar for controls
+    st.sidebar.header("Map Controls")
+    start_date = end_date = None
+    if HISTORY_ROOT:
+        dates = st.sidebar.date_input("Service dates", value=())
+        if len(dates) == 2:
+            start_date, end_date = (date.isoformat() for date in dates)
+    version = data_version(route_sources(start_date, end_date))
+    with stage('load_data'):
+        data = load_time_indexes(version)
+    if os.environ.get("BUSMAP_WARM_CACHE") == "1":
+        start_render_cache_warmer(version)
+
+    st.title("Georgia Tech Traffic Congestion")
+
+    selected_route = st.sidebar.radio("Select Route", list(data.keys()))
+    selected_hour = st.sidebar.selectbox("Filter by Hour", HOUR_OPTIONS)
+    binned = st.sidebar.checkbox("Aggregate overlapping traces (25 m bins)", value=True)
+
+    # Build (or reuse) the map for the selected route and hour
+    hour = int(selected_hour) if selected_hour != "All Hours" else None
+    with stage('render_route'):
+        m, stats = render_route(selected_route, hour, version, binned)
+
+    # Display the map
+    with stage('st_folium'):
+        map_state = st_folium(m, width=700, height=500)
+
+    # Display statistics
+    st.subheader("Route Statistics")
+    st.write(f"Number of data points: {stats['count']}")
+    if 'bins' in stats:
+        st.write(f"Route bins with data: {stats['bins']}")
+    st.write(f"Average traffic congestion: {stats['mean']:.2f}")
+    st.write(f"Max traffic congestion: {stats['max']:.2f}")
+    st.write(f"Min traffic congestion: {stats['min']:.2f}")
+    percentiles = summary_cube(version).summary([selected_route], None if hour is None else [hour])
+    st.write(f"Traffic congestion percentiles (all readings): p50 {percentiles['p50']:.2f}, "
+             f"p90 {percentiles['p90']:.2f}, p99 {percentiles['p99']:.2f}")
+
+    # Conditions around the last clicked point on the map
+    clicked = (map_state or {}).get("last_clicked")
+    if clicked:
+        st.subheader("Conditions at Selected Location")
+        with stage('condition_at'):
+            result = spatial_index(selected_route, version).condition_at(clicked["lat"], clicked["lng"], CLICK_RADIUS_M)
+        segment = result['segment']
+        if segment is not None:
+            st.write(f"Nearest segment ({result['segment_distance_m']:.0f} m away, {segment['est_time']}): "
+                     f"{describe_congestion(segment['traffic_congestion'])} ({segment['traffic_congestion']:.2f})")
+        nearby = result['nearby']
+        st.write(f"Data points within {CLICK_RADIUS_M:.0f} m (all hours): {nearby['count']}")
+        if nearby['count']:
+            congestion = nearby['traffic_congestion']
+            st.write(f"Average traffic congestion: {congestion['mean']:.2f} "
+                     f"(min {congestion['min']:.2f}, max {congestion['max']:.2f})")
+
+def main():
+    # With BUSMAP_PROFILE set, every rerun is profiled and its report written at the end.
+    # Streamlit stops a rerun by raising, so tracing must end in a finally.
+    profile_path = stage_timing.report_path()
+    if profile_path:
+        timer = stage_timing.start()
+        try:
+            show_app()
+        finally:
+            stage_timing.stop()
+        timer.write_report(profile_path)
+        with st.expander("Profile"):
+            st.dataframe(pd.DataFrame(timer.summary()))
+    else:
+        show_app()
 
-# Display statistics
-st.subheader("Route Statistics")
-filtered_data = filter_df_by_hour(data[selected_route], hour) if hour else data[selected_route]
-st.write(f"Number of data points: {len(filtered_data)}")
-st.write(f"Average traffic congestion: {filtered_data['traffic_congestion'].mean():.2f}")
-st.write(f"Max traffic congestion: {filtered_data['traffic_congestion'].max():.2f}")
-st.write(f"Min traffic congestion: {filtered_data['traffic_congestion'].min():.2f}")
\ No newline at end of file
+# streamlit run executes this file as __main__; importing it (benchmark_routes) only
+# defines the functions
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,411 @@
+import base64
+import json
+import numpy as np
+import folium
+from jinja2 import Template
+from route_classify import condition_codes
+from route_lod import simplify_runs, reindex_runs
+from route_segments import prepare_route, segment_runs
+from route_time_index import est_time_seconds
+from stage_timing import stage
+
+# Route geometry and per-run attributes are written once as base64 typed arrays and
+# turned into Leaflet polylines in the browser. Switching the active attribute (e.g. the
+# road_condition_1..5 phases) only restyles the existing polylines, and zooming swaps in
+# the simplified geometry for the current level of detail. The traffic map instead
+# ships every hour's runs in one bundle file beside the page (hour_bundle_payload,
+# HourBundleRoutes), so its hour filter is a slice of arrays already in the browser.
+
+def encode_array(values, dtype):
+    return base64.b64encode(np.ascontiguousarray(values, dtype=dtype).tobytes()).decode('ascii')
+
+# Int16 mean of a run without any finite value
+NO_MEAN = -32768
+
+def encode_means(means):
+    # Means * 100 as Int16, clipped to its range, NO_MEAN where NaN
+    scaled = np.clip(np.round(np.nan_to_num(means) * 100), NO_MEAN + 1, 32767)
+    return np.where(np.isnan(means), NO_MEAN, scaled)
+
+def route_payload(df, route_name, value_columns, lod_levels=((0, 0.0),), with_times=False):
+    # Runs are split wherever any of the value columns changes color bucket, so each run
+    # has one color per attribute. Arrays are little-endian:
+    #   codes:  Uint8 color bucket, attribute-major (codes[a * runs + k])
+    #   means:  Int16 run average * 100, attribute-major; NO_MEAN where the run has no
+    #           finite value
+    #   times:  Int32 seconds of day of each run's first and last fix (times[2 * k],
+    #           times[2 * k + 1]), -1 where missing; only with_times
+    # and for each (min zoom, tolerance) level of detail:
+    #   coords: Int32 [lat, lon] * 1e6 per kept point
+    #   bounds: Uint32 run k covers points bounds[k]..bounds[k + 1]
+    df = prepare_route(df)
+    values = np.column_stack([df[column].to_numpy(dtype=float) for column in value_columns])
+    codes = condition_codes(values).astype(np.uint8)
+    starts, stops = segment_runs(codes)
+
+    # Average of the finite segment start values in each run, per attribute. A fix that
+    # stands for several collapsed ones (route_compress) counts as that many.
+    if len(starts):
+        finite = np.isfinite(values[:-1])
+        weights = df['fixes'].to_numpy(dtype=float)[:-1, None] if 'fixes' in df else np.ones((len(df) - 1, 1))
+        sums = np.add.reduceat(np.where(finite, values[:-1] * weights, 0.0), starts, axis=0)
+        counts = np.add.reduceat(finite * weights, starts, axis=0)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            means = np.where(counts > 0, sums / np.maximum(counts, 1), np.nan)
+    else:
+        means = np.zeros((0, len(value_columns)))
+
+    lat = df['latitude'].to_numpy(dtype=float)
+    lon = df['longitude'].to_numpy(dtype=float)
+    levels = []
+    for min_zoom, tolerance in lod_levels:
+        with stage('lod_level') as timed:
+            keep = simplify_runs(lat, lon, starts, stops, tolerance)
+            level_starts, level_stops = reindex_runs(keep, starts, stops)
+            coords = np.round(np.column_stack((lat[keep], lon[keep])) * 1e6)
+            levels.append({
+                'min_zoom': min_zoom,
+                'coords': encode_array(coords.ravel(), '<i4'),
+                'bounds': encode_array(np.concatenate((level_starts, level_stops[-1:])), '<u4'),
+            })
+            timed.rows = int(keep.sum())
+            timed.output_bytes = len(levels[-1]['coords']) + len(levels[-1]['bounds'])
+
+    payload = {
+        'name': route_name,
+        'runs': len(starts),
+        'codes': encode_array(codes[starts].T.ravel(), 'u1'),
+        'means': encode_array(encode_means(means.T.ravel()), '<i2'),
+        'levels': levels,
+    }
+    if with_times:
+        if 'est_seconds' in df:
+            seconds = df['est_seconds'].to_numpy(dtype=np.int32)
+        else:
+            seconds = est_time_seconds(df['est_time'])
+        payload['times'] = encode_array(np.column_stack((seconds[starts], seconds[stops])).ravel(), '<i4')
+    return payload
+
+class ClientRoutes(folium.MacroElement):
+    # Draws each route payload into its (empty) folium FeatureGroup at the level of
+    # detail for the current zoom and exposes window.busRoutes.setAttribute(i) to
+    # restyle them. With attribute_labels, a
+    # bottom-right control cycles through the attributes. With descriptions (one text
+    # per color bucket), popups read "route, start - stop, description" like the
+    # PolyLine popups of the run maps instead of showing the run average.
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var palette = {{ this.palette|tojson }};
+            var labels = {{ this.attribute_labels|tojson }};
+            var popupLabel = {{ this.popup_label|tojson }};
+            var descriptions = {{ this.descriptions|tojson }};
+            var noMean = {{ this.no_mean }};
+            var routes = {{ this.payloads|tojson }};
+            var groups = [{% for layer in this.layers %}{{ layer.get_name() }}{{ ", " if not loop.last }}{% endfor %}];
+            var current = 0;
+
+            function decode(b64, Type) {
+                var bin = atob(b64);
+                var bytes = new Uint8Array(bin.length);
+                for (var i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+                return new Type(bytes.buffer);
+            }
+
+            function formatTime(seconds) {
+                if (seconds < 0) return 'nan';
+                return [Math.floor(seconds / 3600), Math.floor(seconds / 60) % 60, seconds % 60].map(function(part) {
+                    return (part < 10 ? '0' : '') + part;
+                }).join(':');
+            }
+
+            function popupText(route, k) {
+                if (descriptions) {
+                    var text = route.name;
+                    if (route.times) {
+                        text += ', ' + formatTime(route.times[2 * k]) + ' - ' + formatTime(route.times[2 * k + 1]);
+                    }
+                    return text + ', ' + descriptions[route.codes[current * route.runs + k]];
+                }
+                var mean = route.means[current * route.runs + k];
+                return route.name + ' - ' + popupLabel + ': ' + (mean === noMean ? 'nan' : (mean / 100).toFixed(2));
+            }
+
+            function levelFor(route, zoom) {
+                var index = 0;
+                route.levels.forEach(function(level, i) {
+                    if (zoom >= level.min_zoom) index = i;
+                });
+                return index;
+            }
+
+            // Polylines of a level are only created the first time it is shown
+            function buildLevel(route, level) {
+                var coords = decode(level.coords, Int32Array);
+                var bounds = decode(level.bounds, Uint32Array);
+                level.lines = [];
+                for (var k = 0; k < route.runs; k++) {
+                    var latlngs = [];
+                    for (var p = bounds[k]; p <= bounds[k + 1]; p++) {
+                        latlngs.push([coords[2 * p] / 1e6, coords[2 * p + 1] / 1e6]);
+                    }
+                    var line = L.polyline(latlngs, {color: palette[route.codes[k]], weight: 7, opacity: 0.7});
+                    // Popup text is only built when the run is clicked
+                    line.bindPopup((function(k) {
+                        return function() { return popupText(route, k); };
+                    })(k));
+                    level.lines.push(line);
+                }
+            }
+
+            function restyle(route, lines) {
+                var offset = current * route.runs;
+                lines.forEach(function(line, k) {
+                    line.setStyle({color: palette[route.codes[offset + k]]});
+                });
+            }
+
+            function showLevels() {
+                var zoom = map.getZoom();
+                routes.forEach(function(route, r) {
+                    var index = levelFor(route, zoom);
+                    if (index === route.shown) return;
+                    var group = groups[r];
+                    if (route.shown !== undefined) {
+                        route.levels[route.shown].lines.forEach(function(line) { group.removeLayer(line); });
+                    }
+                    var level = route.levels[index];
+                    if (!level.lines) buildLevel(route, level);
+                    restyle(route, level.lines);
+                    level.lines.forEach(function(line) { line.addTo(group); });
+                    route.shown = index;
+                });
+            }
+
+            routes.forEach(function(route) {
+                route.codes = decode(route.codes, Uint8Array);
+                route.means = decode(route.means, Int16Array);
+                if (route.times) route.times = decode(route.times, Int32Array);
+            });
+            showLevels();
+            map.on('zoomend', showLevels);
+
+            function setAttribute(index) {
+                current = index;
+                routes.forEach(function(route) {
+                    restyle(route, route.levels[route.shown].lines);
+                });
+                var label = document.getElementById('currentPhase');
+                if (label) label.textContent = labels[index];
+            }
+
+            if (labels.length > 1) {
+                var control = L.control({position: 'bottomright'});
+                control.onAdd = function() {
+                    var div = L.DomUtil.create('div', 'phase-control');
+                    div.innerHTML = '<button id="prevPhase">&#9664;</button> <span id="currentPhase">' + labels[0] +
+                        '</span> <button id="nextPhase">&#9654;</button>';
+                    L.DomEvent.disableClickPropagation(div);
+                    div.querySelector('#prevPhase').addEventListener('click', function() {
+                        setAttribute((current + labels.length - 1) % labels.length);
+                    });
+                    div.querySelector('#nextPhase').addEventListener('click', function() {
+                        setAttribute((current + 1) % labels.length);
+                    });
+                    return div;
+                };
+                control.addTo(map);
+            }
+
+            window.busRoutes = {setAttribute: setAttribute};
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, payloads, layers, palette, attribute_labels=(), popup_label='Value', descriptions=None):
+        super().__init__()
+        self._name = 'ClientRoutes'
+        self.payloads = payloads
+        self.layers = list(layers)
+        self.palette = list(palette)
+        self.attribute_labels = list(attribute_labels)
+        self.popup_label = popup_label
+        self.descriptions = list(descriptions) if descriptions is not None else None
+        self.no_mean = NO_MEAN
+
+# Views of an hour bundle: 0..23 are the hours of the day, ALL_HOURS the whole route
+ALL_HOURS = 24
+
+def hour_bundle_payload(df, route_name, value_column, tolerance=0.0):
+    # Every hour's runs of one route, in one pass over the route sorted by hour (time
+    # within the hour), followed by the whole day's runs. Each view is cut into runs on
+    # its own, exactly as a map of that hour alone would be. Arrays are little-endian:
+    #   views:  Uint32 runs of view v are views[v]..views[v + 1] - 1
+    #   codes:  Uint8 color bucket per run
+    #   times:  Int32 seconds of day of each run's first and last fix, -1 where missing
+    #   first, last: Uint32 each run's first and last point
+    #   coords: Int32 [lat, lon] * 1e6 per kept point, simplified to tolerance
+    df = prepare_route(df)
+    with stage('hour_bundle', rows=len(df)) as timed:
+        if 'est_seconds' in df:
+            seconds = df['est_seconds'].to_numpy(dtype=np.int32)
+        else:
+            seconds = est_time_seconds(df['est_time'])
+        lat = df['latitude'].to_numpy(dtype=float)
+        lon = df['longitude'].to_numpy(dtype=float)
+        codes = condition_codes(df[value_column].to_numpy(dtype=float)).astype(np.uint8)
+        hours = np.where(seconds >= 0, seconds // 3600, -1)
+        by_hour = np.argsort(hours, kind='stable')
+        offsets = np.searchsorted(hours[by_hour], np.arange(ALL_HOURS + 1))
+        views = [by_hour[offsets[hour]:offsets[hour + 1]] for hour in range(ALL_HOURS)]
+        views.append(np.arange(len(df)))
+
+        run_counts, run_codes, run_times, firsts, lasts, coords = [], [], [], [], [], []
+        points = 0
+        for rows in views:
+            starts, stops = segment_runs(codes[rows])
+            run_counts.append(len(starts))
+            if not len(starts):
+                continue
+            keep = simplify_runs(lat[rows], lon[rows], starts, stops, tolerance)
+            kept_starts, kept_stops = reindex_runs(keep, starts, stops)
+            run_codes.append(codes[rows[starts]])
+            run_times.append(np.column_stack((seconds[rows[starts]], seconds[rows[stops]])).ravel())
+            firsts.append(kept_starts + points)
+            lasts.append(kept_stops + points)
+            kept = rows[keep]
+            coords.append(np.round(np.column_stack((lat[kept], lon[kept])) * 1e6).ravel())
+            points += len(kept)
+
+        def joined(parts):
+            return np.concatenate(parts) if parts else np.zeros(0)
+
+        payload = {
+            'name': route_name,
+            'views': encode_array(np.concatenate(([0], np.cumsum(run_counts))), '<u4'),
+            'codes': encode_array(joined(run_codes), 'u1'),
+            'times': encode_array(joined(run_times), '<i4'),
+            'first': encode_array(joined(firsts), '<u4'),
+            'last': encode_array(joined(lasts), '<u4'),
+            'coords': encode_array(joined(coords), '<i4'),
+        }
+        timed.output_bytes = sum(len(value) for value in payload.values())
+    return payload
+
+def bundle_script(payloads):
+    # The bundle file HourBundleRoutes reads: a plain script, so a page opened from disk
+    # can load it with a <script src> where fetching a data file would be refused
+    return 'window.busBundle = ' + json.dumps(payloads, separators=(',', ':')) + ';\n'
+
+class HourBundleRoutes(folium.MacroElement):
+    # Draws the hour_bundle_payload routes of window.busBundle (loaded from the bundle
+    # file before this script runs) into their (empty) folium FeatureGroups, with a
+    # top-right hour selector. Switching hours slices the bundle's arrays by the view's
+    # run offsets; each view's polylines are built the first time it is shown and
+    # popups read "route, start - stop, description" as on the run maps.
+    _template = Template(u"""
+        {% macro script(this, kwargs) %}
+        (function() {
+            var map = {{ this._parent.get_name() }};
+            var palette = {{ this.palette|tojson }};
+            var descriptions = {{ this.descriptions|tojson }};
+            var allHours = {{ this.all_hours }};
+            var routes = window.busBundle;
+            var groups = [{% for layer in this.layers %}{{ layer.get_name() }}{{ ", " if not loop.last }}{% endfor %}];
+
+            function decode(b64, Type) {
+                var bin = atob(b64);
+                var bytes = new Uint8Array(bin.length);
+                for (var i = 0; i < bin.length; i++) bytes[i] = bin.charCodeAt(i);
+                return new Type(bytes.buffer);
+            }
+
+            function formatTime(seconds) {
+                if (seconds < 0) return 'nan';
+                return [Math.floor(seconds / 3600), Math.floor(seconds / 60) % 60, seconds % 60].map(function(part) {
+                    return (part < 10 ? '0' : '') + part;
+                }).join(':');
+            }
+
+            function hourLabel(hour) {
+                return (hour % 12 === 0 ? 12 : hour % 12) + (hour < 12 ? ' AM' : ' PM');
+            }
+
+            function buildView(route, view) {
+                var lines = [];
+                for (var k = route.views[view]; k < route.views[view + 1]; k++) {
+                    var latlngs = [];
+                    for (var p = route.first[k]; p <= route.last[k]; p++) {
+                        latlngs.push([route.coords[2 * p] / 1e6, route.coords[2 * p + 1] / 1e6]);
+                    }
+                    var line = L.polyline(latlngs, {color: palette[route.codes[k]], weight: 7, opacity: 0.7});
+                    // Popup text is only built when the run is clicked
+                    line.bindPopup((function(k) {
+                        return function() {
+                            return route.name + ', ' + formatTime(route.times[2 * k]) + ' - ' +
+                                formatTime(route.times[2 * k + 1]) + ', ' + descriptions[route.codes[k]];
+                        };
+                    })(k));
+                    lines.push(line);
+                }
+                return lines;
+            }
+
+            function showView(view) {
+                routes.forEach(function(route, r) {
+                    var group = groups[r];
+                    if (route.shown !== undefined) {
+                        route.lines[route.shown].forEach(function(line) { group.removeLayer(line); });
+                    }
+                    if (!route.lines[view]) route.lines[view] = buildView(route, view);
+                    route.lines[view].forEach(function(line) { line.addTo(group); });
+                    route.shown = view;
+                });
+            }
+
+            routes.forEach(function(route) {
+                route.views = decode(route.views, Uint32Array);
+                route.codes = decode(route.codes, Uint8Array);
+                route.times = decode(route.times, Int32Array);
+                route.first = decode(route.first, Uint32Array);
+                route.last = decode(route.last, Uint32Array);
+                route.coords = decode(route.coords, Int32Array);
+                route.lines = {};
+            });
+            showView(allHours);
+
+            // Only hours some route has runs in are offered
+            var options = '<option value="' + allHours + '">All Hours</option>';
+            for (var hour = 0; hour < allHours; hour++) {
+                if (routes.some(function(route) { return route.views[hour + 1] > route.views[hour]; })) {
+                    options += '<option value="' + hour + '">' + hourLabel(hour) + '</option>';
+                }
+            }
+            var control = L.control({position: 'topright'});
+            control.onAdd = function() {
+                var div = L.DomUtil.create('div', 'hour-filter');
+                div.style.cssText = 'background: white; padding: 10px; border-radius: 5px; ' +
+                    'box-shadow: 0 0 15px rgba(0,0,0,0.2);';
+                div.innerHTML = '<label for="hour-select">Filter by Hour: </label><select id="hour-select">' +
+                    options + '</select>';
+                L.DomEvent.disableClickPropagation(div);
+                div.querySelector('#hour-select').addEventListener('change', function() {
+                    showView(parseInt(this.value, 10));
+                });
+                return div;
+            };
+            control.addTo(map);
+
+            window.busRoutes = {showHour: function(hour) { showView(hour === null ? allHours : hour); }};
+        })();
+        {% endmacro %}
+        """)
+
+    def __init__(self, layers, palette, descriptions):
+        super().__init__()
+        self._name = 'HourBundleRoutes'
+        self.layers = list(layers)
+        self.palette = list(palette)
+        self.descriptions = list(descriptions)
+        self.all_hours = ALL_HOURS
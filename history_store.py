@@ -0,0 +1,341 @@
+import argparse
+import hashlib
+import os
+import shutil
+import threading
+import time
+import uuid
+from urllib.parse import parse_qs
+import numpy as np
+import pandas as pd
+from route_loader import HISTORY_PREFIX, downcast_column, est_time_from_seconds, read_manifest, write_manifest
+from route_time_index import SECONDS_PER_HOUR, est_time_seconds
+from stage_timing import stage
+
+# Multi-day route history on disk, one directory per route and service date:
+#   <root>/<route>/<YYYY-MM-DD>/part-<id>/  000.npy, 001.npy, ..., manifest.json
+# Each part is written once, in the route cache's column layout, sorted by est_time, and
+# its manifest records where every hour starts, so queries skip whole dates and read
+# only the hours they need from memory-mapped columns. A part is visible once its
+# directory is renamed into place; compaction writes a merged part that names the parts
+# it replaces, so readers never see a day twice, and deletes them REPLACED_GRACE_S
+# later, so a reader that listed them just before can still read them. Only one process
+# at a time compacts a day, holding a lock file in its directory. Rows without a Unix
+# time go under the date UNKNOWN_DATE.
+#
+#   python history_store.py append history "Blue Route" real_data/blue_traffic_mini.csv
+#   python history_store.py compact history
+#   python history_store.py list history
+#
+# Map scripts and the app read a store through a route source string in place of a
+# CSV path: history:<root>?route=Blue Route&start=2023-09-04&end=2023-09-10
+STORE_VERSION = 1
+TIMEZONE = 'America/New_York'
+# Parts with fewer rows than this are merged with the other small parts of their day
+COMPACT_ROWS = 200_000
+# Replaced parts and unfinished writes are kept this long before compaction deletes them
+REPLACED_GRACE_S = 3600.0
+# Rows without a Unix time are stored under this date; only open-ended queries see them
+UNKNOWN_DATE = 'unknown'
+# A day's compaction lock older than this is left over from a crashed process
+STALE_LOCK_S = 3600.0
+COMPACT_LOCK = '.compact.lock'
+
+def route_dir_name(route):
+    return route.lower().replace(' ', '_')
+
+def service_dates(unix_seconds):
+    # Local calendar date of each Unix time, as 'YYYY-MM-DD'; UNKNOWN_DATE where missing
+    times = pd.to_datetime(pd.Series(unix_seconds), unit='s', utc=True).dt.tz_convert(TIMEZONE)
+    return times.dt.strftime('%Y-%m-%d').fillna(UNKNOWN_DATE).to_numpy(dtype=object)
+
+def hour_ranges(hour_offsets, hours):
+    # Row ranges of the given hours, with adjacent hours merged into one slice
+    ranges = []
+    for hour in sorted(set(hours)):
+        start, stop = hour_offsets[hour], hour_offsets[hour + 1]
+        if start == stop:
+            continue
+        if ranges and ranges[-1][1] == start:
+            ranges[-1][1] = stop
+        else:
+            ranges.append([start, stop])
+    return ranges
+
+def write_part(date_dir, df, route, date, replaces=()):
+    # Writes df as a new immutable part and returns its directory
+    if 'est_seconds' in df:
+        seconds = df['est_seconds'].to_numpy(dtype=np.int32)
+    else:
+        seconds = est_time_seconds(df['est_time'])
+    sort_keys = (df['time'].to_numpy(), seconds) if 'time' in df else (seconds,)
+    order = np.lexsort(sort_keys)
+    df = df.iloc[order]
+    seconds = seconds[order]
+
+    name = f"part-{uuid.uuid4().hex[:12]}"
+    tmp_dir = os.path.join(date_dir, '.tmp-' + name)
+    os.makedirs(tmp_dir)
+    columns = []
+    for i, column in enumerate(column for column in df.columns if column != 'est_seconds'):
+        if column == 'est_time':
+            values, kind = seconds, 'est_seconds'
+        else:
+            values, kind = downcast_column(column, df[column]), 'values'
+        file_name = f"{i:03d}.npy"
+        np.save(os.path.join(tmp_dir, file_name), values)
+        columns.append({'name': column, 'file': file_name, 'kind': kind, 'dtype': values.dtype.str})
+
+    write_manifest(tmp_dir, {
+        'version': STORE_VERSION,
+        'route': route,
+        'date': date,
+        'rows': len(df),
+        'columns': columns,
+        # hour_offsets[h]:hour_offsets[h + 1] are the rows in hour h; unparsed times sort first
+        'hour_offsets': np.searchsorted(seconds, np.arange(25) * SECONDS_PER_HOUR, side='left').tolist(),
+        'replaces': list(replaces),
+    })
+    part_dir = os.path.join(date_dir, name)
+    os.replace(tmp_dir, part_dir)
+    return part_dir
+
+def read_part(part_dir, manifest, hours=None, columns=None):
+    # The part's rows (only the given hours, if any) as a DataFrame; unselected rows of
+    # the memory-mapped columns are never read
+    mmap_mode = 'r' if manifest['rows'] else None
+    ranges = [[0, manifest['rows']]] if hours is None else hour_ranges(manifest['hour_offsets'], hours)
+    frame = {}
+    for column in manifest['columns']:
+        if columns is not None and column['name'] not in columns:
+            continue
+        values = np.load(os.path.join(part_dir, column['file']), mmap_mode=mmap_mode)
+        if len(ranges) != 1 or ranges[0] != [0, manifest['rows']]:
+            values = np.concatenate([values[start:stop] for start, stop in ranges] or [values[:0]])
+        if column['kind'] == 'est_seconds':
+            frame['est_time'] = est_time_from_seconds(values)
+            frame['est_seconds'] = values
+        else:
+            frame[column['name']] = values
+    return pd.DataFrame(frame, copy=False)
+
+def acquire_lock(lock_path, stale_s=STALE_LOCK_S):
+    # Creates lock_path unless another process holds it; a lock older than stale_s is
+    # taken over. Returns whether the caller now holds it.
+    for _ in range(2):
+        try:
+            os.close(os.open(lock_path, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.path.getmtime(lock_path) < stale_s:
+                    return False
+                os.remove(lock_path)
+            except FileNotFoundError:
+                pass
+    return False
+
+class HistoryStore:
+
+    def __init__(self, root):
+        self.root = root
+        # Appends and compactions of this process take turns; parts are only ever
+        # added or replaced, and replaced ones outlive any reasonable read (see
+        # remove_replaced), so readers need no lock
+        self.lock = threading.Lock()
+
+    def route_dir(self, route):
+        return os.path.join(self.root, route_dir_name(route))
+
+    def routes(self):
+        # Route names as stored in their parts' manifests
+        names = []
+        if not os.path.isdir(self.root):
+            return names
+        for entry in sorted(os.listdir(self.root)):
+            for date in self.dates_of_dir(os.path.join(self.root, entry)):
+                parts = self.parts_of_dir(os.path.join(self.root, entry, date))
+                if parts:
+                    names.append(parts[0][1]['route'])
+                    break
+        return names
+
+    def dates_of_dir(self, route_dir):
+        if not os.path.isdir(route_dir):
+            return []
+        return sorted(entry for entry in os.listdir(route_dir) if not entry.startswith('.'))
+
+    def dates(self, route, start=None, end=None):
+        # Service dates with data, optionally limited to start <= date <= end; rows of
+        # UNKNOWN_DATE belong to no range, so only an unlimited query includes them
+        return [date for date in self.dates_of_dir(self.route_dir(route))
+                if (start is None or date >= start) and (end is None or date <= end)
+                and (date != UNKNOWN_DATE or start is None and end is None)]
+
+    def parts_of_dir(self, date_dir):
+        # (part dir, manifest) of the live parts of one day
+        parts = {}
+        for entry in sorted(os.listdir(date_dir)):
+            if entry.startswith('part-'):
+                manifest = read_manifest(os.path.join(date_dir, entry))
+                if manifest is not None and manifest.get('version') == STORE_VERSION:
+                    parts[entry] = manifest
+        replaced = {name for manifest in parts.values() for name in manifest['replaces']}
+        return [(os.path.join(date_dir, name), manifest) for name, manifest in parts.items() if name not in replaced]
+
+    def partitions(self, route, start=None, end=None, hours=None):
+        # (part dir, manifest) of every part of the route in the date range that has
+        # rows in any of the hours
+        for date in self.dates(route, start, end):
+            for part_dir, manifest in self.parts_of_dir(os.path.join(self.route_dir(route), date)):
+                if hours is not None and not hour_ranges(manifest['hour_offsets'], hours):
+                    continue
+                yield part_dir, manifest
+
+    def iter_query(self, route, start=None, end=None, hours=None, columns=None):
+        # One DataFrame per matching part, for consumers that work a day at a time
+        for part_dir, manifest in self.partitions(route, start, end, hours):
+            yield read_part(part_dir, manifest, hours, columns)
+
+    def query(self, route, start=None, end=None, hours=None, columns=None):
+        with stage('history_query') as timed:
+            frames = list(self.iter_query(route, start, end, hours, columns))
+            df = pd.concat(frames, ignore_index=True) if frames else pd.DataFrame(columns=columns or [])
+            timed.rows = len(df)
+        return df
+
+    def version(self, route, start=None, end=None):
+        # Changes whenever a part in the range is added or replaced; parts are immutable,
+        # so their names identify their content
+        names = [os.path.basename(part_dir) for part_dir, _ in self.partitions(route, start, end)]
+        return hashlib.sha256('\n'.join(names).encode()).hexdigest()
+
+    def append(self, route, df, date=None):
+        # Adds df as new parts, one per service date (all under `date`, if given);
+        # returns the part directories written
+        if date is None:
+            if 'time' not in df:
+                raise ValueError("rows need a 'time' column (Unix seconds) or an explicit date")
+            dates = service_dates(df['time'].to_numpy(dtype=float))
+        else:
+            dates = np.full(len(df), date, dtype=object)
+        written = []
+        with self.lock, stage('history_append', rows=len(df)):
+            for day in np.unique(dates):
+                date_dir = os.path.join(self.route_dir(route), day)
+                os.makedirs(date_dir, exist_ok=True)
+                written.append(write_part(date_dir, df[dates == day], route, day))
+        return written
+
+    def compact(self, route=None, min_rows=COMPACT_ROWS, grace_s=REPLACED_GRACE_S):
+        # Merges each day's small parts into one, and deletes the parts replaced more
+        # than grace_s ago; returns how many parts were merged
+        merged = 0
+        routes = [route] if route is not None else self.routes()
+        with self.lock:
+            for name in routes:
+                for date in self.dates(name):
+                    date_dir = os.path.join(self.route_dir(name), date)
+                    # Another process compacting the same day would merge the same parts
+                    # twice; whoever holds the day's lock file does it, the other skips
+                    if not acquire_lock(os.path.join(date_dir, COMPACT_LOCK)):
+                        continue
+                    try:
+                        merged += self.compact_day(name, date, date_dir, min_rows)
+                        self.remove_replaced(date_dir, grace_s)
+                    finally:
+                        os.remove(os.path.join(date_dir, COMPACT_LOCK))
+        return merged
+
+    def compact_day(self, route, date, date_dir, min_rows):
+        small = [(part_dir, manifest) for part_dir, manifest in self.parts_of_dir(date_dir)
+                 if manifest['rows'] < min_rows]
+        if len(small) < 2:
+            return 0
+        with stage('history_compact', rows=sum(manifest['rows'] for _, manifest in small)):
+            df = pd.concat([read_part(part_dir, manifest) for part_dir, manifest in small], ignore_index=True)
+            write_part(date_dir, df, route, date, [os.path.basename(part_dir) for part_dir, _ in small])
+        return len(small)
+
+    def remove_replaced(self, date_dir, grace_s=REPLACED_GRACE_S):
+        # Deletes parts replaced more than grace_s ago, unfinished writes as old, and
+        # parts of other store versions. A replaced part is only deleted once the parts
+        # it replaced itself are gone, so none of those resurfaces if a deletion fails.
+        # A part still memory-mapped by a reader may refuse (on Windows); a later
+        # compaction retries.
+        now = time.time()
+        manifests = {entry: read_manifest(os.path.join(date_dir, entry))
+                     for entry in os.listdir(date_dir) if entry.startswith('part-')}
+        replaced_at = {}
+        for entry, manifest in manifests.items():
+            if manifest is None or manifest.get('version') != STORE_VERSION:
+                continue
+            written = os.path.getmtime(os.path.join(date_dir, entry, 'manifest.json'))
+            for name in manifest['replaces']:
+                replaced_at[name] = min(replaced_at.get(name, written), written)
+        expired = {entry for entry, manifest in manifests.items()
+                   if manifest is None or manifest.get('version') != STORE_VERSION
+                   or (entry in replaced_at and now - replaced_at[entry] >= grace_s)}
+        while expired:
+            ready = [entry for entry in sorted(expired) if manifests[entry] is None
+                     or not any(name in manifests for name in manifests[entry].get('replaces', ()))]
+            for entry in ready:
+                shutil.rmtree(os.path.join(date_dir, entry), ignore_errors=True)
+                if not os.path.exists(os.path.join(date_dir, entry)):
+                    del manifests[entry]
+            if not any(entry not in manifests for entry in ready):
+                break
+            expired.difference_update(ready)
+        for entry in os.listdir(date_dir):
+            path = os.path.join(date_dir, entry)
+            if entry.startswith('.tmp-') and now - os.path.getmtime(path) >= grace_s:
+                shutil.rmtree(path, ignore_errors=True)
+
+def parse_source(source):
+    # 'history:<root>?route=...&start=...&end=...' -> (store, route, start, end)
+    root, _, query = source[len(HISTORY_PREFIX):].partition('?')
+    params = {key: values[-1] for key, values in parse_qs(query).items()}
+    if 'route' not in params:
+        raise ValueError(f"history source without a route: {source}")
+    return HistoryStore(root), params['route'], params.get('start'), params.get('end')
+
+def load_source(source, hours=None, columns=None):
+    store, route, start, end = parse_source(source)
+    return store.query(route, start, end, hours, columns)
+
+def source_version(source):
+    store, route, start, end = parse_source(source)
+    return store.version(route, start, end)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    commands = parser.add_subparsers(dest='command', required=True)
+    append = commands.add_parser('append', help="add a route CSV to the store, split by service date")
+    append.add_argument('root')
+    append.add_argument('route', help='route name, e.g. "Blue Route"')
+    append.add_argument('csv_path')
+    append.add_argument('--date', help="store every row under this YYYY-MM-DD instead of its own date")
+    compact = commands.add_parser('compact', help="merge each day's small parts")
+    compact.add_argument('root')
+    compact.add_argument('--route')
+    compact.add_argument('--min-rows', type=int, default=COMPACT_ROWS)
+    compact.add_argument('--grace-s', type=float, default=REPLACED_GRACE_S,
+                         help="keep replaced parts this long for readers that listed them")
+    listing = commands.add_parser('list', help="routes, dates, parts and rows in the store")
+    listing.add_argument('root')
+    args = parser.parse_args(argv)
+
+    store = HistoryStore(args.root)
+    if args.command == 'append':
+        parts = store.append(args.route, pd.read_csv(args.csv_path), args.date)
+        print(f"Wrote {len(parts)} parts for {args.route}")
+    elif args.command == 'compact':
+        print(f"Merged {store.compact(args.route, args.min_rows, args.grace_s)} parts")
+    else:
+        for route in store.routes():
+            for date in store.dates(route):
+                parts = list(store.partitions(route, date, date))
+                print(f"{route}\t{date}\t{len(parts)} parts\t{sum(manifest['rows'] for _, manifest in parts)} rows")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import argparse
+import numpy as np
+import pandas as pd
+from route_geo import haversine_m
+
+# Raw logs have one row per IMU sample; latitude/longitude are only set on rows that
+# carry a GPS fix. time is Unix seconds, acceleration is in m/s^2.
+RAW_COLUMNS = ['time', 'accel_x', 'accel_y', 'accel_z', 'latitude', 'longitude']
+OUTPUT_COLUMNS = ['latitude', 'longitude', 'time', 'est_time', 'road_condition', 'traffic_congestion']
+
+BLOCK_ROWS = 500_000
+VIBRATION_WINDOW = 100  # IMU samples per vibration window
+FIX_WINDOW = 30  # GPS fixes per stop/go window
+STOP_SPEED = 0.5  # m/s; slower than this counts as stopped
+FREE_FLOW_SPEED = 11.0  # m/s; campus free-flow speed (~25 mph)
+
+# Piecewise-linear road score from the RMS of vertical vibration: smooth pavement
+# scores 5 (excellent), rough pavement 1 (poor). 0 means no score was available.
+VIBRATION_RMS = [0.3, 0.8, 1.5, 2.5]
+VIBRATION_SCORE = [5.0, 4.0, 2.5, 1.0]
+
+def rolling_mean(values, window):
+    # Trailing mean over `window` samples, skipping NaNs; NaN until the window is full
+    # or when it holds no valid samples
+    values = np.asarray(values, dtype=float)
+    out = np.full(len(values), np.nan)
+    if len(values) >= window:
+        valid = ~np.isnan(values)
+        csum = np.cumsum(np.concatenate(([0.0], np.where(valid, values, 0.0))))
+        ccount = np.cumsum(np.concatenate(([0], valid)))
+        sums = csum[window:] - csum[:-window]
+        counts = ccount[window:] - ccount[:-window]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            out[window - 1:] = np.where(counts > 0, sums / counts, np.nan)
+    return out
+
+def vibration_rms(magnitude, window=VIBRATION_WINDOW):
+    # Remove gravity and slow tilt with a trailing mean, then take the RMS of the rest
+    residual = magnitude - rolling_mean(magnitude, window)
+    return np.sqrt(rolling_mean(residual ** 2, window))
+
+def score_road_condition(rms):
+    score = np.interp(rms, VIBRATION_RMS, VIBRATION_SCORE)
+    return np.where(np.isnan(rms), 0.0, score)
+
+def score_traffic_congestion(stopped_fraction, mean_speed):
+    # 1 (free flow) to 5 (heavy): mostly time spent stopped, partly how slow the rest is
+    slowness = 1 - np.clip(mean_speed / FREE_FLOW_SPEED, 0, 1)
+    score = 1 + 4 * np.clip(0.6 * stopped_fraction + 0.4 * slowness, 0, 1)
+    return np.where(np.isnan(stopped_fraction) | np.isnan(mean_speed), 0.0, score)
+
+def est_time_strings(unix_seconds):
+    times = pd.to_datetime(pd.Series(unix_seconds), unit='s', utc=True)
+    return times.dt.tz_convert('America/New_York').dt.strftime('%H:%M:%S').to_numpy()
+
+def read_blocks(path, block_rows=BLOCK_ROWS):
+    yield from pd.read_csv(path, usecols=RAW_COLUMNS, chunksize=block_rows)
+
+def score_blocks(blocks):
+    # Yields one scored DataFrame per raw block. Only the last few IMU samples and GPS
+    # fixes are carried between blocks, so windows span block boundaries while memory
+    # stays proportional to the block size.
+    imu_tail = np.zeros(0)
+    fix_tail = {'time': np.zeros(0), 'latitude': np.zeros(0), 'longitude': np.zeros(0), 'speed': np.zeros(0)}
+    # The vibration RMS needs two stacked windows of history
+    imu_keep = 2 * (VIBRATION_WINDOW - 1)
+
+    for block in blocks:
+        accel = block[['accel_x', 'accel_y', 'accel_z']].to_numpy(dtype=float)
+        magnitude = np.sqrt((accel ** 2).sum(axis=1))
+        imu = np.concatenate((imu_tail, magnitude))
+        rms = vibration_rms(imu)[len(imu_tail):]
+        imu_tail = imu[-imu_keep:] if imu_keep else imu[:0]
+
+        fixes = block[['latitude', 'longitude']].notna().all(axis=1).to_numpy()
+        new_time = block['time'].to_numpy(dtype=float)[fixes]
+        new_lat = block['latitude'].to_numpy(dtype=float)[fixes]
+        new_lon = block['longitude'].to_numpy(dtype=float)[fixes]
+        if not len(new_time):
+            continue
+
+        time = np.concatenate((fix_tail['time'], new_time))
+        lat = np.concatenate((fix_tail['latitude'], new_lat))
+        lon = np.concatenate((fix_tail['longitude'], new_lon))
+        # Speed of each new fix from the fix before it (possibly from the previous block)
+        speed = np.full(len(time), np.nan)
+        speed[:len(fix_tail['speed'])] = fix_tail['speed']
+        start = max(len(fix_tail['time']), 1)
+        dt = time[start:] - time[start - 1:-1]
+        distance = haversine_m(lat[start - 1:-1], lon[start - 1:-1], lat[start:], lon[start:])
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed[start:] = np.where(dt > 0, distance / dt, np.nan)
+
+        stopped = np.where(np.isnan(speed), np.nan, (speed < STOP_SPEED).astype(float))
+        new = slice(len(fix_tail['time']), None)
+        stopped_fraction = rolling_mean(stopped, FIX_WINDOW)[new]
+        mean_speed = rolling_mean(speed, FIX_WINDOW)[new]
+
+        keep = slice(-(FIX_WINDOW - 1), None) if FIX_WINDOW > 1 else slice(0, 0)
+        fix_tail = {'time': time[keep], 'latitude': lat[keep], 'longitude': lon[keep], 'speed': speed[keep]}
+
+        yield pd.DataFrame({
+            'latitude': new_lat,
+            'longitude': new_lon,
+            'time': new_time,
+            'est_time': est_time_strings(new_time),
+            'road_condition': score_road_condition(rms[fixes]),
+            'traffic_congestion': score_traffic_congestion(stopped_fraction, mean_speed),
+        }, columns=OUTPUT_COLUMNS)
+
+def ingest(raw_path, output_path, block_rows=BLOCK_ROWS):
+    # Raw IMU/GPS log -> route condition CSV in the layout the map scripts read
+    rows = 0
+    with open(output_path, 'w', newline='') as file:
+        for i, scored in enumerate(score_blocks(read_blocks(raw_path, block_rows))):
+            scored.to_csv(file, header=(i == 0), index=False)
+            rows += len(scored)
+        if rows == 0:
+            pd.DataFrame(columns=OUTPUT_COLUMNS).to_csv(file, index=False)
+    return rows
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('raw_path', help="raw sensor log (CSV with " + ", ".join(RAW_COLUMNS) + ")")
+    parser.add_argument('output_path', help="route CSV to write, e.g. real_data/blue_traffic.csv")
+    parser.add_argument('--block-rows', type=int, default=BLOCK_ROWS, help="raw rows read per block")
+    args = parser.parse_args(argv)
+    rows = ingest(args.raw_path, args.output_path, args.block_rows)
+    print(f"Wrote {rows} fixes to {args.output_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,474 @@
+import argparse
+import asyncio
+import json
+import time
+import numpy as np
+from all_routes_traffichourfilter import ROUTE_FILES
+from ingest_sensors import FIX_WINDOW, STOP_SPEED, score_traffic_congestion
+from route_bins import RouteBins
+from route_classify import TRAFFIC, condition_codes
+from route_geo import haversine_m
+from route_loader import load_route
+from stage_timing import add_profile_arguments, profiling, stage
+from synthetic_routes import synthetic_route
+
+# Live congestion map. Bus positions arrive as JSON lines
+#   {"bus": "12", "route": "Red Route", "time": 1693830000, "latitude": 33.77, "longitude": -84.39}
+# from a tailed file, a local TCP socket or a built-in simulator, and are scored once per
+# tick: every bus keeps its last FIX_WINDOW speeds in a ring buffer, scored like
+# ingest_sensors, and each fix's score is folded into the 25 m route bin it snaps to.
+# Browsers at http://host:port/ get the bins once and then, over Server-Sent Events,
+# only the bins whose color changed.
+#
+#   python live_routes.py --simulate 300                  # 300 synthetic buses at 1 Hz
+#   python live_routes.py --feed-file positions.jsonl     # follow a file as it grows
+#   python live_routes.py --feed-port 9100 --route "Red Route=real_data/red_traffic_mini.csv"
+TICK_S = 1.0
+# Share of each tick the batch update may use; over it, fewer fixes are taken per tick
+# and the rest wait in the (bounded) queue
+CPU_BUDGET = 0.25
+MAX_FIXES_PER_TICK = 20_000
+MIN_FIXES_PER_TICK = 500
+QUEUE_FIXES = 4 * MAX_FIXES_PER_TICK
+# A bin's score is a mean of its readings in which each reading's weight halves every
+# this many seconds
+HALF_LIFE_S = 300.0
+# Updates a browser may fall behind by before it is disconnected (it reconnects and
+# gets a fresh snapshot)
+CLIENT_QUEUE = 64
+STATUS_EVERY_TICKS = 60
+SIMULATED_ROUTE = 'Simulated Route'
+SIMULATED_ROWS = 20_000
+
+def parse_fix(line):
+    # One feed line -> (bus, route, time, latitude, longitude), or None if malformed
+    try:
+        record = json.loads(line)
+        return (str(record['bus']), str(record['route']), float(record['time']),
+                float(record['latitude']), float(record['longitude']))
+    except (ValueError, TypeError, KeyError):
+        return None
+
+class BusRings:
+    # The last `window` speeds and stop flags of every bus, one row per bus, so a batch
+    # advances every bus that reported with a few array operations. Unlike the batch
+    # ingestion, a bus is scored from whatever valid samples its ring holds, so it
+    # shows up as soon as it has moved once.
+
+    def __init__(self, window=FIX_WINDOW, capacity=64):
+        self.window = window
+        self.rows = {}
+        self.last_time = np.full(capacity, np.nan)
+        self.last_lat = np.full(capacity, np.nan)
+        self.last_lon = np.full(capacity, np.nan)
+        self.speed = np.full((capacity, window), np.nan)
+        self.stopped = np.full((capacity, window), np.nan)
+        self.head = np.zeros(capacity, dtype=np.intp)
+
+    def _grow(self, capacity):
+        for name in ('last_time', 'last_lat', 'last_lon', 'speed', 'stopped'):
+            old = getattr(self, name)
+            new = np.full((capacity,) + old.shape[1:], np.nan)
+            new[:len(old)] = old
+            setattr(self, name, new)
+        self.head = np.concatenate((self.head, np.zeros(capacity - len(self.head), dtype=np.intp)))
+
+    def row_for(self, buses):
+        rows = np.array([self.rows.setdefault(bus, len(self.rows)) for bus in buses], dtype=np.intp)
+        if len(self.rows) > len(self.head):
+            self._grow(max(2 * len(self.head), len(self.rows)))
+        return rows
+
+    def push(self, rows, time, lat, lon):
+        # One fix for each of `rows` (no repeats) -> its congestion score, 0 when the
+        # bus has no speed yet. Fixes no newer than the bus's last one are ignored.
+        prev_time = self.last_time[rows]
+        dt = time - prev_time
+        fresh = ~(dt <= 0)
+        distance = haversine_m(self.last_lat[rows], self.last_lon[rows], lat, lon)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where(dt > 0, distance / dt, np.nan)
+        stopped = np.where(np.isnan(speed), np.nan, (speed < STOP_SPEED).astype(float))
+
+        rows, head = rows[fresh], self.head[rows[fresh]]
+        self.speed[rows, head] = speed[fresh]
+        self.stopped[rows, head] = stopped[fresh]
+        self.head[rows] = (head + 1) % self.window
+        self.last_time[rows] = time[fresh]
+        self.last_lat[rows] = lat[fresh]
+        self.last_lon[rows] = lon[fresh]
+
+        scores = np.zeros(len(fresh))
+        scores[fresh] = score_traffic_congestion(nan_mean(self.stopped[rows]), nan_mean(self.speed[rows]))
+        return scores
+
+def nan_mean(values):
+    # Row means over the non-NaN entries; NaN for rows without any
+    valid = ~np.isnan(values)
+    counts = valid.sum(axis=1)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.where(counts > 0, np.where(valid, values, 0.0).sum(axis=1) / counts, np.nan)
+
+class LiveRoute:
+    # Decayed congestion score per route bin, plus the colors last sent to browsers
+
+    def __init__(self, name, bins, half_life=HALF_LIFE_S):
+        self.name = name
+        self.bins = bins
+        self.half_life = half_life
+        self.scores = np.zeros(bins.n_bins)
+        self.weights = np.zeros(bins.n_bins)
+        self.updated = np.full(bins.n_bins, np.nan)
+        self.published = condition_codes(self.scores)
+
+    def update(self, lat, lon, scores, now):
+        _, bins = self.bins.snap(lat, lon)
+        valid = (bins >= 0) & (scores > 0)
+        counts = np.bincount(bins[valid], minlength=self.bins.n_bins)
+        sums = np.bincount(bins[valid], weights=scores[valid], minlength=self.bins.n_bins)
+        hit = np.flatnonzero(counts)
+        # Old readings keep half their weight per half-life and new ones weigh 1 each, so
+        # readings arriving at an unchanged `now` still count; a bin's first readings
+        # replace the 0
+        age = now - self.updated[hit]
+        keep = np.where(np.isnan(age), 0.0, 0.5 ** (np.maximum(age, 0) / self.half_life))
+        old = keep * self.weights[hit]
+        self.weights[hit] = old + counts[hit]
+        self.scores[hit] = (old * self.scores[hit] + sums[hit]) / self.weights[hit]
+        self.updated[hit] = now
+
+    def changes(self):
+        # Bins whose color bucket changed since the last call, as an update message
+        codes = condition_codes(self.scores)
+        changed = np.flatnonzero(codes != self.published)
+        self.published[changed] = codes[changed]
+        return {
+            'bins': changed.tolist(),
+            'codes': codes[changed].tolist(),
+            'scores': np.round(self.scores[changed], 2).tolist(),
+        }
+
+    def snapshot(self):
+        # Bin boundary points plus the published colors; bin k runs from point k to k + 1
+        along = np.minimum(np.arange(self.bins.n_bins + 1) * self.bins.bin_m, self.bins.length)
+        lat, lon = self.bins.point_at(along)
+        return {
+            'name': self.name,
+            'points': np.round(np.column_stack((lat, lon)), 6).tolist(),
+            'codes': self.published.tolist(),
+            'scores': np.round(self.scores, 2).tolist(),
+        }
+
+class LiveMap:
+    # Feeds offer fixes to a bounded queue; run() takes them in batches once per tick
+
+    def __init__(self, routes, tick=TICK_S, cpu_budget=CPU_BUDGET):
+        self.routes = routes
+        self.tick = tick
+        self.cpu_budget = cpu_budget
+        self.rings = BusRings()
+        self.queue = asyncio.Queue(maxsize=QUEUE_FIXES)
+        self.clients = set()
+        self.fixes_per_tick = MAX_FIXES_PER_TICK
+        self.now = 0.0
+        self.dropped = 0
+        self.unknown = 0
+
+    def offer(self, fix):
+        # For feeds that cannot wait (sockets, the simulator): drop the fix when full
+        try:
+            self.queue.put_nowait(fix)
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    def apply(self, fixes):
+        # Scores a batch and folds it into the route bins; returns the update message
+        with stage('live_batch', rows=len(fixes)):
+            known = [fix for fix in fixes if fix[1] in self.routes]
+            self.unknown += len(fixes) - len(known)
+            fixes = known
+            if fixes:
+                buses, route_names, times, lats, lons = zip(*fixes)
+                rows = self.rings.row_for(buses)
+                times, lats, lons = (np.array(values, dtype=float) for values in (times, lats, lons))
+                route_names = np.array(route_names, dtype=object)
+                # A bus may report several times in a batch: take its fixes in time order,
+                # one round per fix, each round a single vectorized push over many buses
+                order = np.lexsort((times, rows))
+                rows, times, lats, lons, route_names = (v[order] for v in (rows, times, lats, lons, route_names))
+                first = np.flatnonzero(np.concatenate(([True], rows[1:] != rows[:-1])))
+                rank = np.arange(len(rows)) - np.repeat(first, np.diff(np.append(first, len(rows))))
+                scores = np.zeros(len(rows))
+                for r in range(rank.max() + 1):
+                    in_round = np.flatnonzero(rank == r)
+                    scores[in_round] = self.rings.push(rows[in_round], times[in_round], lats[in_round], lons[in_round])
+
+                self.now = max(self.now, float(times.max()))
+                for name, route in self.routes.items():
+                    on_route = route_names == name
+                    if on_route.any():
+                        route.update(lats[on_route], lons[on_route], scores[on_route], self.now)
+
+            changes = {name: route.changes() for name, route in self.routes.items()}
+            return {name: change for name, change in changes.items() if change['bins']}
+
+    async def run(self):
+        ticks = taken = 0
+        cpu_total = 0.0
+        while True:
+            started = time.perf_counter()
+            fixes = []
+            while len(fixes) < self.fixes_per_tick and not self.queue.empty():
+                fixes.append(self.queue.get_nowait())
+            cpu = time.process_time()
+            update = self.apply(fixes)
+            cpu = time.process_time() - cpu
+            if update:
+                self.broadcast('update', update)
+
+            # Keep each batch within its share of the tick by adjusting the batch size
+            budget = self.cpu_budget * self.tick
+            if cpu > budget and len(fixes) >= self.fixes_per_tick:
+                self.fixes_per_tick = max(MIN_FIXES_PER_TICK, int(self.fixes_per_tick * budget / cpu))
+            elif cpu < budget / 2:
+                self.fixes_per_tick = min(MAX_FIXES_PER_TICK, 2 * self.fixes_per_tick)
+
+            ticks, taken, cpu_total = ticks + 1, taken + len(fixes), cpu_total + cpu
+            if ticks % STATUS_EVERY_TICKS == 0:
+                print(f"{taken / (ticks * self.tick):.0f} fixes/s from {len(self.rings.rows)} buses, "
+                      f"{1000 * cpu_total / ticks:.1f} ms CPU per tick, {self.queue.qsize()} queued, "
+                      f"{self.dropped} dropped, {self.unknown} for unknown routes")
+            await asyncio.sleep(max(0.0, self.tick - (time.perf_counter() - started)))
+
+    def snapshot(self):
+        return {
+            'palette': TRAFFIC.palette,
+            'descriptions': TRAFFIC.labels,
+            'routes': [route.snapshot() for route in self.routes.values()],
+        }
+
+    def subscribe(self):
+        client = asyncio.Queue(maxsize=CLIENT_QUEUE)
+        client.put_nowait(('snapshot', json.dumps(self.snapshot(), separators=(',', ':'))))
+        self.clients.add(client)
+        return client
+
+    def broadcast(self, event, message):
+        data = json.dumps(message, separators=(',', ':'))
+        for client in list(self.clients):
+            try:
+                client.put_nowait((event, data))
+            except asyncio.QueueFull:
+                # Too far behind: end its stream so it reconnects from a snapshot
+                self.clients.discard(client)
+                while not client.empty():
+                    client.get_nowait()
+                client.put_nowait(None)
+
+async def tail_file(live, path, poll=0.2):
+    # Follows a JSON-lines file from its start, like `tail -f`; waits when the queue is full
+    with open(path) as file:
+        partial = ''
+        while True:
+            line = file.readline()
+            if not line:
+                await asyncio.sleep(poll)
+                continue
+            partial += line
+            if not partial.endswith('\n'):
+                continue
+            fix = parse_fix(partial)
+            partial = ''
+            if fix is not None:
+                await live.queue.put(fix)
+
+async def serve_feed(live, host, port):
+    # Accepts any number of local connections, each sending JSON lines
+    async def handle(reader, writer):
+        async for line in reader:
+            fix = parse_fix(line)
+            if fix is not None:
+                live.offer(fix)
+        writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+async def simulate(live, buses, route_name, frame):
+    # `buses` buses replaying one synthetic trace from evenly spaced starting points,
+    # each reporting once a second. Every lap of the trace is shifted later by the
+    # trace's duration, so a bus's times keep increasing when it wraps around.
+    lat = frame['latitude'].to_numpy()
+    lon = frame['longitude'].to_numpy()
+    seconds = frame['time'].to_numpy(dtype=float)
+    lap_s = seconds[-1] - seconds[0] + 1
+    offsets = np.arange(buses) * len(frame) // max(buses, 1)
+    step = 0
+    while True:
+        started = time.perf_counter()
+        rows = (offsets + step) % len(frame)
+        times = seconds[rows] + (offsets + step) // len(frame) * lap_s
+        for bus, row in enumerate(rows):
+            live.offer((f"sim-{bus}", route_name, float(times[bus]), float(lat[row]), float(lon[row])))
+        step += 1
+        await asyncio.sleep(max(0.0, 1.0 - (time.perf_counter() - started)))
+
+PAGE = """<!DOCTYPE html>
+<html>
+<head>
+<meta charset="utf-8">
+<title>Live Bus Congestion</title>
+<link rel="stylesheet" href="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.css"/>
+<script src="https://cdn.jsdelivr.net/npm/leaflet@1.9.3/dist/leaflet.js"></script>
+<style>html, body, #map { height: 100%; margin: 0; }</style>
+</head>
+<body>
+<div id="map"></div>
+<script>
+var map = L.map('map');
+L.tileLayer('https://tile.openstreetmap.org/{z}/{x}/{y}.png', {
+    attribution: '&copy; OpenStreetMap contributors', maxZoom: 19
+}).addTo(map);
+var control = L.control.layers(null, null, {collapsed: false}).addTo(map);
+var palette, descriptions, routes = {}, fitted = false;
+
+function popupText(route, k) {
+    return route.name + ', ' + descriptions[route.codes[k]] + ' (' + route.scores[k].toFixed(2) + ')';
+}
+
+function showSnapshot(snapshot) {
+    palette = snapshot.palette;
+    descriptions = snapshot.descriptions;
+    Object.keys(routes).forEach(function(name) {
+        control.removeLayer(routes[name].group);
+        map.removeLayer(routes[name].group);
+    });
+    routes = {};
+    var bounds = L.latLngBounds([]);
+    snapshot.routes.forEach(function(route) {
+        route.group = L.layerGroup().addTo(map);
+        route.lines = route.codes.map(function(code, k) {
+            var line = L.polyline([route.points[k], route.points[k + 1]],
+                                  {color: palette[code], weight: 7, opacity: 0.7});
+            line.bindPopup(function() { return popupText(route, k); });
+            return line.addTo(route.group);
+        });
+        route.points.forEach(function(point) { bounds.extend(point); });
+        control.addOverlay(route.group, route.name);
+        routes[route.name] = route;
+    });
+    if (bounds.isValid() && !fitted) {
+        map.fitBounds(bounds);
+        fitted = true;
+    }
+}
+
+// Only bins whose color changed arrive here
+function applyUpdate(update) {
+    Object.keys(update).forEach(function(name) {
+        var route = routes[name], change = update[name];
+        if (!route) return;
+        change.bins.forEach(function(k, i) {
+            route.codes[k] = change.codes[i];
+            route.scores[k] = change.scores[i];
+            route.lines[k].setStyle({color: palette[change.codes[i]]});
+        });
+    });
+}
+
+var events = new EventSource('/events');
+events.addEventListener('snapshot', function(e) { showSnapshot(JSON.parse(e.data)); });
+events.addEventListener('update', function(e) { applyUpdate(JSON.parse(e.data)); });
+</script>
+</body>
+</html>
+"""
+
+async def handle_http(live, reader, writer):
+    # GET / is the page; GET /events is its Server-Sent Events stream
+    try:
+        request = (await reader.readline()).decode('latin-1').split()
+        while (await reader.readline()).strip():
+            pass
+        path = request[1] if len(request) > 1 else '/'
+        if path == '/':
+            body = PAGE.encode('utf-8')
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/html; charset=utf-8\r\n"
+                         b"Content-Length: %d\r\nConnection: close\r\n\r\n" % len(body) + body)
+        elif path == '/events':
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/event-stream\r\n"
+                         b"Cache-Control: no-cache\r\nConnection: keep-alive\r\n\r\n")
+            client = live.subscribe()
+            try:
+                while True:
+                    message = await client.get()
+                    if message is None:
+                        break
+                    event, data = message
+                    writer.write(f"event: {event}\ndata: {data}\n\n".encode('utf-8'))
+                    await writer.drain()
+            finally:
+                live.clients.discard(client)
+        else:
+            writer.write(b"HTTP/1.1 404 Not Found\r\nContent-Length: 0\r\nConnection: close\r\n\r\n")
+        await writer.drain()
+    except (ConnectionError, asyncio.IncompleteReadError):
+        pass
+    finally:
+        writer.close()
+
+def load_routes(route_args, simulated_frame=None):
+    # LiveRoute per name from --route NAME=CSV, by default the map scripts' ROUTE_FILES;
+    # with a simulated frame, its route plus only the --route ones
+    routes = {}
+    if simulated_frame is not None:
+        routes[SIMULATED_ROUTE] = LiveRoute(SIMULATED_ROUTE, RouteBins.from_route(simulated_frame))
+    if route_args:
+        route_files = dict(arg.split('=', 1) for arg in route_args)
+    else:
+        route_files = {} if simulated_frame is not None else ROUTE_FILES
+    for name, path in route_files.items():
+        routes[name] = LiveRoute(name, RouteBins.from_route(load_route(path)))
+    return routes
+
+async def run_live(args):
+    frame = synthetic_route(SIMULATED_ROWS) if args.simulate else None
+    live = LiveMap(load_routes(args.route, frame), args.tick)
+    tasks = [asyncio.ensure_future(live.run())]
+    servers = [await asyncio.start_server(lambda r, w: handle_http(live, r, w), args.host, args.port)]
+    if args.feed_file:
+        tasks.append(asyncio.ensure_future(tail_file(live, args.feed_file)))
+    if args.feed_port:
+        servers.append(await serve_feed(live, args.host, args.feed_port))
+    if args.simulate:
+        tasks.append(asyncio.ensure_future(simulate(live, args.simulate, SIMULATED_ROUTE, frame)))
+    print(f"Live map at http://{args.host}:{args.port}/")
+    try:
+        await asyncio.gather(*tasks)
+    finally:
+        for server in servers:
+            server.close()
+
+def main(argv=None):
+    parser = add_profile_arguments(argparse.ArgumentParser())
+    parser.add_argument('--feed-file', help="JSON-lines file of positions to follow")
+    parser.add_argument('--feed-port', type=int, help="accept JSON-lines positions on this local TCP port")
+    parser.add_argument('--simulate', type=int, default=0, metavar='BUSES', help="replay this many synthetic buses")
+    parser.add_argument('--route', action='append', default=[], metavar='NAME=CSV',
+                        help="route to bin positions on (repeatable; default: the map scripts' routes)")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765, help="port of the live page")
+    parser.add_argument('--tick', type=float, default=TICK_S, help="seconds between batched updates")
+    args = parser.parse_args(argv)
+    if not (args.feed_file or args.feed_port or args.simulate):
+        parser.error("give a feed: --feed-file, --feed-port or --simulate")
+    if any('=' not in arg for arg in args.route):
+        parser.error("--route takes NAME=CSV")
+
+    with profiling(args.profile, args.profile_sort):
+        try:
+            asyncio.run(run_live(args))
+        except KeyboardInterrupt:
+            pass
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+import os
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from branca.element import Element
+from client_layers import route_payload
+from route_loader import load_route
+import stage_timing
+
+def build_fragments(build, jobs, workers=None):
+    # Runs build(job) for every job, fanned out over a process pool unless workers is 1.
+    # build must be a module-level function and jobs/results picklable (paths and plain
+    # data, not DataFrames or folium objects). Results come back in job order, so the
+    # assembled map does not depend on which worker finished first.
+    jobs = list(jobs)
+    workers = min(workers or os.cpu_count() or 1, len(jobs))
+    if workers <= 1:
+        return [build(job) for job in jobs]
+    timer = stage_timing.active()
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        if timer is None:
+            return list(pool.map(build, jobs))
+        # Profiled: each worker times its own stages and sends them back with the result
+        results = []
+        for result, records in pool.map(partial(profiled_build, build, timer.memory), jobs):
+            timer.extend(records)
+            results.append(result)
+        return results
+
+def profiled_build(build, memory, job):
+    timer = stage_timing.start(memory)
+    try:
+        with timer.stage(build.__name__):
+            result = build(job)
+    finally:
+        stage_timing.stop()
+    return result, [dict(record, worker=os.getpid()) for record in timer.records]
+
+def payload_fragment(job):
+    # (csv path, route name, value columns, lod levels) -> client_layers route payload
+    path, route_name, value_columns, lod_levels = job
+    return route_payload(load_route(path), route_name, value_columns, lod_levels)
+
+def stabilize_ids(root):
+    # folium names every element with a random id. Renumber the tree in order so that
+    # building the same data twice, serially or in parallel, saves byte-identical HTML.
+    # Besides _children this follows elements held in attributes, such as a Popup's html.
+    elements = []
+    stack = [root]
+    seen = set()
+    while stack:
+        element = stack.pop()
+        if id(element) in seen:
+            continue
+        seen.add(id(element))
+        elements.append(element)
+        held = [value for key, value in vars(element).items()
+                if key != '_parent' and isinstance(value, Element)]
+        stack.extend(reversed(list(element._children.values()) + held))
+
+    old_names = {id(element): element.get_name() for element in elements}
+    for counter, element in enumerate(elements):
+        element._id = f"{counter:032x}"
+    # Children added without an explicit name are keyed by their old name, which some
+    # templates (e.g. Popup) render as a variable name
+    for element in elements:
+        element._children = OrderedDict(
+            (child.get_name() if key == old_names[id(child)] else key, child)
+            for key, child in element._children.items()
+        )
+    return root
+
+def add_worker_argument(parser):
+    parser.add_argument('--workers', type=int, default=None,
+                        help="processes used to build route layers (default: all cores, 1 = serial)")
+    return parser
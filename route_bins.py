@@ -0,0 +1,174 @@
+import numpy as np
+import pandas as pd
+from route_geo import local_xy
+from route_segments import prepare_route
+from route_spatial import GridBuckets, MAX_SEGMENT_M
+from route_time_index import est_time_seconds
+
+BIN_M = 25.0
+# Fixes farther than this from the reference line are treated as off-route
+MAX_SNAP_M = 50.0
+# A trace counts as a full lap once it has covered this much and comes back to its start
+LAP_MIN_M = 500.0
+# The reference line keeps fixes at least this far apart, so GPS jitter between
+# closely spaced fixes does not inflate its length
+REFERENCE_SPACING_M = 10.0
+
+def path_length(x, y):
+    return np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(x), np.diff(y)))))
+
+def thin_trace(x, y, spacing):
+    # Indices of the first fix, the first fix to reach each multiple of `spacing` of
+    # distance traveled, and the last fix
+    along = path_length(x, y)
+    passed = np.searchsorted(along, np.arange(spacing, along[-1], spacing))
+    return np.unique(np.concatenate(([0], passed, [len(x) - 1])))
+
+def reference_trace(df, bin_m=BIN_M):
+    # (lat, lon) of one lap of the route: the longest stretch of the time-ordered trace
+    # without GPS gaps, cut where it first returns to its start, thinned and smoothed
+    df = prepare_route(df)
+    lat = df['latitude'].to_numpy(dtype=float)
+    lon = df['longitude'].to_numpy(dtype=float)
+    if len(lat) < 2:
+        return lat, lon
+    x, y = local_xy(lat, lon)
+    gaps = np.flatnonzero(np.hypot(np.diff(x), np.diff(y)) > MAX_SEGMENT_M) + 1
+    starts = np.concatenate(([0], gaps))
+    stops = np.concatenate((gaps, [len(x)]))
+    along = path_length(x, y)
+    longest = int(np.argmax(along[stops - 1] - along[starts]))
+    a, b = starts[longest], stops[longest]
+
+    traveled = along[a:b] - along[a]
+    from_start = np.hypot(x[a:b] - x[a], y[a:b] - y[a])
+    closed = np.flatnonzero((traveled >= LAP_MIN_M) & (from_start <= bin_m))
+    if len(closed):
+        b = a + closed[0] + 1
+    keep = a + thin_trace(x[a:b], y[a:b], REFERENCE_SPACING_M)
+    lat, lon = lat[keep], lon[keep]
+    if len(keep) > 2:
+        # 3-point moving average on the interior points; the ends stay put
+        lat[1:-1] = (lat[:-2] + lat[1:-1] + lat[2:]) / 3
+        lon[1:-1] = (lon[:-2] + lon[1:-1] + lon[2:]) / 3
+    return lat, lon
+
+class RouteBins:
+    # Fixed-length bins along a reference line. The line is resampled every bin_m / 5
+    # and every fix is snapped to the nearest sample, which gives its distance along
+    # the route and so its bin.
+
+    def __init__(self, ref_lat, ref_lon, bin_m=BIN_M, lat0=None):
+        self.bin_m = bin_m
+        self.ref_lat = np.asarray(ref_lat, dtype=float)
+        self.ref_lon = np.asarray(ref_lon, dtype=float)
+        if len(self.ref_lat) < 2:
+            raise ValueError("a reference line needs at least two fixes")
+        self.lat0 = float(np.mean(self.ref_lat)) if lat0 is None else float(lat0)
+        x, y = local_xy(self.ref_lat, self.ref_lon, self.lat0)
+        self.ref_along = path_length(x, y)
+        self.length = float(self.ref_along[-1])
+        self.n_bins = max(int(np.ceil(self.length / bin_m)), 1)
+
+        self.stations = np.append(np.arange(0, self.length, bin_m / 5), self.length)
+        self.sample_x = np.interp(self.stations, self.ref_along, x)
+        self.sample_y = np.interp(self.stations, self.ref_along, y)
+        self.samples = GridBuckets(self.sample_x, self.sample_y, MAX_SNAP_M)
+
+    @classmethod
+    def from_route(cls, df, bin_m=BIN_M):
+        return cls(*reference_trace(df, bin_m), bin_m=bin_m)
+
+    @classmethod
+    def from_centerline(cls, centerline, bin_m=BIN_M):
+        # Bins along a map-matched centerline (route_match) instead of a single lap; their
+        # distances along the route are the centerline's, so a matched frame's along_m
+        # picks the bin directly
+        return cls(centerline.lat, centerline.lon, bin_m=bin_m, lat0=centerline.lat0)
+
+    def bins_of(self, along):
+        # Bin of each distance along the route; -1 where NaN (off-route)
+        found = np.isfinite(along)
+        return np.where(found, np.clip(np.nan_to_num(along) // self.bin_m, 0, self.n_bins - 1), -1).astype(np.int64)
+
+    def snap(self, lat, lon):
+        # (distance along the route in meters, bin) per fix; bin is -1 when off-route
+        x, y = local_xy(lat, lon, self.lat0)
+        nearest, _ = self.samples.nearest_within(x, y, self.sample_x, self.sample_y)
+        along = np.where(nearest >= 0, self.stations[nearest], np.nan)
+        return along, self.bins_of(along)
+
+    def point_at(self, along):
+        return (np.interp(along, self.ref_along, self.ref_lat),
+                np.interp(along, self.ref_along, self.ref_lon))
+
+    def aggregate(self, df, value_columns, by_hour=True):
+        # One row per (bin, hour) with data, or per bin when by_hour is False:
+        # count plus mean/min/max of every value column, and <column>_count of the
+        # finite values its mean is over, from bincount and reduceat. A map-matched
+        # frame (route_match.match_route, with bins from_centerline) is binned by its
+        # along_m; any other is snapped to the reference line first.
+        if 'along_m' in df:
+            bins = self.bins_of(df['along_m'].to_numpy(dtype=float))
+        else:
+            _, bins = self.snap(df['latitude'].to_numpy(dtype=float), df['longitude'].to_numpy(dtype=float))
+        if by_hour:
+            seconds = df['est_seconds'].to_numpy() if 'est_seconds' in df else est_time_seconds(df['est_time'])
+            groups, n_groups = np.asarray(seconds) // 3600, 24
+        else:
+            groups, n_groups = np.zeros(len(bins), dtype=np.int64), 1
+        valid = (bins >= 0) & (groups >= 0)
+        keys = bins[valid] * n_groups + groups[valid]
+        n_keys = self.n_bins * n_groups
+
+        counts = np.bincount(keys, minlength=n_keys)
+        occupied = np.flatnonzero(counts)
+        table = {'bin': occupied // n_groups}
+        if by_hour:
+            table['hour'] = occupied % n_groups
+        table['count'] = counts[occupied]
+
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        run_starts = np.flatnonzero(np.concatenate(([True], sorted_keys[1:] != sorted_keys[:-1])))
+        for column in value_columns:
+            values = df[column].to_numpy(dtype=float)[valid]
+            finite = ~np.isnan(values)
+            sums = np.bincount(keys, weights=np.where(finite, values, 0.0), minlength=n_keys)
+            finite_counts = np.bincount(keys, weights=finite, minlength=n_keys)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                table[f'{column}_mean'] = (sums / finite_counts)[occupied]
+            table[f'{column}_count'] = finite_counts[occupied].astype(np.int64)
+            sorted_values = values[order]
+            if len(sorted_values):
+                table[f'{column}_min'] = np.fmin.reduceat(sorted_values, run_starts)
+                table[f'{column}_max'] = np.fmax.reduceat(sorted_values, run_starts)
+            else:
+                table[f'{column}_min'] = table[f'{column}_max'] = np.zeros(0)
+
+        table = pd.DataFrame(table)
+        table['start_m'] = table['bin'] * self.bin_m
+        table['end_m'] = np.minimum(table['start_m'] + self.bin_m, self.length)
+        return table
+
+    def route_frame(self, table, value_column, hour=None):
+        # The aggregated table as a drawable trace: one point per bin boundary, with the
+        # bin's mean on the point where the bin starts. Bins without data get 0, which
+        # every color scale shows as unavailable. Pass an hourly table with an hour, or
+        # a by_hour=False table for all hours.
+        if hour is not None:
+            table = table[table['hour'] == hour]
+        means = np.zeros(self.n_bins + 1)
+        means[table['bin'].to_numpy()] = np.nan_to_num(table[f'{value_column}_mean'].to_numpy())
+        counts = np.zeros(self.n_bins + 1, dtype=np.int64)
+        counts[table['bin'].to_numpy()] = table['count'].to_numpy()
+        along = np.minimum(np.arange(self.n_bins + 1) * self.bin_m, self.length)
+        lat, lon = self.point_at(along)
+        return pd.DataFrame({
+            'latitude': lat,
+            'longitude': lon,
+            'time': np.arange(self.n_bins + 1),
+            'along_m': along,
+            'count': counts,
+            value_column: means,
+        })
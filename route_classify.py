@@ -0,0 +1,81 @@
+import bisect
+import numpy as np
+import pandas as pd
+
+# Color buckets, palettes and labels for every map, in one place. A score is bucketed by
+# the upper edges of its buckets: <= 0 is "no data", then one bucket per unit up to 4,
+# and anything above 4 (or NaN) is the top bucket. Road condition and traffic congestion
+# share the buckets but read in opposite directions: a high road score is a smooth road
+# (green), a high congestion score is a jam (red). Whole columns are classified with one
+# searchsorted into small integer codes, which index the palette and labels; the scalar
+# methods give the same answers for one value.
+CONDITION_EDGES = np.array([0, 1, 2, 3, 4], dtype=float)
+
+GRAY = '#808080'
+RED = '#FF0000'
+ORANGE = '#FF7F00'
+YELLOW = '#FFFF00'
+CHARTREUSE = '#7FFF00'
+GREEN = '#00FF00'
+
+def condition_codes(values, edges=CONDITION_EDGES):
+    # Bucket of every value: code k is the first edge the value is <= to, len(edges) above them all
+    return np.searchsorted(edges, np.asarray(values, dtype=float), side='left')
+
+class ConditionScale:
+    # palette[k] and labels[k] belong to bucket k, so both have one more entry than edges
+
+    def __init__(self, palette, labels, edges=CONDITION_EDGES):
+        self.edges = np.asarray(edges, dtype=float)
+        if len(palette) != len(self.edges) + 1 or len(labels) != len(self.edges) + 1:
+            raise ValueError(f"{len(self.edges)} edges need {len(self.edges) + 1} colors and labels")
+        self.palette = list(palette)
+        self.labels = list(labels)
+        self._edges = self.edges.tolist()
+        # Labels may repeat across buckets; categories are the distinct ones in order
+        self.categories = list(dict.fromkeys(self.labels))
+        self._label_codes = np.array([self.categories.index(label) for label in self.labels])
+
+    def codes(self, values):
+        return condition_codes(values, self.edges)
+
+    def colors(self, values):
+        return np.array(self.palette, dtype=object)[self.codes(values)]
+
+    def describe(self, values):
+        # Labels of a whole column, as a Categorical
+        return pd.Categorical.from_codes(self._label_codes[self.codes(values)], categories=self.categories)
+
+    def code(self, value):
+        return len(self._edges) if value != value else bisect.bisect_left(self._edges, value)
+
+    def color(self, value):
+        return self.palette[self.code(value)]
+
+    def label(self, value):
+        return self.labels[self.code(value)]
+
+ROAD = ConditionScale(
+    [GRAY, RED, ORANGE, YELLOW, CHARTREUSE, GREEN],
+    ["No Data", "Poor", "Below Average", "Average", "Good", "Excellent"],
+)
+TRAFFIC = ConditionScale(
+    [GRAY, GREEN, CHARTREUSE, YELLOW, ORANGE, RED],
+    # Scores up to 0 have no congestion reading but read as none
+    ["No Traffic Congestion", "No Traffic Congestion", "Minor Traffic Congestion", "Moderate Traffic Congestion",
+     "Moderate-Heavy Traffic Congestion", "Heavy Traffic Congestion"],
+)
+
+# Phases 1-4 of the time series files; anything else is night
+TIMES_OF_DAY = ["Morning", "Noon", "Afternoon", "Evening", "Night"]
+
+def phase_codes(phases):
+    phases = np.asarray(phases, dtype=float)
+    day = (phases >= 1) & (phases <= len(TIMES_OF_DAY) - 1) & (phases == np.floor(phases))
+    return np.where(day, np.nan_to_num(phases) - 1, len(TIMES_OF_DAY) - 1).astype(np.intp)
+
+def times_of_day(phases):
+    return pd.Categorical.from_codes(phase_codes(phases), categories=TIMES_OF_DAY)
+
+def time_of_day(phase):
+    return TIMES_OF_DAY[phase - 1] if phase in (1, 2, 3, 4) else TIMES_OF_DAY[-1]
@@ -0,0 +1,77 @@
+import numpy as np
+from route_classify import condition_codes
+from route_geo import haversine_m
+from route_loader import is_code_column
+from route_segments import prepare_route
+from stage_timing import stage
+
+# Collapses the long runs of near-identical fixes logged while a bus waits at a stop or
+# a light. A run is consecutive fixes each within STATIONARY_M of the run's first fix,
+# with every condition column in the same color bucket; it becomes its first fix, with
+# each condition column averaged over the run (which keeps it in that bucket),
+# dwell_s = seconds from the first to the last fix and fixes = how many were merged.
+# Every segment drawn from the result has the color the original run had, and its
+# geometry moves by at most STATIONARY_M (under a pixel at the maps' zoom). Fixes
+# repeating the previous fix's timestamp are dropped first.
+STATIONARY_M = 2.0
+# Fixes further apart in time than this are never merged
+MAX_GAP_S = 60.0
+# Rows compared against a run's first fix at a time when splitting runs
+SPLIT_WINDOW = 16
+
+def split_far_runs(lat, lon, starts, radius_m):
+    # A bus creeping forward stays within radius_m of its previous fix but not of the
+    # run's first: walk each run once, starting a new run at the first fix too far from
+    # the current run's first. Rows are checked in windows that double while nothing is
+    # far and reset after a cut, so each row is looked at a bounded number of times.
+    starts = starts.copy()
+    firsts = np.flatnonzero(starts)
+    ends = np.append(firsts[1:], len(starts))
+    for anchor, end in zip(firsts[ends - firsts > 1], ends[ends - firsts > 1]):
+        checked, window = anchor + 1, SPLIT_WINDOW
+        while checked < end:
+            stop = min(end, checked + window)
+            far = np.flatnonzero(haversine_m(lat[anchor], lon[anchor], lat[checked:stop], lon[checked:stop]) > radius_m)
+            if len(far):
+                anchor = checked + far[0]
+                starts[anchor] = True
+                checked, window = anchor + 1, SPLIT_WINDOW
+            else:
+                checked, window = stop, window * 2
+    return starts
+
+def compress_stationary(df, radius_m=STATIONARY_M):
+    df = prepare_route(df)
+    with stage('compress_stationary', rows=len(df)):
+        seconds = df['time'].to_numpy(dtype=float)
+        unique = np.concatenate(([True], np.diff(seconds) != 0)) if len(df) else np.zeros(0, dtype=bool)
+        df = df[unique]
+        seconds = seconds[unique]
+        if len(df) < 2:
+            return df.assign(dwell_s=0.0, fixes=1)
+
+        lat = df['latitude'].to_numpy(dtype=float)
+        lon = df['longitude'].to_numpy(dtype=float)
+        value_columns = [column for column in df.columns if is_code_column(column)]
+        codes = condition_codes(np.column_stack([df[column].to_numpy(dtype=float) for column in value_columns])) \
+            if value_columns else np.zeros((len(df), 1))
+        same_codes = (codes[1:] == codes[:-1]).all(axis=1)
+        step = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+        starts = np.concatenate(([True], ~((step <= radius_m) & same_codes & (np.diff(seconds) <= MAX_GAP_S))))
+
+        starts = split_far_runs(lat, lon, starts, radius_m)
+
+        first_rows = np.flatnonzero(starts)
+        counts = np.diff(np.append(first_rows, len(df)))
+        last_rows = first_rows + counts - 1
+        result = df.iloc[first_rows].copy()
+        for column in value_columns:
+            values = df[column].to_numpy(dtype=float)
+            finite = np.isfinite(values)
+            sums = np.add.reduceat(np.where(finite, values, 0.0), first_rows)
+            n = np.add.reduceat(finite.astype(np.int64), first_rows)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                result[column] = np.where(n > 0, sums / np.maximum(n, 1), np.nan)
+        result['dwell_s'] = seconds[last_rows] - seconds[first_rows]
+        result['fixes'] = counts
+        return result
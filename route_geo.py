@@ -0,0 +1,23 @@
+import numpy as np
+
+EARTH_RADIUS_M = 6371008.8
+
+def local_xy(lat, lon, lat0=None):
+    # Equirectangular projection to meters around lat0; accurate to well under a
+    # meter over a campus-sized area, and cheap enough for whole columns
+    lat = np.asarray(lat, dtype=float)
+    lon = np.asarray(lon, dtype=float)
+    if lat0 is None:
+        lat0 = np.nanmean(lat) if lat.size else 0.0
+    scale = np.pi / 180 * EARTH_RADIUS_M
+    return lon * scale * np.cos(np.radians(lat0)), lat * scale
+
+def meters_per_pixel(zoom, lat):
+    # Web Mercator ground resolution of a 256 px tile pyramid
+    return 2 * np.pi * EARTH_RADIUS_M * np.cos(np.radians(lat)) / (256 * 2 ** zoom)
+
+def haversine_m(lat1, lon1, lat2, lon2):
+    # Great-circle distance in meters, elementwise over arrays
+    lat1, lon1, lat2, lon2 = (np.radians(np.asarray(v, dtype=float)) for v in (lat1, lon1, lat2, lon2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.minimum(a, 1.0)))
@@ -0,0 +1,219 @@
+import hashlib
+import json
+import os
+import shutil
+import time
+import uuid
+import numpy as np
+import pandas as pd
+from route_time_index import est_time_seconds
+from stage_timing import stage
+
+# Bump when the on-disk column layout changes so old caches get rebuilt
+CACHE_VERSION = 1
+COORD_COLUMNS = ('latitude', 'longitude')
+# Route sources starting with this are history store queries rather than CSV paths
+HISTORY_PREFIX = 'history:'
+# Prefixed to any route source, loads it with stationary runs collapsed (route_compress)
+STATIONARY_PREFIX = 'stationary:'
+
+# Builds replaced this long ago are deleted by the next build of the same cache; a
+# process that read the old manifest just before can still load its columns
+STALE_BUILD_S = 3600.0
+
+_second_labels = None
+
+def is_code_column(name):
+    return name == 'traffic_congestion' or name.startswith('road_condition')
+
+def file_sha256(path):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def cache_dir_for(path, compress=False):
+    # real_data/blue_traffic.csv -> real_data/.cache/blue_traffic.csv.cols/
+    # (blue_traffic.csv.stationary.cols/ for the compressed frame)
+    suffix = '.stationary.cols' if compress else '.cols'
+    return os.path.join(os.path.dirname(path), '.cache', os.path.basename(path) + suffix)
+
+def second_labels():
+    # 'HH:MM:SS' for every second of the day, shared by all cached est_time columns
+    global _second_labels
+    if _second_labels is None:
+        seconds = np.arange(86400)
+        _second_labels = [f"{h:02d}:{m:02d}:{s:02d}" for h, m, s in zip(seconds // 3600, seconds // 60 % 60, seconds % 60)]
+    return _second_labels
+
+def est_time_from_seconds(seconds):
+    # Categorical view of seconds of day; -1 (unparsed) becomes NaN
+    return pd.Categorical.from_codes(np.asarray(seconds, dtype=np.int32), categories=second_labels())
+
+def downcast_column(name, series):
+    if name in COORD_COLUMNS:
+        return series.to_numpy(dtype=np.float32)
+    if is_code_column(name):
+        values = series.to_numpy(dtype=np.float64)
+        integral = np.isfinite(values).all() and (values == np.round(values)).all()
+        if integral and len(values) and values.min() >= -128 and values.max() <= 127:
+            return values.astype(np.int8)
+        return values.astype(np.float32)
+    if pd.api.types.is_numeric_dtype(series.dtype):
+        return series.to_numpy()
+    # Text columns become fixed-width unicode so they can be memory-mapped too
+    return series.fillna('').to_numpy(dtype=str)
+
+def read_manifest(cache_dir):
+    try:
+        with open(os.path.join(cache_dir, 'manifest.json')) as file:
+            return json.load(file)
+    except (OSError, ValueError):
+        return None
+
+def write_manifest(cache_dir, manifest):
+    # Atomic, and safe against another process writing the same manifest
+    tmp_path = os.path.join(cache_dir, f'manifest.json.{uuid.uuid4().hex[:12]}.tmp')
+    with open(tmp_path, 'w') as file:
+        json.dump(manifest, file, indent=1)
+    os.replace(tmp_path, os.path.join(cache_dir, 'manifest.json'))
+
+def cache_is_current(manifest, path):
+    if manifest is None or manifest.get('version') != CACHE_VERSION:
+        return False
+    stat = os.stat(path)
+    if manifest['size'] == stat.st_size and manifest['mtime_ns'] == stat.st_mtime_ns:
+        return True
+    # Touched but maybe not changed (e.g. a fresh checkout): fall back to the content hash
+    if manifest['size'] != stat.st_size or manifest['sha256'] != file_sha256(path):
+        return False
+    manifest['mtime_ns'] = stat.st_mtime_ns
+    write_manifest(cache_dir_for(path, manifest.get('compressed', False)), manifest)
+    return True
+
+def remove_stale_builds(cache_dir, current):
+    # Column files of earlier builds (build-<id>/, or NNN.npy directly in cache_dir
+    # before builds had their own directory) once they are STALE_BUILD_S old
+    now = time.time()
+    for entry in os.listdir(cache_dir):
+        entry_path = os.path.join(cache_dir, entry)
+        try:
+            stale = entry != current and now - os.path.getmtime(entry_path) >= STALE_BUILD_S
+            if stale and entry.startswith('build-'):
+                shutil.rmtree(entry_path, ignore_errors=True)
+            elif stale and (entry.endswith('.npy') or entry.endswith('.tmp')):
+                os.remove(entry_path)
+        except FileNotFoundError:
+            # Renamed into place or removed by another process since listdir
+            pass
+
+def build_cache(path, cache_dir, compress=False):
+    # Columns are written to a new build-<id>/ directory and the manifest naming it is
+    # swapped in last, so readers see either the old cache or the complete new one, and
+    # processes building the same cache at once never write the same file
+    os.makedirs(cache_dir, exist_ok=True)
+    build = f"build-{uuid.uuid4().hex[:12]}"
+    build_dir = os.path.join(cache_dir, build)
+    os.makedirs(build_dir)
+
+    stat = os.stat(path)
+    sha256 = file_sha256(path)
+    with stage('read_csv') as timed:
+        df = pd.read_csv(path)
+        timed.rows = len(df)
+    if compress:
+        import route_compress
+        df = route_compress.compress_stationary(df)
+
+    columns = []
+    for i, name in enumerate(df.columns):
+        if name == 'est_time':
+            # Stored as seconds of day; the text form is rebuilt as a categorical on load
+            values, kind = est_time_seconds(df[name]), 'est_seconds'
+        else:
+            values, kind = downcast_column(name, df[name]), 'values'
+        file_name = f"{i:03d}.npy"
+        np.save(os.path.join(build_dir, file_name), values)
+        columns.append({'name': name, 'file': file_name, 'kind': kind, 'dtype': values.dtype.str})
+
+    manifest = {
+        'version': CACHE_VERSION,
+        'source': os.path.basename(path),
+        'size': stat.st_size,
+        'mtime_ns': stat.st_mtime_ns,
+        'sha256': sha256,
+        'compressed': compress,
+        'rows': len(df),
+        'build': build,
+        'columns': columns,
+    }
+    write_manifest(cache_dir, manifest)
+    remove_stale_builds(cache_dir, build)
+    return manifest
+
+def dataset_version(path):
+    # Content hash of the source CSV, taken from the cache when it is current
+    manifest = read_manifest(cache_dir_for(path))
+    return manifest['sha256'] if cache_is_current(manifest, path) else file_sha256(path)
+
+def load_route_csv(path, use_cache=True, compress=False):
+    # Route CSV as a DataFrame backed by memory-mapped, downcast .npy columns.
+    # The cache is (re)built from the CSV the first time and whenever its content changes.
+    # With compress, stationary runs are collapsed before caching (route_compress).
+    if not use_cache:
+        with stage('read_csv') as timed:
+            df = pd.read_csv(path)
+            timed.rows = len(df)
+        if compress:
+            import route_compress
+            df = route_compress.compress_stationary(df)
+        return df
+
+    cache_dir = cache_dir_for(path, compress)
+    manifest = read_manifest(cache_dir)
+    if not cache_is_current(manifest, path):
+        with stage('build_cache'):
+            manifest = build_cache(path, cache_dir, compress)
+
+    # Empty files cannot be memory-mapped
+    mmap_mode = 'r' if manifest['rows'] else None
+    build_dir = os.path.join(cache_dir, manifest.get('build', ''))
+    columns = {}
+    for column in manifest['columns']:
+        values = np.load(os.path.join(build_dir, column['file']), mmap_mode=mmap_mode)
+        if column['kind'] == 'est_seconds':
+            columns['est_time'] = est_time_from_seconds(values)
+            columns['est_seconds'] = values
+        else:
+            columns[column['name']] = values
+    return pd.DataFrame(columns, copy=False)
+
+def load_route(source):
+    # A route CSV path, or a history store query such as
+    # 'history:history?route=Blue Route&start=2023-09-04' (see history_store), either
+    # optionally prefixed with 'stationary:'. A DataFrame is a route already loaded and
+    # comes back as it is.
+    if isinstance(source, pd.DataFrame):
+        return source
+    source = str(source)
+    if source.startswith(STATIONARY_PREFIX):
+        source = source[len(STATIONARY_PREFIX):]
+        if not source.startswith(HISTORY_PREFIX):
+            return load_route_csv(source, compress=True)
+        import route_compress
+        return route_compress.compress_stationary(load_route(source))
+    if source.startswith(HISTORY_PREFIX):
+        import history_store
+        return history_store.load_source(source)
+    return load_route_csv(source)
+
+def route_version(source):
+    # Changes whenever the data behind a route source changes
+    source = str(source)
+    if source.startswith(STATIONARY_PREFIX):
+        return route_version(source[len(STATIONARY_PREFIX):])
+    if source.startswith(HISTORY_PREFIX):
+        import history_store
+        return history_store.source_version(source)
+    return dataset_version(source)
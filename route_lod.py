@@ -0,0 +1,65 @@
+import numpy as np
+from route_geo import local_xy
+
+# (min zoom, tolerance in meters) for each level of detail. Each tolerance is roughly
+# half a screen pixel at the level's lowest zoom on campus; 0 keeps every fix.
+LOD_LEVELS = ((0, 16.0), (13, 4.0), (15, 1.0), (17, 0.0))
+
+def douglas_peucker(x, y, tolerance):
+    # Keep mask for one polyline in projected meters; both endpoints are always kept
+    n = len(x)
+    keep = np.zeros(n, dtype=bool)
+    if n == 0:
+        return keep
+    if tolerance <= 0 or n < 3:
+        keep[:] = True
+        return keep
+    keep[0] = keep[-1] = True
+
+    stack = [(0, n - 1)]
+    while stack:
+        a, b = stack.pop()
+        if b - a < 2:
+            continue
+        dx, dy = x[b] - x[a], y[b] - y[a]
+        px, py = x[a + 1:b] - x[a], y[a + 1:b] - y[a]
+        length2 = dx * dx + dy * dy
+        if length2 == 0:
+            dist = np.hypot(px, py)
+        else:
+            # Distance to the chord segment rather than its line, so a trace that
+            # loops back to its start is not collapsed
+            t = np.clip((px * dx + py * dy) / length2, 0, 1)
+            dist = np.hypot(px - t * dx, py - t * dy)
+        i = int(np.argmax(dist))
+        if dist[i] > tolerance:
+            mid = a + 1 + i
+            keep[mid] = True
+            stack.append((a, mid))
+            stack.append((mid, b))
+    return keep
+
+def simplify_runs(lat, lon, starts, stops, tolerance):
+    # Keep mask over all points that simplifies each color run on its own, so every
+    # point where the color changes survives at every level
+    keep = np.zeros(len(lat), dtype=bool)
+    if tolerance <= 0:
+        keep[:] = True
+        return keep
+    x, y = local_xy(lat, lon)
+    for start, stop in zip(starts, stops):
+        keep[start:stop + 1] |= douglas_peucker(x[start:stop + 1], y[start:stop + 1], tolerance)
+    return keep
+
+def reindex_runs(keep, starts, stops):
+    # Run bounds after dropping the points that are not kept
+    position = np.cumsum(keep) - 1
+    return position[starts], position[stops]
+
+def lod_tolerance(zoom, lod_levels=LOD_LEVELS):
+    # Tolerance of the level shown at this zoom
+    tolerance = lod_levels[0][1]
+    for min_zoom, level_tolerance in lod_levels:
+        if zoom >= min_zoom:
+            tolerance = level_tolerance
+    return tolerance
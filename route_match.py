@@ -0,0 +1,185 @@
+import argparse
+import os
+import time
+import numpy as np
+from history_store import route_dir_name
+from route_bins import BIN_M, MAX_SNAP_M, RouteBins, path_length, reference_trace
+from route_geo import EARTH_RADIUS_M, local_xy
+from route_loader import load_route
+from route_segments import prepare_route
+from route_spatial import GridBuckets, point_segment_distance
+from stage_timing import stage
+
+# Map-matching onto one canonical centerline per route. The centerline starts as the
+# reference lap of route_bins, resampled every SPACING_M, and is then pulled onto the
+# middle of all the route's traces: every fix is projected onto the line, and each
+# vertex moves sideways by the median signed offset of the fixes around it (smoothed
+# along the line), for a few rounds. Projection is an exact nearest-segment search over
+# a grid of segment midpoints, vectorized over all fixes, and gives each fix its
+# distance along the route (along_m) and signed distance from the line (offset_m,
+# positive to the left of travel), so rendering and aggregation can work in one
+# dimension. Fixes on a road the route runs twice get the nearer pass.
+#
+#   python route_match.py centerlines "Blue Route=real_data/blue_traffic_mini.csv"
+SPACING_M = 5.0
+ITERATIONS = 3
+# Vertices with fewer fixes around them keep their place
+MIN_FIXES = 3
+# Offsets are smoothed over this many vertices either side
+SMOOTH_VERTICES = 4
+# Fixes are first looked up on a fine grid, which settles every fix within NEAR_M of
+# the line with few candidate segments; only the rest go to the coarse MAX_SNAP_M grid
+NEAR_M = 10.0
+
+def resample(x, y, spacing):
+    along = path_length(x, y)
+    stations = np.append(np.arange(0, along[-1], spacing), along[-1])
+    return np.interp(stations, along, x), np.interp(stations, along, y)
+
+def moving_average(values, half):
+    # Centered mean over 2 * half + 1 entries, over fewer at the ends
+    window = np.ones(2 * half + 1)
+    return np.convolve(values, window, mode='same') / np.convolve(np.ones(len(values)), window, mode='same')
+
+def group_medians(keys, values, n_keys):
+    # (median of values, count) per key in 0..n_keys - 1; NaN median where empty
+    order = np.lexsort((values, keys))
+    keys, values = keys[order], values[order]
+    counts = np.bincount(keys, minlength=n_keys)
+    starts = np.concatenate(([0], np.cumsum(counts)[:-1]))
+    medians = np.full(n_keys, np.nan)
+    occupied = counts > 0
+    low = starts[occupied] + (counts[occupied] - 1) // 2
+    high = starts[occupied] + counts[occupied] // 2
+    medians[occupied] = (values[low] + values[high]) / 2
+    return medians, counts
+
+class RouteCenterline:
+
+    def __init__(self, lat, lon, lat0=None):
+        self.lat = np.asarray(lat, dtype=float)
+        self.lon = np.asarray(lon, dtype=float)
+        if len(self.lat) < 2:
+            raise ValueError("a centerline needs at least two points")
+        self.lat0 = float(np.mean(self.lat)) if lat0 is None else float(lat0)
+        self.x, self.y = local_xy(self.lat, self.lon, self.lat0)
+        self.along = path_length(self.x, self.y)
+        self.length = float(self.along[-1])
+        self.seg_dx = np.diff(self.x)
+        self.seg_dy = np.diff(self.y)
+        self.seg_length = np.hypot(self.seg_dx, self.seg_dy)
+        # A segment within some distance of a fix has its midpoint within that distance
+        # plus half its length, which the grid cells must cover
+        mid_x = (self.x[:-1] + self.x[1:]) / 2
+        mid_y = (self.y[:-1] + self.y[1:]) / 2
+        half = float(self.seg_length.max()) / 2
+        self.near_segments = GridBuckets(mid_x, mid_y, NEAR_M + half)
+        self.segments = GridBuckets(mid_x, mid_y, MAX_SNAP_M + half)
+
+    @classmethod
+    def from_xy(cls, x, y, lat0):
+        scale = np.pi / 180 * EARTH_RADIUS_M
+        return cls(y / scale, x / (scale * np.cos(np.radians(lat0))), lat0)
+
+    @classmethod
+    def from_traces(cls, df, spacing=SPACING_M, iterations=ITERATIONS):
+        # Centerline of every trace of the route, seeded with its reference lap
+        df = prepare_route(df)
+        with stage('centerline', rows=len(df)):
+            seed_lat, seed_lon = reference_trace(df)
+            lat0 = float(np.mean(seed_lat))
+            x, y = resample(*local_xy(seed_lat, seed_lon, lat0), spacing)
+            line = cls.from_xy(x, y, lat0)
+            fx, fy = local_xy(df['latitude'].to_numpy(dtype=float), df['longitude'].to_numpy(dtype=float), lat0)
+            for _ in range(iterations):
+                along, offset, _ = line.project_xy(fx, fy)
+                matched = np.isfinite(along)
+                vertex = np.rint(along[matched] / spacing).astype(np.int64).clip(0, len(line.x) - 1)
+                medians, counts = group_medians(vertex, offset[matched], len(line.x))
+                shift = moving_average(np.where(counts >= MIN_FIXES, medians, 0.0), SMOOTH_VERTICES)
+                # Left normal at each vertex, from the direction of the line around it
+                tx, ty = np.gradient(line.x), np.gradient(line.y)
+                norm = np.maximum(np.hypot(tx, ty), 1e-9)
+                x, y = resample(line.x - shift * ty / norm, line.y + shift * tx / norm, spacing)
+                line = cls.from_xy(x, y, lat0)
+            return line
+
+    def nearest_segments(self, x, y, grid, max_distance):
+        def distance_to(segments, rows):
+            return point_segment_distance(x[rows], y[rows], self.x[segments], self.y[segments],
+                                          self.x[segments + 1], self.y[segments + 1])
+
+        return grid.nearest_within(x, y, None, None, distance_to, max_distance)
+
+    def project_xy(self, x, y):
+        # (along_m, offset_m, segment) of points in the line's local meters; NaN and -1
+        # beyond MAX_SNAP_M. offset_m is the distance to the nearest segment, negative
+        # to the right of travel.
+        x, y = np.asarray(x, dtype=float), np.asarray(y, dtype=float)
+        segment, distance = self.nearest_segments(x, y, self.near_segments, NEAR_M)
+        far = np.flatnonzero(segment < 0)
+        if len(far):
+            segment[far], distance[far] = self.nearest_segments(x[far], y[far], self.segments, MAX_SNAP_M)
+        found = segment >= 0
+        s = np.where(found, segment, 0)
+        px, py = x - self.x[s], y - self.y[s]
+        with np.errstate(divide='ignore', invalid='ignore'):
+            t = np.clip((px * self.seg_dx[s] + py * self.seg_dy[s]) / self.seg_length[s] ** 2, 0, 1)
+        left = self.seg_dx[s] * py - self.seg_dy[s] * px >= 0
+        along = self.along[s] + t * self.seg_length[s]
+        offset = np.where(left, distance, -distance)
+        return np.where(found, along, np.nan), np.where(found, offset, np.nan), segment
+
+    def project(self, lat, lon):
+        return self.project_xy(*local_xy(lat, lon, self.lat0))
+
+    def point_at(self, along):
+        return np.interp(along, self.along, self.lat), np.interp(along, self.along, self.lon)
+
+    def save(self, path):
+        np.savez_compressed(path, lat=self.lat, lon=self.lon, lat0=self.lat0)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['lat'], data['lon'], float(data['lat0']))
+
+def match_route(df, centerline):
+    # The route with along_m and offset_m per fix (NaN for fixes off the route)
+    with stage('map_match', rows=len(df)):
+        along, offset, _ = centerline.project(df['latitude'].to_numpy(dtype=float),
+                                              df['longitude'].to_numpy(dtype=float))
+        return df.assign(along_m=along, offset_m=offset)
+
+def matched_bins(df, bin_m=BIN_M):
+    # (RouteBins along the route's centerline, the route with along_m and offset_m), so
+    # RouteBins.aggregate bins every fix by its matched distance along the route
+    centerline = RouteCenterline.from_traces(df)
+    return RouteBins.from_centerline(centerline, bin_m), match_route(df, centerline)
+
+def centerline_path(root, route):
+    return os.path.join(root, route_dir_name(route) + '.npz')
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('root', help="directory the centerlines are saved in, one <route>.npz each")
+    parser.add_argument('routes', nargs='+', metavar='NAME=SOURCE', help="route CSV or history store source")
+    args = parser.parse_args(argv)
+    if any('=' not in arg for arg in args.routes):
+        parser.error("routes take NAME=SOURCE")
+
+    os.makedirs(args.root, exist_ok=True)
+    for name, source in (arg.split('=', 1) for arg in args.routes):
+        df = load_route(source)
+        centerline = RouteCenterline.from_traces(df)
+        centerline.save(centerline_path(args.root, name))
+        started = time.perf_counter()
+        matched = match_route(df, centerline)
+        elapsed = time.perf_counter() - started
+        offsets = matched['offset_m'].abs()
+        print(f"{name}: {centerline.length / 1000:.2f} km centerline, {offsets.notna().mean():.1%} of "
+              f"{len(df)} fixes matched, median offset {offsets.median():.1f} m, "
+              f"{1e9 * elapsed / max(len(df), 1):.0f} ns per fix")
+
+if __name__ == '__main__':
+    main()
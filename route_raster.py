@@ -0,0 +1,171 @@
+import argparse
+import os
+import shutil
+import struct
+import zlib
+import numpy as np
+import pandas as pd
+from route_classify import ROAD, TRAFFIC, condition_codes
+from route_loader import load_route
+from route_time_index import RouteTimeIndex
+from stage_timing import stage
+
+# Raster alternative to the vector route layers: fixes are aggregated into 256 px Web
+# Mercator tiles (mean value per pixel, each fix spread over a small square so sparse
+# traces stay visible) and written as PNGs under <tile dir>/{z}/{x}/{y}.png, which
+# folium shows as a TileLayer. The page then loads at most a screenful of small images
+# however many fixes went in, and building the tiles is a few bincounts per tile.
+TILE_PX = 256
+MIN_ZOOM = 12
+MAX_ZOOM = 18
+# Each fix covers the (2 * SPLAT_PX + 1)^2 pixels around it
+SPLAT_PX = 2
+ALPHA = 200
+
+def mercator_pixels(lat, lon, zoom):
+    # Global pixel coordinates of a 256 px tile pyramid at `zoom`
+    scale = TILE_PX * 2 ** zoom
+    lat = np.radians(np.clip(np.asarray(lat, dtype=float), -85.05112878, 85.05112878))
+    x = (np.asarray(lon, dtype=float) + 180.0) / 360.0 * scale
+    y = (1.0 - np.log(np.tan(lat) + 1.0 / np.cos(lat)) / np.pi) / 2.0 * scale
+    return x, y
+
+def box_sum(grid, radius):
+    # Sum over the (2 * radius + 1)^2 window around every cell, via an integral image
+    size = 2 * radius + 1
+    padded = np.pad(grid, radius)
+    integral = np.zeros((padded.shape[0] + 1, padded.shape[1] + 1), dtype=grid.dtype)
+    integral[1:, 1:] = padded.cumsum(axis=0).cumsum(axis=1)
+    return integral[size:, size:] - integral[:-size, size:] - integral[size:, :-size] + integral[:-size, :-size]
+
+def encode_png(rgba):
+    # (height, width, 4) uint8 -> PNG bytes; rows are stored unfiltered
+    height, width, _ = rgba.shape
+    raw = np.concatenate((np.zeros((height, 1), dtype=np.uint8), rgba.reshape(height, width * 4)), axis=1)
+
+    def chunk(tag, data):
+        return struct.pack('>I', len(data)) + tag + data + struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 6, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(raw.tobytes(), 6))
+            + chunk(b'IEND', b''))
+
+def hex_rgb(color):
+    return [int(color[i:i + 2], 16) for i in (1, 3, 5)]
+
+def tile_entries(ix, iy, radius):
+    # (fix, tile x, tile y) for every tile a fix's square touches: up to four when it
+    # lies near a tile corner
+    tx0, tx1 = (ix - radius) // TILE_PX, (ix + radius) // TILE_PX
+    ty0, ty1 = (iy - radius) // TILE_PX, (iy + radius) // TILE_PX
+    fixes = np.arange(len(ix))
+    corners = [
+        (np.ones(len(ix), dtype=bool), tx0, ty0),
+        (tx1 != tx0, tx1, ty0),
+        (ty1 != ty0, tx0, ty1),
+        ((tx1 != tx0) & (ty1 != ty0), tx1, ty1),
+    ]
+    return (np.concatenate([fixes[mask] for mask, _, _ in corners]),
+            np.concatenate([tx[mask] for mask, tx, _ in corners]),
+            np.concatenate([ty[mask] for mask, _, ty in corners]))
+
+def render_zoom(lat, lon, values, zoom, palette, tile_dir, radius=SPLAT_PX):
+    # Writes the zoom level's non-empty tiles; returns how many
+    x, y = mercator_pixels(lat, lon, zoom)
+    ix, iy = np.floor(x).astype(np.int64), np.floor(y).astype(np.int64)
+    fixes, tx, ty = tile_entries(ix, iy, radius)
+    order = np.lexsort((ty, tx))
+    fixes, tx, ty = fixes[order], tx[order], ty[order]
+    starts = np.flatnonzero(np.concatenate(([True], (tx[1:] != tx[:-1]) | (ty[1:] != ty[:-1]))))
+    stops = np.append(starts[1:], len(fixes))
+
+    side = TILE_PX + 2 * radius
+    written = 0
+    for start, stop in zip(starts, stops):
+        tile_fixes = fixes[start:stop]
+        # Pixel within the tile, shifted by the margin that catches neighbors' squares
+        local = ((iy[tile_fixes] - ty[start] * TILE_PX + radius) * side
+                 + ix[tile_fixes] - tx[start] * TILE_PX + radius)
+        inside = (local >= 0) & (local < side * side)
+        local = local[inside]
+        # Scores <= 0 are "no reading": they mark the pixel as covered but stay out of
+        # its mean, so it is gray only when it has no reading at all
+        tile_values = values[tile_fixes][inside]
+        reading = (tile_values > 0).astype(float)
+        sums = np.bincount(local, weights=tile_values * reading, minlength=side * side).reshape(side, side)
+        counts = np.bincount(local, weights=reading, minlength=side * side).reshape(side, side)
+        fix_counts = np.bincount(local, minlength=side * side).reshape(side, side).astype(float)
+        sums = box_sum(sums, radius)[radius:radius + TILE_PX, radius:radius + TILE_PX]
+        counts = box_sum(counts, radius)[radius:radius + TILE_PX, radius:radius + TILE_PX]
+        covered = box_sum(fix_counts, radius)[radius:radius + TILE_PX, radius:radius + TILE_PX] > 0
+        if not covered.any():
+            continue
+        means = np.where(counts > 0, sums / np.maximum(counts, 1), 0.0)
+        rgba = np.zeros((TILE_PX, TILE_PX, 4), dtype=np.uint8)
+        rgba[..., :3] = palette[condition_codes(means)]
+        rgba[..., 3] = np.where(covered, ALPHA, 0)
+
+        column_dir = os.path.join(tile_dir, str(zoom), str(tx[start]))
+        os.makedirs(column_dir, exist_ok=True)
+        with open(os.path.join(column_dir, f"{ty[start]}.png"), 'wb') as file:
+            file.write(encode_png(rgba))
+        written += 1
+    return written
+
+def is_tile_pyramid(tile_dir):
+    # Whether tile_dir holds nothing but {z} directories, so it is safe to replace
+    return all(name.isdigit() and os.path.isdir(os.path.join(tile_dir, name)) for name in os.listdir(tile_dir))
+
+def render_tiles(df, value_column, tile_dir, colors, hour=None, zooms=range(MIN_ZOOM, MAX_ZOOM + 1)):
+    # Replaces tile_dir with the tiles of one route (or several concatenated), optionally
+    # for a single hour. colors[code] is the hex color of each condition bucket.
+    if hour is not None:
+        df = RouteTimeIndex(df).hour(hour)
+    lat = df['latitude'].to_numpy(dtype=float)
+    lon = df['longitude'].to_numpy(dtype=float)
+    values = df[value_column].to_numpy(dtype=float)
+    valid = np.isfinite(lat) & np.isfinite(lon) & np.isfinite(values)
+    lat, lon, values = lat[valid], lon[valid], values[valid]
+    palette = np.array([hex_rgb(color) for color in colors], dtype=np.uint8)
+
+    if os.path.isdir(tile_dir) and not is_tile_pyramid(tile_dir):
+        raise ValueError(f"{tile_dir} is not a tile directory; refusing to replace it")
+    shutil.rmtree(tile_dir, ignore_errors=True)
+    os.makedirs(tile_dir)
+    tiles = {}
+    for zoom in zooms:
+        with stage('raster_zoom', rows=len(values)):
+            tiles[zoom] = render_zoom(lat, lon, values, zoom, palette, tile_dir)
+    return {'min_zoom': min(zooms), 'max_zoom': max(zooms), 'tiles': tiles, 'points': len(values)}
+
+def route_tile_layer(job):
+    # build_maps layer: (source, value column, hour, colors, tile dir, tile URL) -> the
+    # tiles written plus the URL template a TileLayer loads them from; `files` tells
+    # build_maps the layer is only usable from its cache while the tiles are on disk
+    path, value_column, hour, colors, tile_dir, tiles_url = job
+    layer = render_tiles(load_route(path), value_column, tile_dir, colors, hour)
+    layer['url'] = tiles_url + '/{z}/{x}/{y}.png'
+    layer['files'] = [tile_dir]
+    return layer
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('tile_dir', help="directory to (re)write the {z}/{x}/{y}.png tiles into; "
+                        "must be new, empty or an earlier tile directory")
+    parser.add_argument('sources', nargs='+', help="route CSVs or history sources, drawn together")
+    parser.add_argument('--column', default='traffic_congestion')
+    parser.add_argument('--road', action='store_true', help="color as road condition (high is good) rather than congestion")
+    parser.add_argument('--hour', type=int)
+    parser.add_argument('--zooms', type=int, nargs=2, default=(MIN_ZOOM, MAX_ZOOM), metavar=('MIN', 'MAX'))
+    args = parser.parse_args(argv)
+    if os.path.isdir(args.tile_dir) and not is_tile_pyramid(args.tile_dir):
+        parser.error(f"{args.tile_dir} is not a tile directory; refusing to replace it")
+
+    df = pd.concat([load_route(source) for source in args.sources], ignore_index=True)
+    colors = (ROAD if args.road else TRAFFIC).palette
+    result = render_tiles(df, args.column, args.tile_dir, colors, args.hour, range(args.zooms[0], args.zooms[1] + 1))
+    print(f"{result['points']} fixes -> {sum(result['tiles'].values())} tiles in {args.tile_dir}")
+
+if __name__ == '__main__':
+    main()
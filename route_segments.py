@@ -0,0 +1,79 @@
+import numpy as np
+import folium
+from route_classify import CONDITION_EDGES, condition_codes
+from route_lod import simplify_runs, reindex_runs
+from stage_timing import stage
+
+def prepare_route(df):
+    # Drop rows with missing lat/lon and sort by time
+    with stage('prepare_route', rows=len(df)):
+        return df.dropna(subset=['latitude', 'longitude']).sort_values('time')
+
+def segment_runs(codes):
+    # codes[i] colors the segment from point i to point i + 1, so the last code is unused.
+    # Returns (starts, stops): run k covers points starts[k]..stops[k] inclusive.
+    # A 2D codes array (points x attributes) splits wherever any attribute changes.
+    codes = np.asarray(codes)
+    seg = codes[:-1]
+    if len(seg) == 0:
+        empty = np.zeros(0, dtype=np.intp)
+        return empty, empty
+    changed = seg[1:] != seg[:-1]
+    if changed.ndim > 1:
+        changed = changed.any(axis=1)
+    breaks = np.flatnonzero(changed) + 1
+    starts = np.concatenate(([0], breaks))
+    stops = np.concatenate((breaks, [len(seg)]))
+    return starts, stops
+
+def route_runs(df, value_column, edges=CONDITION_EDGES):
+    df = prepare_route(df)
+    values = df[value_column].to_numpy(dtype=float)
+    starts, stops = segment_runs(condition_codes(values, edges))
+    return df, values, starts, stops
+
+def route_run_lines(df, value_column, scale, popup_for=None, merge_colors=False, tolerance=0.0):
+    # PolyLine arguments for one line per same-color run instead of one per pair of fixes.
+    # Runs are colored from their first values by the ConditionScale (every value in a
+    # run shares its bucket); popup_for(df, values, start, stop) builds the run's popup.
+    # With merge_colors, all runs of a color become one multi-polyline without popups.
+    # A tolerance (meters) simplifies each run's geometry, keeping every color change.
+    # The result is plain data, so it can be built in another process.
+    df, values, starts, stops = route_runs(df, value_column, scale.edges)
+    colors = scale.colors(values[starts])
+    with stage('simplify_runs', rows=len(starts)):
+        coords = df[['latitude', 'longitude']].to_numpy(dtype=float)
+        keep = simplify_runs(coords[:, 0], coords[:, 1], starts, stops, tolerance)
+        point_starts, point_stops = reindex_runs(keep, starts, stops)
+        coords = coords[keep].tolist()
+
+    if merge_colors:
+        by_color = {}
+        for color, first, last in zip(colors, point_starts, point_stops):
+            by_color.setdefault(color, []).append(coords[first:last + 1])
+        return [{'locations': lines, 'color': color, 'popup': None} for color, lines in by_color.items()]
+
+    return [
+        {
+            'locations': coords[first:last + 1],
+            'color': color,
+            'popup': popup_for(df, values, start, stop) if popup_for else None,
+        }
+        for color, start, stop, first, last in zip(colors, starts, stops, point_starts, point_stops)
+    ]
+
+def add_run_lines(feature_group, lines):
+    with stage('polylines', rows=len(lines)):
+        for line in lines:
+            folium.PolyLine(
+                locations=line['locations'],
+                color=line['color'],
+                weight=7,
+                opacity=0.7,
+                popup=line['popup']
+            ).add_to(feature_group)
+    return feature_group
+
+def add_route_runs(feature_group, df, value_column, scale, popup_for=None, merge_colors=False, tolerance=0.0):
+    lines = route_run_lines(df, value_column, scale, popup_for, merge_colors, tolerance)
+    return add_run_lines(feature_group, lines)
@@ -0,0 +1,205 @@
+import numpy as np
+from route_geo import local_xy
+from route_segments import prepare_route
+
+CELL_SIZE_M = 5.0
+# Segments longer than this are GPS gaps, not road, and are skipped by nearest_segment
+MAX_SEGMENT_M = 100.0
+STAT_COLUMNS = ('traffic_congestion', 'road_condition')
+
+def ranges_to_indices(starts, stops):
+    # Concatenation of arange(start, stop) for every pair, without a Python loop
+    lengths = stops - starts
+    total = int(lengths.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.intp)
+    offsets = np.repeat(starts - np.concatenate(([0], np.cumsum(lengths)[:-1])), lengths)
+    return offsets + np.arange(total)
+
+def point_segment_distance(px, py, ax, ay, bx, by):
+    dx, dy = bx - ax, by - ay
+    length2 = dx * dx + dy * dy
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = np.where(length2 > 0, ((px - ax) * dx + (py - ay) * dy) / length2, 0.0)
+    t = np.clip(t, 0, 1)
+    return np.hypot(px - (ax + t * dx), py - (ay + t * dy))
+
+def summarize(rows, columns=STAT_COLUMNS):
+    # count/mean/min/max of the condition columns for a set of rows
+    stats = {'count': len(rows)}
+    for column in columns:
+        if column in rows:
+            values = rows[column].to_numpy(dtype=float)
+            stats[column] = {
+                'mean': float(np.nanmean(values)) if len(values) else np.nan,
+                'min': float(np.nanmin(values)) if len(values) else np.nan,
+                'max': float(np.nanmax(values)) if len(values) else np.nan,
+            }
+    return stats
+
+class GridBuckets:
+    # Items (points, or segments by their midpoint) bucketed into a uniform grid. Items
+    # are sorted by cell and each occupied cell stores its offset range, so a query only
+    # touches the cells it overlaps. pad is how far an item reaches past its bucket
+    # point (half a segment's length), and is kept per cell as a maximum.
+
+    def __init__(self, x, y, cell_size, pad=None):
+        self.cell_size = cell_size
+        cx, cy = self.cell(x, y)
+        cell_ids = self.cell_id(cx, cy)
+        self.order = np.argsort(cell_ids, kind='stable')
+        sorted_ids = cell_ids[self.order]
+        self.cells, self.starts = np.unique(sorted_ids, return_index=True)
+        self.stops = np.append(self.starts[1:], len(sorted_ids))
+        self.cell_x = (self.cells >> 32) - (1 << 31)
+        self.cell_y = (self.cells & 0xFFFFFFFF) - (1 << 31)
+        self.pad = np.zeros(len(self.cells))
+        if pad is not None and len(self.cells):
+            self.pad = np.maximum.reduceat(np.asarray(pad, dtype=float)[self.order], self.starts)
+
+    def cell(self, x, y):
+        return (np.floor(np.asarray(x) / self.cell_size).astype(np.int64),
+                np.floor(np.asarray(y) / self.cell_size).astype(np.int64))
+
+    def cell_id(self, cx, cy):
+        # Both cell coordinates packed into one sortable int64
+        return ((cx + (1 << 31)) << 32) | (cy + (1 << 31))
+
+    def members(self, hit):
+        return self.order[ranges_to_indices(self.starts[hit], self.stops[hit])]
+
+    def in_box(self, xmin, xmax, ymin, ymax):
+        # Items in the cells overlapping the box (cells grown by their pad)
+        reach = float(self.pad.max()) if len(self.pad) else 0.0
+        (cx0, cx1), (cy0, cy1) = self.cell([xmin - reach, xmax + reach], [ymin - reach, ymax + reach])
+        if (cx1 - cx0 + 1) * (cy1 - cy0 + 1) > len(self.cells):
+            hit = np.flatnonzero((self.cell_x >= cx0) & (self.cell_x <= cx1) &
+                                 (self.cell_y >= cy0) & (self.cell_y <= cy1))
+        else:
+            gx, gy = np.meshgrid(np.arange(cx0, cx1 + 1), np.arange(cy0, cy1 + 1))
+            wanted = self.cell_id(gx.ravel(), gy.ravel())
+            pos = np.searchsorted(self.cells, wanted)
+            found = pos < len(self.cells)
+            pos, wanted = pos[found], wanted[found]
+            hit = pos[self.cells[pos] == wanted]
+        return self.members(hit)
+
+    def nearest_within(self, qx, qy, item_x, item_y, distance_to=None, max_distance=None):
+        # Nearest item for many query points at once, looking only at the 3x3 cells
+        # around each query. distance_to(items, rows) gives the true distances from the
+        # query rows to the items (default: to the item points). Exact for every query
+        # whose nearest item is within max_distance (default cell_size) with its bucket
+        # point within cell_size; the rest get item -1 and distance inf.
+        qx, qy = np.asarray(qx, dtype=float), np.asarray(qy, dtype=float)
+        best = np.full(len(qx), -1, dtype=np.intp)
+        best_distance = np.full(len(qx), np.inf)
+        if not len(self.cells):
+            return best, best_distance
+        cx, cy = self.cell(qx, qy)
+        for ox in (-1, 0, 1):
+            for oy in (-1, 0, 1):
+                wanted = self.cell_id(cx + ox, cy + oy)
+                pos = np.minimum(np.searchsorted(self.cells, wanted), len(self.cells) - 1)
+                found = self.cells[pos] == wanted
+                starts = np.where(found, self.starts[pos], 0)
+                counts = np.where(found, self.stops[pos] - self.starts[pos], 0)
+                for k in range(int(counts.max())):
+                    rows = np.flatnonzero(counts > k)
+                    items = self.order[starts[rows] + k]
+                    if distance_to is None:
+                        distance = np.hypot(item_x[items] - qx[rows], item_y[items] - qy[rows])
+                    else:
+                        distance = distance_to(items, rows)
+                    better = distance < best_distance[rows]
+                    best[rows[better]] = items[better]
+                    best_distance[rows[better]] = distance[better]
+        outside = best_distance > (self.cell_size if max_distance is None else max_distance)
+        best[outside] = -1
+        best_distance[outside] = np.inf
+        return best, best_distance
+
+    def nearest(self, x, y, distance_to):
+        # Exact nearest item: distance_to(items) gives true distances. Every cell gets a
+        # lower bound (distance to its rectangle minus its pad); the closest cell's items
+        # give an upper bound, and only cells whose lower bound is below it are checked.
+        if not len(self.cells):
+            return None, np.inf
+        x0 = self.cell_x * self.cell_size
+        y0 = self.cell_y * self.cell_size
+        dx = np.maximum(np.maximum(x0 - x, x - (x0 + self.cell_size)), 0)
+        dy = np.maximum(np.maximum(y0 - y, y - (y0 + self.cell_size)), 0)
+        lower = np.hypot(dx, dy) - self.pad
+        first = self.members([int(np.argmin(lower))])
+        upper = distance_to(first).min()
+        items = self.members(np.flatnonzero(lower <= upper))
+        distance = distance_to(items)
+        best = int(np.argmin(distance))
+        return int(items[best]), float(distance[best])
+
+class RouteSpatialIndex:
+    # Grid indexes over one route's fixes and drawn segments in local meters. Fixes keep
+    # the time order used for drawing, so fix i and i + 1 form the segment drawn between
+    # them; segments longer than MAX_SEGMENT_M are GPS gaps and are not indexed.
+
+    def __init__(self, df, cell_size=CELL_SIZE_M):
+        self.df = prepare_route(df)
+        lat = self.df['latitude'].to_numpy(dtype=float)
+        lon = self.df['longitude'].to_numpy(dtype=float)
+        self.lat0 = float(np.mean(lat)) if len(lat) else 0.0
+        self.x, self.y = local_xy(lat, lon, self.lat0)
+        self.points = GridBuckets(self.x, self.y, cell_size)
+
+        length = np.hypot(np.diff(self.x), np.diff(self.y))
+        self.segment_starts = np.flatnonzero(length <= MAX_SEGMENT_M)
+        a, b = self.segment_starts, self.segment_starts + 1
+        self.segments = GridBuckets((self.x[a] + self.x[b]) / 2, (self.y[a] + self.y[b]) / 2,
+                                    cell_size, pad=length[a] / 2)
+
+    def _project(self, lat, lon):
+        x, y = local_xy(lat, lon, self.lat0)
+        return float(x), float(y)
+
+    def _within(self, x, y, radius):
+        candidates = self.points.in_box(x - radius, x + radius, y - radius, y + radius)
+        distance = np.hypot(self.x[candidates] - x, self.y[candidates] - y)
+        inside = distance <= radius
+        return candidates[inside], distance[inside]
+
+    def radius(self, lat, lon, radius_m):
+        # Fixes within radius_m of the point, in time order
+        x, y = self._project(lat, lon)
+        positions, _ = self._within(x, y, radius_m)
+        return self.df.iloc[np.sort(positions)]
+
+    def bbox(self, south, west, north, east):
+        (xmin, xmax), (ymin, ymax) = local_xy([south, north], [west, east], self.lat0)
+        candidates = self.points.in_box(xmin, xmax, ymin, ymax)
+        inside = ((self.x[candidates] >= xmin) & (self.x[candidates] <= xmax) &
+                  (self.y[candidates] >= ymin) & (self.y[candidates] <= ymax))
+        return self.df.iloc[np.sort(candidates[inside])]
+
+    def nearest(self, lat, lon):
+        # (position, distance in meters) of the closest fix
+        x, y = self._project(lat, lon)
+        return self.points.nearest(x, y, lambda items: np.hypot(self.x[items] - x, self.y[items] - y))
+
+    def nearest_segment(self, lat, lon):
+        # (start position, distance in meters) of the closest drawn segment
+        x, y = self._project(lat, lon)
+
+        def distance_to(items):
+            a = self.segment_starts[items]
+            return point_segment_distance(x, y, self.x[a], self.y[a], self.x[a + 1], self.y[a + 1])
+
+        item, distance = self.segments.nearest(x, y, distance_to)
+        return (None, distance) if item is None else (int(self.segment_starts[item]), distance)
+
+    def condition_at(self, lat, lon, radius_m=50.0):
+        # Stats of the nearest segment and of every fix within radius_m of the point
+        start, distance = self.nearest_segment(lat, lon)
+        nearby = self.radius(lat, lon, radius_m)
+        return {
+            'segment': None if start is None else self.df.iloc[start],
+            'segment_distance_m': distance,
+            'nearby': summarize(nearby),
+        }
@@ -0,0 +1,270 @@
+import argparse
+import json
+import os
+import tempfile
+import folium
+import numpy as np
+import pandas as pd
+import all_routes_traffichourfilter
+from build_maps import add_controls, render_html
+from route_classify import TRAFFIC
+from route_loader import HISTORY_PREFIX, STATIONARY_PREFIX
+from route_time_index import SECONDS_PER_HOUR, est_time_seconds
+from stage_timing import add_profile_arguments, profiling, stage
+
+# Out-of-core version of the traffic runs map, for routes that do not fit in memory.
+# Nothing ever holds a whole route or the whole page:
+#   1. the source is read in chunks of CHUNK_ROWS, each sorted by time and written to a
+#      temporary directory as one raw file per column;
+#   2. the sorted chunks are merged block by block (every round takes the rows of each
+#      chunk up to the earliest last time among the chunks' next blocks, so whatever is
+#      emitted precedes all rows still on disk);
+#   3. the merged blocks are cut into same-colored runs, exactly as route_run_lines cuts
+#      a whole route, and written into the page as they come, as <script> blocks at the
+#      end of the body. folium's own script follows </body>, so the blocks only queue
+#      their runs, which are drawn once the page is parsed and the layers exist. Each
+#      run's popup is attached when the run ends, so a run spanning many blocks is drawn
+#      as several lines sharing one popup.
+# The page skeleton (map, controls and the variant's CSS and JavaScript) comes from
+# build_maps and is tiny, so peak memory depends on CHUNK_ROWS and BLOCK_ROWS only.
+#
+# This is a separate command: build_maps loads every route whole and never calls it.
+# Use it for a route too large for that; its page has one route layer per source and
+# none of build_maps' layer cache, hour bundle or compact output.
+#
+#   python route_stream.py traffic_stream.html "Blue Route=real_data/blue_traffic.csv" --hour 8
+CHUNK_ROWS = 500_000
+BLOCK_ROWS = 200_000
+# Rows read from each sorted chunk per merge round, at least
+MIN_STEP_ROWS = 1024
+VALUE_COLUMN = 'traffic_congestion'
+COLUMNS = {'time': np.float64, 'latitude': np.float64, 'longitude': np.float64, 'value': np.float64,
+           'est_seconds': np.int32}
+
+add_pieces_js = """
+<script>
+var openRunLines = [];
+var queuedRunPieces = [];
+function addRunPieces(layerName, pieces) {
+    queuedRunPieces.push([layerName, pieces]);
+}
+function drawRunPieces(layer, pieces) {
+    // piece: [color, [[lat, lon], ...] or null, popup text when the run ends here or null]
+    pieces.forEach(function(piece) {
+        if (piece[1] !== null) {
+            openRunLines.push(L.polyline(piece[1], {color: piece[0], weight: 7, opacity: 0.7}).addTo(layer));
+        }
+        if (piece[2] !== null) {
+            openRunLines.forEach(function(line) { line.bindPopup(piece[2]); });
+            openRunLines = [];
+        }
+    });
+}
+// The map and its layers are created by folium's script after the body
+document.addEventListener("DOMContentLoaded", function() {
+    queuedRunPieces.forEach(function(entry) { drawRunPieces(window[entry[0]], entry[1]); });
+    queuedRunPieces = [];
+});
+</script>
+"""
+
+def source_chunks(source, chunk_rows, value_column=VALUE_COLUMN):
+    # The source's rows, chunk_rows at a time, with only the columns the map needs
+    if source.startswith(STATIONARY_PREFIX):
+        raise ValueError("stationary sources need a whole route in memory and cannot be streamed")
+    columns = ['time', 'latitude', 'longitude', 'est_time', value_column]
+    if source.startswith(HISTORY_PREFIX):
+        from history_store import parse_source
+        store, route, start, end = parse_source(source)
+        for frame in store.iter_query(route, start, end, columns=columns):
+            for offset in range(0, len(frame), chunk_rows):
+                yield frame.iloc[offset:offset + chunk_rows]
+    else:
+        yield from pd.read_csv(source, usecols=columns, chunksize=chunk_rows)
+
+def write_sorted_chunks(chunks, run_root, hour=None, value_column=VALUE_COLUMN):
+    # Sorts each chunk by time into its own directory of raw columns; returns the
+    # directories and the mean position of the rows kept
+    run_dirs = []
+    lat_sum = lon_sum = 0.0
+    rows = 0
+    for chunk in chunks:
+        with stage('stream_sort_chunk', rows=len(chunk)):
+            seconds = chunk['est_seconds'].to_numpy() if 'est_seconds' in chunk else est_time_seconds(chunk['est_time'])
+            columns = {
+                'time': chunk['time'].to_numpy(dtype=float),
+                'latitude': chunk['latitude'].to_numpy(dtype=float),
+                'longitude': chunk['longitude'].to_numpy(dtype=float),
+                'value': chunk[value_column].to_numpy(dtype=float),
+                'est_seconds': np.asarray(seconds, dtype=np.int32),
+            }
+            keep = ~(np.isnan(columns['latitude']) | np.isnan(columns['longitude']))
+            if hour is not None:
+                keep &= columns['est_seconds'] // SECONDS_PER_HOUR == hour
+            # Rows without a time sort last, as in prepare_route
+            columns['time'] = np.where(np.isnan(columns['time']), np.inf, columns['time'])
+            order = np.flatnonzero(keep)[np.argsort(columns['time'][keep], kind='stable')]
+            if not len(order):
+                continue
+            run_dir = os.path.join(run_root, f"chunk-{len(run_dirs):05d}")
+            os.makedirs(run_dir)
+            for name, dtype in COLUMNS.items():
+                columns[name][order].astype(dtype).tofile(os.path.join(run_dir, name))
+            run_dirs.append(run_dir)
+            lat_sum += columns['latitude'][order].sum()
+            lon_sum += columns['longitude'][order].sum()
+            rows += len(order)
+    center = [lat_sum / rows, lon_sum / rows] if rows else None
+    return run_dirs, center
+
+class SortedChunk:
+    # Reads one sorted chunk's columns a slice at a time, without mapping the files
+
+    def __init__(self, run_dir):
+        self.run_dir = run_dir
+        self.rows = os.path.getsize(os.path.join(run_dir, 'time')) // np.dtype(COLUMNS['time']).itemsize
+        self.position = 0
+
+    def read(self, name, start, stop):
+        dtype = np.dtype(COLUMNS[name])
+        return np.fromfile(os.path.join(self.run_dir, name), dtype=dtype, count=stop - start,
+                           offset=start * dtype.itemsize)
+
+def merge_sorted_chunks(run_dirs, block_rows=BLOCK_ROWS):
+    # Yields the rows of every chunk in time order, as dicts of column arrays of at most
+    # about block_rows rows
+    chunks = [SortedChunk(run_dir) for run_dir in run_dirs]
+    step = max(block_rows // max(len(chunks), 1), MIN_STEP_ROWS)
+    while True:
+        live = [chunk for chunk in chunks if chunk.position < chunk.rows]
+        if not live:
+            return
+        times = [chunk.read('time', chunk.position, min(chunk.position + step, chunk.rows)) for chunk in live]
+        # Rows up to the earliest last time of a block that is not its chunk's end are safe to emit
+        bound = min((block[-1] for chunk, block in zip(live, times) if chunk.position + len(block) < chunk.rows),
+                    default=np.inf)
+        pieces = []
+        for chunk, block in zip(live, times):
+            take = int(np.searchsorted(block, bound, side='right'))
+            if take:
+                start, stop = chunk.position, chunk.position + take
+                pieces.append({name: block[:take] if name == 'time' else chunk.read(name, start, stop)
+                               for name in COLUMNS})
+                chunk.position = stop
+        merged = {name: np.concatenate([piece[name] for piece in pieces]) for name in COLUMNS}
+        order = np.argsort(merged['time'], kind='stable')
+        yield {name: values[order] for name, values in merged.items()}
+
+def format_est(seconds):
+    # Seconds of day as the est_time strings the popups show; 'nan' where unparsed
+    return ['nan' if s < 0 else f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds.tolist()]
+
+class RunWriter:
+    # Cuts a stream of time-ordered blocks into same-colored runs (segment i, from point i
+    # to i + 1, takes the color of point i) and returns them as addRunPieces records
+
+    def __init__(self, route_name, scale=TRAFFIC):
+        self.route_name = route_name
+        self.scale = scale
+        # Last point of the previous block, which starts this block's first segment
+        self.carry = None
+        # (code, start est_seconds, start value) of the run still open
+        self.run = None
+
+    def popup(self, stop_seconds):
+        code, start_seconds, value = self.run
+        start, stop = format_est(np.array([start_seconds, stop_seconds]))
+        return f"{self.route_name}, {start} - {stop}, {self.scale.label(value)}"
+
+    def pieces(self, block):
+        if self.carry is not None:
+            block = {name: np.concatenate(([self.carry[name]], block[name])) for name in COLUMNS}
+        rows = len(block['time'])
+        if not rows:
+            return []
+        self.carry = {name: block[name][-1] for name in COLUMNS}
+        if rows < 2:
+            return []
+        codes = self.scale.codes(block['value'][:-1])
+        previous = np.concatenate(([codes[0] if self.run is None else self.run[0]], codes[:-1]))
+        breaks = np.flatnonzero(codes != previous).tolist()
+        if self.run is None:
+            self.run = (codes[0], block['est_seconds'][0], block['value'][0])
+        coords = np.column_stack((block['latitude'], block['longitude']))
+        colors = self.scale.colors(block['value'][:-1])
+        pieces = []
+        starts = [0] + [b for b in breaks if b > 0]
+        stops = [b for b in breaks if b > 0] + [rows - 1]
+        if breaks and breaks[0] == 0:
+            # The open run ended on the carried point
+            pieces.append([None, None, self.popup(block['est_seconds'][0])])
+            self.run = (codes[0], block['est_seconds'][0], block['value'][0])
+        for start, stop in zip(starts, stops):
+            ends = stop < rows - 1
+            pieces.append([colors[start], coords[start:stop + 1].tolist(),
+                           self.popup(block['est_seconds'][stop]) if ends else None])
+            if ends:
+                self.run = (codes[stop], block['est_seconds'][stop], block['value'][stop])
+        return pieces
+
+    def close(self):
+        # Ends the last run at the route's last point
+        if self.run is None:
+            return []
+        pieces = [[None, None, self.popup(self.carry['est_seconds'])]]
+        self.run = None
+        return pieces
+
+def write_pieces(file, layer_name, pieces):
+    if pieces:
+        file.write(f"<script>addRunPieces({json.dumps(layer_name)}, {json.dumps(pieces, separators=(',', ':'))});</script>\n")
+
+def render_streamed(routes, output_path, hour=None, chunk_rows=CHUNK_ROWS, block_rows=BLOCK_ROWS, work_dir=None,
+                    module=all_routes_traffichourfilter):
+    # routes: {route name: source}. Writes the map to output_path and returns its size in bytes.
+    with tempfile.TemporaryDirectory(prefix='busmap_stream_', dir=work_dir) as run_root:
+        sorted_routes = []
+        for i, (route_name, source) in enumerate(routes.items()):
+            run_dirs, center = write_sorted_chunks(source_chunks(source, chunk_rows),
+                                                   os.path.join(run_root, str(i)), hour)
+            sorted_routes.append((route_name, run_dirs, center))
+        centers = [center for _, _, center in sorted_routes if center is not None]
+
+        map_ = folium.Map(location=list(np.mean(centers, axis=0)) if centers else [0, 0], zoom_start=16)
+        layers = [folium.FeatureGroup(name=route_name).add_to(map_) for route_name, _, _ in sorted_routes]
+        add_controls(map_)
+        html = render_html(map_, module, (), ('xor_js',))
+        head, tail = html.rsplit('</body>', 1)
+
+        with open(output_path, 'w', encoding='utf-8') as file:
+            file.write(head)
+            file.write(add_pieces_js)
+            for layer, (route_name, run_dirs, _) in zip(layers, sorted_routes):
+                writer = RunWriter(route_name)
+                for block in merge_sorted_chunks(run_dirs, block_rows):
+                    with stage('stream_runs', rows=len(block['time'])):
+                        write_pieces(file, layer.get_name(), writer.pieces(block))
+                write_pieces(file, layer.get_name(), writer.close())
+            file.write('</body>' + tail)
+    return os.path.getsize(output_path)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    add_profile_arguments(parser)
+    parser.add_argument('output', help="HTML file to write")
+    parser.add_argument('routes', nargs='+', metavar='NAME=SOURCE', help="route CSV or history store source")
+    parser.add_argument('--hour', type=int, help="draw only the fixes of this hour")
+    parser.add_argument('--chunk-rows', type=int, default=CHUNK_ROWS, help="rows sorted in memory at a time")
+    parser.add_argument('--block-rows', type=int, default=BLOCK_ROWS, help="rows merged and drawn at a time")
+    parser.add_argument('--work-dir', help="where the sorted chunks are kept while drawing (default: system temp)")
+    args = parser.parse_args(argv)
+    if any('=' not in arg for arg in args.routes):
+        parser.error("routes take NAME=SOURCE")
+
+    with profiling(args.profile, args.profile_sort):
+        size = render_streamed(dict(arg.split('=', 1) for arg in args.routes), args.output, args.hour,
+                               args.chunk_rows, args.block_rows, args.work_dir)
+    print(f"Wrote {args.output} ({size / 1e6:.1f} MB)")
+
+if __name__ == '__main__':
+    main()
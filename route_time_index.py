@@ -0,0 +1,37 @@
+import numpy as np
+import pandas as pd
+
+SECONDS_PER_HOUR = 3600
+
+def est_time_seconds(est_time):
+    # 'HH:MM:SS' strings to seconds of day, -1 where the time is missing or malformed
+    parsed = pd.to_datetime(pd.Series(est_time), format='%H:%M:%S', errors='coerce')
+    seconds = parsed.dt.hour * 3600 + parsed.dt.minute * 60 + parsed.dt.second
+    return seconds.fillna(-1).to_numpy(dtype=np.int32)
+
+class RouteTimeIndex:
+    # Rows of one route sorted by est_time, with the offset where each hour starts.
+    # Built once at load time; hour and window queries are binary searches that return
+    # positional slices of the sorted frame, so the source DataFrame is never touched.
+
+    def __init__(self, df):
+        if 'est_seconds' in df:
+            seconds = df['est_seconds'].to_numpy(dtype=np.int32)
+        else:
+            seconds = est_time_seconds(df['est_time'])
+        order = np.argsort(seconds, kind='stable')
+        self.df = df.iloc[order]
+        self.seconds = seconds[order]
+        # hour_offsets[h]:hour_offsets[h + 1] are the rows in hour h; unparsed times sort first
+        self.hour_offsets = np.searchsorted(self.seconds, np.arange(25) * SECONDS_PER_HOUR, side='left')
+
+    def __len__(self):
+        return len(self.df)
+
+    def hour(self, hour):
+        return self.df.iloc[self.hour_offsets[hour]:self.hour_offsets[hour + 1]]
+
+    def window(self, start, end):
+        # Rows with start <= est_time < end, both given in seconds of day
+        lo, hi = np.searchsorted(self.seconds, [start, end], side='left')
+        return self.df.iloc[lo:hi]
@@ -0,0 +1,203 @@
+import argparse
+import time
+import numpy as np
+import pandas as pd
+from ingest_sensors import STOP_SPEED
+from route_bins import RouteBins
+from route_geo import haversine_m
+from route_loader import load_route
+from route_segments import prepare_route
+from route_time_index import est_time_seconds
+from stage_timing import stage
+
+# Speeds, dwells and travel times from the route traces. route_kinematics derives, in one
+# vectorized pass over a route, each fix's distance and time from the previous fix, its
+# speed and the distance traveled so far; stretches slower than STOP_SPEED for at least
+# DWELL_MIN_S are dwells. RouteTravelTimes turns the kinematics into the historical
+# time to cross every route bin in every hour, kept as cumulative arrays, so the ETA
+# from one stop to another at some hour is two lookups and a subtraction.
+#
+#   python route_travel.py real_data/blue_traffic_mini.csv --stop "A=33.7765,-84.3988" --stop "B=33.7733,-84.3950"
+DWELL_MIN_S = 20.0
+# GPS noise alone moves a fix a few meters per second, so whether the bus is stopped is
+# judged from its displacement across this many fixes, centered on the fix
+STOP_WINDOW = 20
+# Consecutive fixes further apart than this (in time or along the route) are a gap in
+# the trace, not travel
+MAX_GAP_S = 60.0
+MAX_STEP_M = 200.0
+# A bin's traversal time is capped, so a bin where buses mostly wait cannot dominate
+MAX_BIN_S = 600.0
+HOURS = 24
+
+def route_kinematics(df):
+    # Per fix of the time-ordered trace: distance_m and dt_s from the previous fix,
+    # speed_mps over that step (NaN across gaps and repeated timestamps), along_trace_m
+    # traveled since the first fix, and whether the bus was stopped (slower than
+    # STOP_SPEED over the STOP_WINDOW fixes around it)
+    df = prepare_route(df)
+    with stage('kinematics', rows=len(df)):
+        lat = df['latitude'].to_numpy(dtype=float)
+        lon = df['longitude'].to_numpy(dtype=float)
+        seconds = df['time'].to_numpy(dtype=float)
+        distance = np.zeros(len(df))
+        dt = np.full(len(df), np.nan)
+        if len(df) > 1:
+            distance[1:] = haversine_m(lat[:-1], lon[:-1], lat[1:], lon[1:])
+            dt[1:] = np.diff(seconds)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            speed = np.where((dt > 0) & (dt <= MAX_GAP_S), distance / dt, np.nan)
+        stopped = np.zeros(len(df), dtype=bool)
+        half = STOP_WINDOW // 2
+        if len(df) > 2 * half:
+            displacement = haversine_m(lat[:-2 * half], lon[:-2 * half], lat[2 * half:], lon[2 * half:])
+            span = seconds[2 * half:] - seconds[:-2 * half]
+            with np.errstate(divide='ignore', invalid='ignore'):
+                stopped[half:len(df) - half] = (span > 0) & (span <= MAX_GAP_S * 2) & (displacement < STOP_SPEED * span)
+        return pd.DataFrame({
+            'latitude': lat,
+            'longitude': lon,
+            'time': seconds,
+            'est_seconds': df['est_seconds'].to_numpy() if 'est_seconds' in df else est_time_seconds(df['est_time']),
+            'distance_m': distance,
+            'dt_s': dt,
+            'speed_mps': speed,
+            'along_trace_m': np.cumsum(distance),
+            'stopped': stopped,
+        })
+
+def find_dwells(kinematics, min_seconds=DWELL_MIN_S):
+    # One row per dwell: first and last fix, duration, and mean position
+    stopped = kinematics['stopped'].to_numpy()
+    edges = np.diff(np.concatenate(([False], stopped, [False])).astype(np.int8))
+    starts = np.flatnonzero(edges == 1)
+    stops = np.flatnonzero(edges == -1) - 1
+    seconds = kinematics['time'].to_numpy()
+    duration = seconds[stops] - seconds[starts]
+    keep = duration >= min_seconds
+    starts, stops, duration = starts[keep], stops[keep], duration[keep]
+    if not len(starts):
+        return pd.DataFrame(columns=['start', 'stop', 'seconds', 'latitude', 'longitude'])
+    lengths = stops - starts + 1
+    csum_lat = np.concatenate(([0.0], np.cumsum(kinematics['latitude'].to_numpy())))
+    csum_lon = np.concatenate(([0.0], np.cumsum(kinematics['longitude'].to_numpy())))
+    lat = (csum_lat[stops + 1] - csum_lat[starts]) / lengths
+    lon = (csum_lon[stops + 1] - csum_lon[starts]) / lengths
+    return pd.DataFrame({'start': starts, 'stop': stops, 'seconds': duration, 'latitude': lat, 'longitude': lon})
+
+class RouteTravelTimes:
+    # seconds[h, k]: historical time to cross bin k in hour h; cumulative[h] sums them
+    # from the start of the reference line. Hours without data for a bin fall back to
+    # the bin over all hours, then to the route's mean speed.
+
+    def __init__(self, bins, kinematics):
+        self.bins = bins
+        self.stops = {}
+        with stage('travel_times', rows=len(kinematics)):
+            along, bin_index = bins.snap(kinematics['latitude'].to_numpy(), kinematics['longitude'].to_numpy())
+            # Each step between fixes counts toward the bin and hour it starts in
+            progress = np.diff(along)
+            # Crossing the end of the reference line continues from its start
+            progress = np.where(progress < -bins.length / 2, progress + bins.length, progress)
+            dt = kinematics['dt_s'].to_numpy()[1:]
+            hours = kinematics['est_seconds'].to_numpy()[:-1] // 3600
+            step_bins = bin_index[:-1]
+            valid = ((step_bins >= 0) & (bin_index[1:] >= 0) & (hours >= 0) & (dt > 0) & (dt <= MAX_GAP_S)
+                     & (np.abs(progress) <= MAX_STEP_M))
+            # GPS noise while waiting moves a bus back and forth; only forward progress counts
+            progress = np.clip(np.nan_to_num(progress), 0, None)
+            keys = hours[valid] * bins.n_bins + step_bins[valid]
+            size = HOURS * bins.n_bins
+            total_s = np.bincount(keys, weights=dt[valid], minlength=size).reshape(HOURS, bins.n_bins)
+            total_m = np.bincount(keys, weights=progress[valid], minlength=size).reshape(HOURS, bins.n_bins)
+
+            lengths = np.full(bins.n_bins, bins.bin_m)
+            lengths[-1] = bins.length - (bins.n_bins - 1) * bins.bin_m
+            route_speed = total_m.sum() / total_s.sum() if total_s.sum() > 0 else np.nan
+            with np.errstate(divide='ignore', invalid='ignore'):
+                seconds = lengths * total_s / total_m
+                overall = lengths * total_s.sum(axis=0) / total_m.sum(axis=0)
+            fallback = np.where(np.isfinite(overall), overall, lengths / route_speed if route_speed > 0 else np.nan)
+            seconds = np.where(np.isfinite(seconds), seconds, fallback)
+            self.seconds = np.minimum(seconds, MAX_BIN_S)
+            self.cumulative = np.concatenate((np.zeros((HOURS, 1)), np.cumsum(self.seconds, axis=1)), axis=1)
+            self.lap_seconds = self.cumulative[:, -1]
+
+    @classmethod
+    def from_route(cls, df, bins=None):
+        return cls(bins if bins is not None else RouteBins.from_route(df), route_kinematics(df))
+
+    def add_stop(self, name, lat, lon):
+        # Records a stop by its position along the route; raises if it is off-route
+        along, bin_index = self.bins.snap(np.array([lat]), np.array([lon]))
+        if bin_index[0] < 0:
+            raise ValueError(f"stop {name} is not on the route")
+        self.stops[name] = float(along[0])
+        return self.stops[name]
+
+    def seconds_to(self, along, hour):
+        # Time from the start of the reference line to `along` meters, in hour `hour`
+        position = along / self.bins.bin_m
+        k = min(int(position), self.bins.n_bins - 1)
+        length = self.bins.length - k * self.bins.bin_m if k == self.bins.n_bins - 1 else self.bins.bin_m
+        fraction = (along - k * self.bins.bin_m) / length
+        return self.cumulative[hour, k] + fraction * self.seconds[hour, k]
+
+    def eta_between(self, from_along, to_along, hour):
+        # Seconds to travel forward from one position to another; a destination behind
+        # the origin is reached by going once around the route
+        travel = self.seconds_to(to_along, hour) - self.seconds_to(from_along, hour)
+        return float(travel if to_along >= from_along else travel + self.lap_seconds[hour])
+
+    def eta(self, from_stop, to_stop, hour):
+        return self.eta_between(self.stops[from_stop], self.stops[to_stop], hour)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('source', help="route CSV or history store source")
+    parser.add_argument('--stop', action='append', default=[], metavar='NAME=LAT,LON',
+                        help="stop to include in the ETA table (repeatable); default: the longest dwells")
+    parser.add_argument('--hours', type=int, nargs='*', default=[8, 12, 17], choices=range(24), metavar='HOUR')
+    parser.add_argument('--dwell-stops', type=int, default=4, help="longest dwells used as stops without --stop")
+    args = parser.parse_args(argv)
+
+    df = load_route(args.source)
+    kinematics = route_kinematics(df)
+    if kinematics.empty:
+        parser.error(f"{args.source} has no fixes with a position")
+    try:
+        bins = RouteBins.from_route(df)
+    except ValueError as error:
+        parser.error(f"{args.source}: {error}")
+    travel = RouteTravelTimes(bins, kinematics)
+    if args.stop:
+        for arg in args.stop:
+            name, _, position = arg.partition('=')
+            lat, lon = (float(value) for value in position.split(','))
+            travel.add_stop(name, lat, lon)
+    else:
+        dwells = find_dwells(kinematics).sort_values('seconds', ascending=False)
+        for i, dwell in enumerate(dwells.head(args.dwell_stops).itertuples()):
+            try:
+                travel.add_stop(f"dwell {i + 1}", dwell.latitude, dwell.longitude)
+            except ValueError:
+                pass
+
+    speeds = kinematics['speed_mps']
+    print(f"{len(kinematics)} fixes, {kinematics['along_trace_m'].iat[-1] / 1000:.1f} km, "
+          f"median moving speed {speeds[~kinematics['stopped']].median():.1f} m/s, "
+          f"{len(find_dwells(kinematics))} dwells of {DWELL_MIN_S:.0f} s or more")
+    names = sorted(travel.stops, key=travel.stops.get)
+    for hour in args.hours:
+        print(f"\nHour {hour}:00, lap {travel.lap_seconds[hour] / 60:.1f} min")
+        for a in names:
+            print(f"  {a:>10}: " + "  ".join(f"{b} {travel.eta(a, b, hour) / 60:5.1f} min" for b in names if b != a))
+    if names and args.hours:
+        repeat = 100_000
+        started = time.perf_counter()
+        for _ in range(repeat):
+            travel.eta(names[0], names[-1], args.hours[0])
+        print(f"\n{1e6 * (time.perf_counter() - started) / repeat:.1f} us per ETA query")
+
+if __name__ == '__main__':
+    main()
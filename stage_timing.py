@@ -0,0 +1,204 @@
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+from contextlib import contextmanager
+
+# Named-stage timing for the map scripts and the app. Code marks its stages with
+#   with stage('read_csv', rows=len(df)) as s:
+#       ...
+#       s.output_bytes = size
+# which costs one attribute lookup when profiling is off. Turn it on with
+# BUSMAP_PROFILE=1 (or =path/to/report.json) or a script's --profile [PATH]; each stage
+# then records wall and CPU time, rows, allocated/peak memory (tracemalloc, unless
+# BUSMAP_PROFILE_MEMORY=0) and output bytes. Nested stages are named parent/child.
+ENV_VAR = 'BUSMAP_PROFILE'
+MEMORY_ENV_VAR = 'BUSMAP_PROFILE_MEMORY'
+DEFAULT_REPORT = 'busmap_profile.json'
+SUMMARY_COLUMNS = ('wall_s', 'cpu_s', 'calls', 'rows', 'alloc_bytes', 'peak_bytes', 'output_bytes')
+
+_local = threading.local()
+
+class _NullStage:
+    # Stands in for a Stage when profiling is off; ignores whatever is recorded on it
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+NULL_STAGE = _NullStage()
+
+class Stage:
+    __slots__ = ('timer', 'name', 'rows', 'output_bytes', '_wall', '_cpu', '_memory', '_peak')
+
+    def __init__(self, timer, name, rows=None):
+        self.timer = timer
+        self.name = name
+        self.rows = rows
+        self.output_bytes = None
+
+    def __enter__(self):
+        timer = self.timer
+        if timer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            if timer.stack:
+                parent = timer.stack[-1]
+                parent._peak = max(parent._peak, peak)
+            tracemalloc.reset_peak()
+            self._memory = self._peak = current
+        timer.stack.append(self)
+        self._cpu = time.process_time()
+        self._wall = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        wall = time.perf_counter() - self._wall
+        cpu = time.process_time() - self._cpu
+        timer = self.timer
+        timer.stack.pop()
+        record = {
+            'name': '/'.join([parent.name for parent in timer.stack] + [self.name]),
+            'wall_s': wall,
+            'cpu_s': cpu,
+            'rows': self.rows,
+            'output_bytes': self.output_bytes,
+        }
+        if timer.memory:
+            current, peak = tracemalloc.get_traced_memory()
+            self._peak = max(self._peak, peak)
+            record['alloc_bytes'] = current - self._memory
+            record['peak_bytes'] = self._peak - self._memory
+            if timer.stack:
+                parent = timer.stack[-1]
+                parent._peak = max(parent._peak, self._peak)
+            tracemalloc.reset_peak()
+        timer.records.append(record)
+        return False
+
+class StageTimer:
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.stack = []
+        self.records = []
+        self.owns_tracing = False
+        self.started = time.perf_counter()
+
+    def stage(self, name, rows=None):
+        return Stage(self, name, rows)
+
+    def extend(self, records):
+        # Records from another process (e.g. a build worker), nested under the open stages
+        prefix = ''.join(parent.name + '/' for parent in self.stack)
+        self.records.extend(dict(record, name=prefix + record['name']) for record in records)
+
+    def summary(self, sort_by='wall_s'):
+        # One row per stage name, totals over its calls; peak_bytes is the largest peak
+        rows = {}
+        for record in self.records:
+            row = rows.setdefault(record['name'], {'name': record['name'], 'calls': 0, 'wall_s': 0.0, 'cpu_s': 0.0,
+                                                   'rows': None, 'alloc_bytes': None, 'peak_bytes': None,
+                                                   'output_bytes': None})
+            row['calls'] += 1
+            row['wall_s'] += record['wall_s']
+            row['cpu_s'] += record['cpu_s']
+            for key in ('rows', 'alloc_bytes', 'output_bytes'):
+                if record.get(key) is not None:
+                    row[key] = (row[key] or 0) + record[key]
+            if record.get('peak_bytes') is not None:
+                row['peak_bytes'] = max(row['peak_bytes'] or 0, record['peak_bytes'])
+        if sort_by == 'name':
+            return sorted(rows.values(), key=lambda row: row['name'])
+        return sorted(rows.values(), key=lambda row: row[sort_by] or 0, reverse=True)
+
+    def report(self, sort_by='wall_s'):
+        return {
+            'total_wall_s': time.perf_counter() - self.started,
+            'memory': self.memory,
+            'summary': self.summary(sort_by),
+            'stages': self.records,
+        }
+
+    def summary_table(self, sort_by='wall_s'):
+        summary = self.summary(sort_by)
+        width = max([len(row['name']) for row in summary] + [5]) + 2
+        lines = [f"{'stage':<{width}}{'calls':>7}{'wall s':>10}{'cpu s':>10}{'rows':>12}"
+                 f"{'alloc MB':>10}{'peak MB':>10}{'out KB':>10}"]
+
+        def number(value, scale=1, digits=0):
+            return '' if value is None else f"{value / scale:,.{digits}f}"
+
+        for row in summary:
+            lines.append(f"{row['name']:<{width}}{row['calls']:>7}{row['wall_s']:>10.3f}{row['cpu_s']:>10.3f}"
+                         f"{number(row['rows']):>12}{number(row['alloc_bytes'], 2 ** 20, 1):>10}"
+                         f"{number(row['peak_bytes'], 2 ** 20, 1):>10}{number(row['output_bytes'], 1024):>10}")
+        return "\n".join(lines)
+
+    def write_report(self, path, sort_by='wall_s'):
+        with open(path, 'w') as file:
+            json.dump(self.report(sort_by), file, indent=2)
+            file.write("\n")
+
+def active():
+    # The timer collecting stages in this thread, or None when profiling is off
+    return getattr(_local, 'timer', None)
+
+def stage(name, rows=None):
+    timer = getattr(_local, 'timer', None)
+    return NULL_STAGE if timer is None else Stage(timer, name, rows)
+
+def start(memory=None):
+    if memory is None:
+        memory = os.environ.get(MEMORY_ENV_VAR, '1') != '0'
+    timer = StageTimer(memory)
+    if memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+        timer.owns_tracing = True
+    _local.timer = timer
+    return timer
+
+def stop():
+    timer = getattr(_local, 'timer', None)
+    _local.timer = None
+    if timer is not None and timer.owns_tracing:
+        tracemalloc.stop()
+    return timer
+
+def report_path(cli_value=None):
+    # Where to write the report, or None when profiling is off: the --profile value,
+    # else BUSMAP_PROFILE (a path, or 1 for the default report file)
+    if cli_value:
+        return cli_value
+    value = os.environ.get(ENV_VAR, '')
+    if value in ('', '0'):
+        return None
+    return DEFAULT_REPORT if value == '1' else value
+
+@contextmanager
+def profiling(cli_value=None, sort_by='wall_s'):
+    # Profiles the block when enabled, then writes the JSON report and prints the
+    # summary table to stderr
+    path = report_path(cli_value)
+    if path is None:
+        yield None
+        return
+    timer = start()
+    try:
+        yield timer
+    finally:
+        stop()
+        timer.write_report(path, sort_by)
+        print(timer.summary_table(sort_by), file=sys.stderr)
+        print(f"Profile written to {path}", file=sys.stderr)
+
+def add_profile_arguments(parser):
+    parser.add_argument('--profile', nargs='?', const=DEFAULT_REPORT, default=None, metavar='PATH',
+                        help=f"time each build stage and write a JSON report (default path: {DEFAULT_REPORT})")
+    parser.add_argument('--profile-sort', default='wall_s', choices=('name',) + SUMMARY_COLUMNS,
+                        help="column the profile summary table is sorted by")
+    return parser
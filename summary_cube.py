@@ -0,0 +1,239 @@
+import argparse
+import os
+import numpy as np
+import pandas as pd
+from history_store import TIMEZONE, HistoryStore, read_part
+from route_loader import load_route, route_version
+from route_time_index import est_time_seconds
+from stage_timing import stage
+
+# Count, sum, min, max and a quantile sketch of one score column per (route, weekday,
+# hour) cell. The scores are bounded (0-5), so the sketch is a histogram of
+# SKETCH_BINS_PER_UNIT bins per unit: two cubes merge by adding arrays, and any
+# percentile of any set of cells is read off their summed histogram, to within half a
+# bin, without touching a raw row. Cubes are updated in place as frames (or new history
+# store parts) arrive, and saved as .npz.
+#
+#   python summary_cube.py cube.npz --history history
+#   python summary_cube.py cube.npz --route "Blue Route=real_data/blue_traffic_mini.csv"
+MAX_VALUE = 5.0
+SKETCH_BINS_PER_UNIT = 100
+# Weekday 0 is Monday; rows without a Unix time go in the last slot
+WEEKDAYS = 8
+UNKNOWN_WEEKDAY = 7
+HOURS = 24
+QUANTILES = (0.5, 0.9, 0.99)
+
+def weekdays_of(unix_seconds):
+    # Local weekday of each Unix time, UNKNOWN_WEEKDAY where it is missing
+    times = pd.to_datetime(pd.Series(unix_seconds), unit='s', utc=True).dt.tz_convert(TIMEZONE)
+    return times.dt.weekday.fillna(UNKNOWN_WEEKDAY).to_numpy(dtype=np.int64)
+
+class SummaryCube:
+
+    def __init__(self, value_column='traffic_congestion', bins_per_unit=SKETCH_BINS_PER_UNIT, max_value=MAX_VALUE):
+        self.value_column = value_column
+        self.bins_per_unit = bins_per_unit
+        self.max_value = max_value
+        self.n_bins = int(round(max_value * bins_per_unit)) + 1
+        self.routes = {}
+        # History store parts already counted, per route (see update_from_history)
+        self.parts = {}
+        # Whole sources already counted, per route: {source: route_version} (see add_source)
+        self.sources = {}
+        self._allocate(0)
+
+    def _allocate(self, n_routes):
+        shape = (n_routes, WEEKDAYS, HOURS)
+        self.count = np.zeros(shape, dtype=np.int64)
+        self.sum = np.zeros(shape)
+        self.min = np.full(shape, np.inf)
+        self.max = np.full(shape, -np.inf)
+        self.sketch = np.zeros(shape + (self.n_bins,), dtype=np.int64)
+
+    def route_index(self, route):
+        if route not in self.routes:
+            self.routes[route] = len(self.routes)
+            for name, fill in (('count', 0), ('sum', 0.0), ('min', np.inf), ('max', -np.inf), ('sketch', 0)):
+                old = getattr(self, name)
+                setattr(self, name, np.concatenate((old, np.full((1,) + old.shape[1:], fill, dtype=old.dtype))))
+        return self.routes[route]
+
+    def add(self, route, df):
+        # Folds a route frame into the cube. Rows without a value or a parsed est_time
+        # are skipped.
+        with stage('cube_add', rows=len(df)):
+            r = self.route_index(route)
+            values = df[self.value_column].to_numpy(dtype=float)
+            seconds = df['est_seconds'].to_numpy() if 'est_seconds' in df else est_time_seconds(df['est_time'])
+            hours = np.asarray(seconds) // 3600
+            if 'time' in df:
+                weekdays = weekdays_of(df['time'].to_numpy(dtype=float))
+            else:
+                weekdays = np.full(len(df), UNKNOWN_WEEKDAY)
+            valid = ~np.isnan(values) & (hours >= 0)
+            values = values[valid]
+            cells = (weekdays[valid] * HOURS + hours[valid]).astype(np.int64)
+            n_cells = WEEKDAYS * HOURS
+
+            self.count[r] += np.bincount(cells, minlength=n_cells).reshape(WEEKDAYS, HOURS)
+            self.sum[r] += np.bincount(cells, weights=values, minlength=n_cells).reshape(WEEKDAYS, HOURS)
+            np.minimum.at(self.min[r].reshape(-1), cells, values)
+            np.maximum.at(self.max[r].reshape(-1), cells, values)
+            bins = np.clip(np.round(values * self.bins_per_unit), 0, self.n_bins - 1).astype(np.int64)
+            sketch = np.bincount(cells * self.n_bins + bins, minlength=n_cells * self.n_bins)
+            self.sketch[r] += sketch.reshape(WEEKDAYS, HOURS, self.n_bins)
+
+    def merge(self, other):
+        # Adds another cube with the same sketch resolution, route by route
+        if (other.bins_per_unit, other.n_bins) != (self.bins_per_unit, self.n_bins):
+            raise ValueError("cubes with different sketch resolutions cannot be merged")
+        for route, o in other.routes.items():
+            r = self.route_index(route)
+            self.count[r] += other.count[o]
+            self.sum[r] += other.sum[o]
+            self.min[r] = np.minimum(self.min[r], other.min[o])
+            self.max[r] = np.maximum(self.max[r], other.max[o])
+            self.sketch[r] += other.sketch[o]
+            self.parts.setdefault(route, set()).update(other.parts.get(route, ()))
+            self.sources.setdefault(route, {}).update(other.sources.get(route, {}))
+        return self
+
+    def cells(self, routes=None, hours=None, weekdays=None):
+        # Index into the cube for a combination of routes, hours and weekdays (None: all)
+        route_rows = list(self.routes.values()) if routes is None else [self.routes[route] for route in routes
+                                                                          if route in self.routes]
+        return np.ix_(route_rows,
+                      range(WEEKDAYS) if weekdays is None else list(weekdays),
+                      range(HOURS) if hours is None else list(hours))
+
+    def summary(self, routes=None, hours=None, weekdays=None, quantiles=QUANTILES):
+        # count, mean, min, max and p50/p90/p99 over the chosen cells; NaN when empty
+        index = self.cells(routes, hours, weekdays)
+        count = int(self.count[index].sum())
+        stats = {'count': count, 'mean': np.nan, 'min': np.nan, 'max': np.nan}
+        stats.update({f"p{round(q * 100)}": np.nan for q in quantiles})
+        if not count:
+            return stats
+        stats['mean'] = self.sum[index].sum() / count
+        stats['min'] = float(self.min[index].min())
+        stats['max'] = float(self.max[index].max())
+        cumulative = np.cumsum(self.sketch[index].reshape(-1, self.n_bins).sum(axis=0))
+        for q in quantiles:
+            # First bin holding the q-th ranked value, as the bin's center clamped to the exact range
+            value = np.searchsorted(cumulative, q * count, side='left') / self.bins_per_unit
+            stats[f"p{round(q * 100)}"] = float(np.clip(value, stats['min'], stats['max']))
+        return stats
+
+    def update_from_history(self, store, route):
+        # Adds the route's history store parts not counted yet. A compacted part whose
+        # replaced parts were all counted is recorded without adding it again; one that
+        # also holds uncounted rows means the route is recounted from scratch.
+        counted = self.parts.setdefault(route, set())
+        parts = list(store.partitions(route))
+        fresh = []
+        for part_dir, manifest in parts:
+            name = os.path.basename(part_dir)
+            if name in counted:
+                continue
+            replaces = set(manifest['replaces'])
+            if replaces and replaces <= counted:
+                counted.add(name)
+            elif replaces & counted:
+                return self.rebuild_from_history(store, route)
+            else:
+                fresh.append((name, part_dir, manifest))
+        for name, part_dir, manifest in fresh:
+            self.add(route, read_part(part_dir, manifest, columns=('time', 'est_time', self.value_column)))
+            counted.add(name)
+        return self
+
+    def clear_route(self, route):
+        # Empties the route's cells and forgets what was counted; returns its sources
+        r = self.route_index(route)
+        self.count[r], self.sum[r], self.sketch[r] = 0, 0.0, 0
+        self.min[r], self.max[r] = np.inf, -np.inf
+        self.parts[route] = set()
+        return self.sources.pop(route, {})
+
+    def rebuild_from_history(self, store, route):
+        for source in self.clear_route(route):
+            self.add_source(route, source)
+        return self.update_from_history(store, route)
+
+    def add_source(self, route, source):
+        # Adds a whole route source (CSV path or history query) once. A source already
+        # counted at its current route_version is skipped; one that changed since means
+        # the route is recounted from its sources, and its history store parts are
+        # counted again by the next update_from_history. Returns whether rows were added.
+        version = route_version(source)
+        counted = self.sources.get(route, {})
+        if counted.get(source) == version:
+            return False
+        if source in counted:
+            for other in self.clear_route(route):
+                if other != source:
+                    self.add_source(route, other)
+        self.add(route, load_route(source))
+        self.sources.setdefault(route, {})[source] = version
+        return True
+
+    def save(self, path):
+        routes = sorted(self.routes, key=self.routes.get)
+        np.savez_compressed(
+            path, count=self.count, sum=self.sum, min=self.min, max=self.max, sketch=self.sketch,
+            routes=np.array(routes, dtype=str), value_column=self.value_column,
+            bins_per_unit=self.bins_per_unit, max_value=self.max_value,
+            parts=np.array(['\t'.join([route] + sorted(self.parts.get(route, ()))) for route in routes], dtype=str),
+            sources=np.array(['\t'.join((route, source, version)) for route in routes
+                              for source, version in sorted(self.sources.get(route, {}).items())], dtype=str),
+        )
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        cube = cls(str(data['value_column']), int(data['bins_per_unit']), float(data['max_value']))
+        cube.routes = {str(route): i for i, route in enumerate(data['routes'])}
+        for name in ('count', 'sum', 'min', 'max', 'sketch'):
+            setattr(cube, name, data[name])
+        for line in data['parts']:
+            route, *names = str(line).split('\t')
+            cube.parts[route] = {name for name in names if name}
+        # Cubes saved before sources were recorded have none
+        for line in data['sources'] if 'sources' in data.files else ():
+            route, source, version = str(line).split('\t')
+            cube.sources.setdefault(route, {})[source] = version
+        return cube
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('cube_path', help="cube .npz to create or update")
+    parser.add_argument('--history', help="history store root; adds every route's new parts")
+    parser.add_argument('--route', action='append', default=[], metavar='NAME=SOURCE',
+                        help="add a whole route source (CSV path or history query) not counted yet; repeatable")
+    parser.add_argument('--column', default='traffic_congestion')
+    args = parser.parse_args(argv)
+    if any('=' not in arg for arg in args.route):
+        parser.error("--route takes NAME=SOURCE")
+
+    try:
+        cube = SummaryCube.load(args.cube_path)
+    except OSError:
+        cube = SummaryCube(args.column)
+    # Sources first: a changed one clears its route, whose history parts are then
+    # counted again below
+    for name, source in (arg.split('=', 1) for arg in args.route):
+        if not cube.add_source(name, source):
+            print(f"{source} already counted for {name}")
+    if args.history:
+        store = HistoryStore(args.history)
+        for route in store.routes():
+            cube.update_from_history(store, route)
+    cube.save(args.cube_path)
+    for route in cube.routes:
+        stats = cube.summary([route])
+        print(f"{route}: {stats['count']} readings, mean {stats['mean']:.2f}, "
+              f"p50 {stats['p50']:.2f}, p90 {stats['p90']:.2f}, p99 {stats['p99']:.2f}")
+
+if __name__ == '__main__':
+    main()
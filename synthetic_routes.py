@@ -0,0 +1,95 @@
+import argparse
+import numpy as np
+import pandas as pd
+from route_geo import EARTH_RADIUS_M
+from route_loader import second_labels
+
+# Seeded stand-in for the real_data/ CSVs (which live in LFS): a bus looping a closed
+# campus route at 1 Hz with stops, GPS noise and a 07:00-23:00 service day, in the same
+# columns the map scripts read. The same (rows, seed) always gives the same frame.
+COLUMNS = ['latitude', 'longitude', 'time', 'est_time', 'traffic_congestion', 'road_condition',
+           'road_condition_1', 'road_condition_2', 'road_condition_3', 'road_condition_4', 'road_condition_5']
+
+CENTER = (33.7756, -84.3963)
+WAYPOINTS = 16
+SECTION_M = 100.0  # stretch of road sharing a base congestion and pavement quality
+GPS_NOISE_M = 3.0
+SERVICE_START = 7 * 3600
+SERVICE_SECONDS = 16 * 3600
+# Midnight of 2023-09-04 in Eastern time; est_time uses a fixed EDT offset throughout
+FIRST_MIDNIGHT = 1693800000
+RUSH_HOURS = (8, 17)
+MISSING_ROAD_FRACTION = 0.02
+
+def loop_waypoints(rng):
+    # Jittered polygon around CENTER, in local meters, closed back to its first point
+    angles = np.sort(rng.uniform(0, 2 * np.pi, WAYPOINTS))
+    radius = rng.uniform(400, 800, WAYPOINTS)
+    x, y = radius * np.cos(angles), radius * np.sin(angles)
+    return np.append(x, x[0]), np.append(y, y[0])
+
+def bus_speeds(rng, rows):
+    # m/s per one-second fix: stretches of 10-60 s at one speed, a fifth of them stopped
+    stretches = rows // 10 + 1
+    durations = rng.integers(10, 61, stretches)
+    speeds = np.where(rng.random(stretches) < 0.2, 0.0, rng.uniform(2.0, 11.0, stretches))
+    return np.repeat(speeds, durations)[:rows]
+
+def synthetic_route(rows, seed=0):
+    rng = np.random.default_rng(seed)
+    wx, wy = loop_waypoints(rng)
+    waypoint_along = np.concatenate(([0.0], np.cumsum(np.hypot(np.diff(wx), np.diff(wy)))))
+    loop_m = waypoint_along[-1]
+
+    along = np.cumsum(bus_speeds(rng, rows)) % loop_m
+    x = np.interp(along, waypoint_along, wx) + rng.normal(0, GPS_NOISE_M, rows)
+    y = np.interp(along, waypoint_along, wy) + rng.normal(0, GPS_NOISE_M, rows)
+    scale = np.pi / 180 * EARTH_RADIUS_M
+    lat = CENTER[0] + y / scale
+    lon = CENTER[1] + x / (scale * np.cos(np.radians(CENTER[0])))
+
+    i = np.arange(rows)
+    seconds = SERVICE_START + i % SERVICE_SECONDS
+    time = FIRST_MIDNIGHT + (i // SERVICE_SECONDS) * 86400 + seconds
+    est_time = np.asarray(second_labels(), dtype=object)[seconds]
+
+    sections = (along // SECTION_M).astype(np.intp)
+    n_sections = int(loop_m // SECTION_M) + 1
+    base_congestion = rng.uniform(1.0, 3.0, n_sections)
+    rush = np.isin(seconds // 3600, RUSH_HOURS) * 1.5
+    congestion = np.clip(np.round(base_congestion[sections] + rush + rng.normal(0, 0.5, rows)), 1, 5)
+
+    pavement = rng.uniform(1.0, 5.0, n_sections)
+    missing = rng.random(rows) < MISSING_ROAD_FRACTION
+
+    def road_score(offset):
+        score = np.clip(pavement[sections] + offset + rng.normal(0, 0.3, rows), 1.0, 5.0)
+        return np.where(missing, 0.0, score)
+
+    frame = {
+        'latitude': lat,
+        'longitude': lon,
+        'time': time.astype(float),
+        'est_time': est_time,
+        'traffic_congestion': congestion.astype(np.int64),
+        'road_condition': road_score(0.0),
+    }
+    for phase in range(1, 6):
+        frame[f'road_condition_{phase}'] = road_score(rng.normal(0, 0.5))
+    return pd.DataFrame(frame, columns=COLUMNS)
+
+def write_synthetic_csv(path, rows, seed=0):
+    synthetic_route(rows, seed).to_csv(path, index=False)
+    return path
+
+def main(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument('output_path', help="CSV to write, e.g. real_data/blue_traffic.csv")
+    parser.add_argument('--rows', type=int, default=100_000)
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args(argv)
+    write_synthetic_csv(args.output_path, args.rows, args.seed)
+    print(f"Wrote {args.rows} synthetic fixes to {args.output_path}")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+import os
+import build_maps as build_maps_module
+from build_maps import build_maps, code_files
+from synthetic_routes import write_synthetic_csv
+
+def config(tmp_path, compact):
+    path = str(tmp_path / 'route.csv')
+    if not os.path.exists(path):
+        write_synthetic_csv(path, 2000, 1)
+    return {'output_dir': str(tmp_path / 'maps'), 'compact': compact,
+            'maps': [{'variant': 'traffic', 'routes': {'Blue Route': path}}]}
+
+def test_plain_rebuild_removes_compressed_siblings(tmp_path):
+    build_maps(config(tmp_path, True), workers=1)
+    page = tmp_path / 'maps' / 'traffic.html'
+    bundle = tmp_path / 'maps' / 'traffic.bundle.js'
+    assert (tmp_path / 'maps' / 'traffic.html.gz').exists()
+    assert (tmp_path / 'maps' / 'traffic.bundle.js.gz').exists()
+
+    build_maps(config(tmp_path, False), workers=1)
+    assert page.exists() and bundle.exists()
+    assert not [name for name in os.listdir(tmp_path / 'maps') if name.endswith(('.gz', '.br'))]
+
+def test_missing_bundle_rebuilds_the_map(tmp_path):
+    assert build_maps(config(tmp_path, False), workers=1)
+    assert not build_maps(config(tmp_path, False), workers=1)
+    os.remove(tmp_path / 'maps' / 'traffic.bundle.js')
+    assert build_maps(config(tmp_path, False), workers=1)
+    assert (tmp_path / 'maps' / 'traffic.bundle.js').exists()
+
+def test_each_route_is_loaded_once_per_layer(tmp_path, monkeypatch):
+    import route_loader
+    loads = []
+    load_route_csv = route_loader.load_route_csv
+    monkeypatch.setattr(route_loader, 'load_route_csv', lambda *args, **kwargs: loads.append(args) or
+                        load_route_csv(*args, **kwargs))
+    build_maps(config(tmp_path, False), workers=1)
+    assert len(loads) == 1
+
+def test_code_version_covers_every_imported_module():
+    files = code_files(['build_maps', 'all_routes_traffichourfilter'], os.path.dirname(build_maps_module.__file__))
+    assert {'route_geo.py', 'history_store.py', 'route_raster.py', 'client_layers.py'} <= set(files)
+
+def test_hourly_maps_are_drawn_from_bins(tmp_path):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 20000, 1)
+    config = {'output_dir': str(tmp_path / 'maps'),
+              'maps': [{'variant': 'hourly', 'routes': {'Blue Route': path}, 'hours': [8]}]}
+    page, = build_maps(config, workers=1)
+    with open(page, encoding='utf-8') as file:
+        html = file.read()
+    assert 'm along the route' in html
+    assert html.count('L.polyline') < 100
+    assert build_maps(dict(config, compact=True), workers=1) == [page]
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+bus_routes_app = pytest.importorskip('bus_routes_app', exc_type=ImportError)
+
+def test_bin_means_weigh_only_readings_with_a_value():
+    table = pd.DataFrame({
+        'hour': [8, 8, 9],
+        'count': [10, 1, 5],
+        'traffic_congestion_count': [1, 1, 5],
+        'traffic_congestion_mean': [4.0, 2.0, 1.0],
+        'traffic_congestion_min': [4.0, 2.0, 1.0],
+        'traffic_congestion_max': [4.0, 2.0, 1.0],
+    })
+    stats = bus_routes_app.binned_stats(table, 8)
+    assert stats['count'] == 11
+    assert stats['mean'] == 3.0
+    assert np.isnan(bus_routes_app.binned_stats(table.assign(traffic_congestion_count=0))['mean'])
@@ -0,0 +1,24 @@
+import base64
+import numpy as np
+import pandas as pd
+from client_layers import NO_MEAN, encode_means, route_payload
+
+def decode(b64, dtype):
+    return np.frombuffer(base64.b64decode(b64), dtype=dtype)
+
+def test_encode_means():
+    assert encode_means(np.array([1.234, np.nan, 1e9])).tolist() == [123, NO_MEAN, 32767]
+
+def test_run_means_weigh_collapsed_fixes():
+    df = pd.DataFrame({
+        'time': np.arange(4.0),
+        'latitude': 33.77 + np.arange(4) * 1e-4,
+        'longitude': np.full(4, -84.39),
+        'traffic_congestion': [1.2, 1.8, 1.5, 5.0],
+        'fixes': [3, 1, 1, 1],
+    })
+    payload = route_payload(df, 'Blue Route', ['traffic_congestion'])
+    # One run over the first three segments: (3 * 1.2 + 1.8 + 1.5) / 5
+    assert payload['runs'] == 1
+    assert decode(payload['means'], '<i2').tolist() == [138]
+    assert decode(payload['levels'][0]['bounds'], '<u4').tolist() == [0, 3]
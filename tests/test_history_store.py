@@ -0,0 +1,46 @@
+import os
+import numpy as np
+from history_store import COMPACT_LOCK, UNKNOWN_DATE, HistoryStore
+from synthetic_routes import synthetic_route
+
+def one_day(rows):
+    df = synthetic_route(rows)
+    return df[df['time'] < df['time'].min() + 3600].reset_index(drop=True)
+
+def test_rows_without_time_go_to_the_unknown_date(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    df = one_day(500)
+    df.loc[:9, 'time'] = np.nan
+    store.append('Blue Route', df)
+
+    dates = store.dates('Blue Route')
+    assert UNKNOWN_DATE in dates
+    assert len(store.query('Blue Route')) == len(df)
+    known = [date for date in dates if date != UNKNOWN_DATE]
+    assert len(store.query('Blue Route', known[0], known[-1])) == len(df) - 10
+
+def test_compaction_skips_a_day_locked_by_another_process(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    df = one_day(600)
+    for rows in np.array_split(np.arange(len(df)), 3):
+        store.append('Blue Route', df.iloc[rows])
+    date_dir = os.path.join(store.route_dir('Blue Route'), store.dates('Blue Route')[0])
+
+    open(os.path.join(date_dir, COMPACT_LOCK), 'w').close()
+    assert store.compact() == 0
+    os.remove(os.path.join(date_dir, COMPACT_LOCK))
+    assert store.compact() == 3
+    assert store.compact() == 0
+    assert len(list(store.partitions('Blue Route'))) == 1
+    assert len(store.query('Blue Route')) == len(df)
+    assert not os.path.exists(os.path.join(date_dir, COMPACT_LOCK))
+
+def test_reader_survives_a_compaction(tmp_path):
+    store = HistoryStore(str(tmp_path))
+    df = one_day(600)
+    for rows in np.array_split(np.arange(len(df)), 3):
+        store.append('Blue Route', df.iloc[rows])
+    frames = store.iter_query('Blue Route')
+    first = next(frames)
+    store.compact()
+    assert len(first) + sum(len(frame) for frame in frames) == len(df)
@@ -0,0 +1,24 @@
+import numpy as np
+import pandas as pd
+from ingest_sensors import RAW_COLUMNS, score_blocks
+
+def raw_log(rows):
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'time': 1.7e9 + np.arange(rows) * 0.1,
+        'accel_x': rng.normal(0, 1, rows),
+        'accel_y': rng.normal(0, 1, rows),
+        'accel_z': rng.normal(9.8, 1, rows),
+        'latitude': 33.77 + np.arange(rows) * 1e-6,
+        'longitude': np.full(rows, -84.39),
+    }, columns=RAW_COLUMNS)
+    # GPS fixes arrive every tenth IMU sample
+    df.loc[df.index % 10 != 0, ['latitude', 'longitude']] = np.nan
+    return df
+
+def test_block_size_does_not_change_the_scores():
+    df = raw_log(5000)
+    whole = pd.concat(score_blocks([df]), ignore_index=True)
+    blocks = pd.concat(score_blocks(df.iloc[i:i + 333] for i in range(0, len(df), 333)), ignore_index=True)
+    pd.testing.assert_frame_equal(whole, blocks)
+    assert len(whole) == 500
@@ -0,0 +1,21 @@
+import numpy as np
+from live_routes import LiveRoute
+from route_bins import RouteBins
+
+def test_old_readings_lose_half_their_weight_per_half_life():
+    bins = RouteBins([33.77, 33.78], [-84.39, -84.39])
+    route = LiveRoute('Blue Route', bins, half_life=60.0)
+    lat, lon = np.array([33.7701]), np.array([-84.39])
+    route.update(lat, lon, np.array([4.0]), now=0.0)
+    route.update(lat, lon, np.array([1.0]), now=60.0)
+    assert np.isclose(route.scores[0], (0.5 * 4.0 + 1.0) / 1.5)
+    # Readings at the same time weigh the same
+    route.update(lat, lon, np.array([1.0]), now=60.0)
+    assert np.isclose(route.scores[0], (0.5 * 4.0 + 2.0) / 2.5)
+
+def test_changes_report_each_color_change_once():
+    bins = RouteBins([33.77, 33.78], [-84.39, -84.39])
+    route = LiveRoute('Blue Route', bins)
+    route.update(np.array([33.7701]), np.array([-84.39]), np.array([4.5]), now=0.0)
+    assert route.changes()['bins'] == [0]
+    assert route.changes()['bins'] == []
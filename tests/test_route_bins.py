@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+from route_bins import RouteBins, thin_trace
+
+def test_thin_trace_keeps_a_fix_per_spacing_and_both_ends():
+    x = np.arange(50.0)
+    assert thin_trace(x, np.zeros(50), 10.0).tolist() == [0, 10, 20, 30, 40, 49]
+    assert thin_trace(np.zeros(3), np.zeros(3), 10.0).tolist() == [0, 2]
+
+def test_aggregate_counts_finite_values_per_column():
+    bins = RouteBins([40.0, 40.001], [-75.0, -75.0], bin_m=25.0)
+    df = pd.DataFrame({
+        'along_m': [1.0, 2.0, 3.0, 30.0],
+        'traffic_congestion': [1.0, np.nan, 3.0, 2.0],
+    })
+    table = bins.aggregate(df, ['traffic_congestion'], by_hour=False)
+    assert table['count'].tolist() == [3, 1]
+    assert table['traffic_congestion_count'].tolist() == [2, 1]
+    assert table['traffic_congestion_mean'].tolist() == [2.0, 2.0]
@@ -0,0 +1,14 @@
+import numpy as np
+from route_classify import ROAD, TRAFFIC, TIMES_OF_DAY, time_of_day, times_of_day
+
+def test_column_codes_match_the_scalar_ones():
+    values = [-1.0, 0.0, 0.5, 1.0, 1.5, 4.0, 4.01, 7.0, np.nan]
+    for scale in (ROAD, TRAFFIC):
+        assert scale.codes(values).tolist() == [scale.code(value) for value in values]
+        assert list(scale.describe(values)) == [scale.label(value) for value in values]
+    assert TRAFFIC.codes([0.0, np.nan]).tolist() == [0, 5]
+
+def test_times_of_day():
+    phases = [1, 2, 3, 4, 5, 0, 2.5, np.nan]
+    assert list(times_of_day(phases)) == [time_of_day(phase) for phase in phases]
+    assert time_of_day(2.5) == TIMES_OF_DAY[-1]
@@ -0,0 +1,36 @@
+import numpy as np
+import pandas as pd
+from route_compress import compress_stationary, split_far_runs
+from route_geo import haversine_m
+
+def walk_runs(lat, lon, starts, radius_m):
+    # Row-by-row reference for split_far_runs
+    starts = starts.copy()
+    anchor = 0
+    for row in range(len(starts)):
+        if starts[row] or haversine_m(lat[anchor], lon[anchor], lat[row], lon[row]) > radius_m:
+            starts[row] = True
+            anchor = row
+    return starts
+
+def test_split_far_runs_matches_row_walk():
+    rng = np.random.default_rng(0)
+    n = 3000
+    lat = 40 + np.cumsum(rng.uniform(0, 1.2e-5, n))
+    lon = -75 + np.cumsum(rng.uniform(-5e-6, 5e-6, n))
+    starts = rng.random(n) < 0.01
+    starts[0] = True
+    assert (split_far_runs(lat, lon, starts, 2.0) == walk_runs(lat, lon, starts, 2.0)).all()
+
+def test_creeping_bus_is_split_every_radius():
+    n = 100
+    df = pd.DataFrame({
+        'time': 1.7e9 + np.arange(n, dtype=float),
+        'latitude': 40 + np.arange(n) * 1e-6,
+        'longitude': np.full(n, -75.0),
+        'traffic_congestion': np.full(n, 1.0),
+    })
+    result = compress_stationary(df, radius_m=2.0)
+    # 1e-6 degrees of latitude is about 0.111 m, so a new run starts every 18 fixes
+    assert result['fixes'].tolist() == [18] * 5 + [10]
+    assert result['fixes'].sum() == n
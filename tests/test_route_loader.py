@@ -0,0 +1,29 @@
+import multiprocessing
+import os
+import numpy as np
+from route_loader import cache_dir_for, load_route_csv, read_manifest
+from synthetic_routes import write_synthetic_csv
+
+def load_checksum(path):
+    df = load_route_csv(path)
+    return len(df), float(np.nansum(df['latitude'].to_numpy(dtype=float)))
+
+def test_concurrent_cold_loads_see_a_complete_cache(tmp_path):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 300_000, 3)
+    with multiprocessing.get_context('fork').Pool(8) as pool:
+        results = pool.map(load_checksum, [path] * 8)
+    assert len(set(results)) == 1
+    assert results[0][0] == 300_000
+
+def test_rebuild_keeps_the_previous_build_for_readers(tmp_path):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 1000, 1)
+    load_route_csv(path)
+    old = read_manifest(cache_dir_for(path))
+    write_synthetic_csv(path, 2000, 2)
+    assert len(load_route_csv(path)) == 2000
+    new = read_manifest(cache_dir_for(path))
+    assert new['build'] != old['build']
+    # A reader holding the old manifest can still load the old columns
+    assert os.path.isdir(os.path.join(cache_dir_for(path), old['build']))
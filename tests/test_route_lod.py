@@ -0,0 +1,24 @@
+import numpy as np
+from route_lod import LOD_LEVELS, douglas_peucker, lod_tolerance, reindex_runs, simplify_runs
+
+def test_straight_line_keeps_only_its_ends():
+    x = np.arange(10.0)
+    assert douglas_peucker(x, np.zeros(10), 1.0).tolist() == [True] + [False] * 8 + [True]
+
+def test_loop_back_to_the_start_is_not_collapsed():
+    x = np.array([0.0, 10.0, 20.0, 10.0, 0.0])
+    y = np.array([0.0, 0.0, 0.0, 0.1, 0.1])
+    assert douglas_peucker(x, y, 1.0)[2]
+
+def test_every_color_change_survives_simplification():
+    lat = 33.77 + np.arange(30) * 1e-5
+    lon = np.full(30, -84.39)
+    starts, stops = np.array([0, 10, 20]), np.array([10, 20, 29])
+    keep = simplify_runs(lat, lon, starts, stops, 100.0)
+    assert np.flatnonzero(keep).tolist() == [0, 10, 20, 29]
+    assert [list(bounds) for bounds in reindex_runs(keep, starts, stops)] == [[0, 1, 2], [1, 2, 3]]
+
+def test_lod_tolerance_is_the_level_for_the_zoom():
+    assert lod_tolerance(0) == LOD_LEVELS[0][1]
+    assert lod_tolerance(14) == 4.0
+    assert lod_tolerance(20) == 0.0
@@ -0,0 +1,26 @@
+import numpy as np
+from route_match import RouteCenterline, match_route, matched_bins
+from synthetic_routes import synthetic_route
+
+def test_fixes_off_the_route_get_nan():
+    df = synthetic_route(5000)
+    centerline = RouteCenterline.from_traces(df)
+    matched = match_route(df.assign(latitude=df['latitude'] + 0.05), centerline)
+    assert matched['offset_m'].isna().all()
+    assert matched['along_m'].isna().all()
+
+def test_centerline_ignores_fixes_without_a_position():
+    df = synthetic_route(5000)
+    df.loc[::7, ['latitude', 'longitude']] = np.nan
+    centerline = RouteCenterline.from_traces(df)
+    assert np.isfinite(centerline.lat).all() and np.isfinite(centerline.lon).all()
+
+def test_aggregate_bins_matched_fixes_by_along_m():
+    df = synthetic_route(5000)
+    bins, matched = matched_bins(df)
+    table = bins.aggregate(matched, ['traffic_congestion'], by_hour=False)
+    along = matched['along_m'].to_numpy()
+    expected = np.bincount((along[np.isfinite(along)] // bins.bin_m).astype(int).clip(0, bins.n_bins - 1),
+                           minlength=bins.n_bins)
+    assert (table.set_index('bin')['count'].reindex(range(bins.n_bins), fill_value=0).to_numpy() == expected).all()
+    assert table['count'].sum() == np.isfinite(along).sum()
@@ -0,0 +1,49 @@
+import os
+import numpy as np
+import pandas as pd
+import pytest
+import zlib
+from route_classify import TRAFFIC
+from route_raster import TILE_PX, hex_rgb, render_tiles
+
+def read_png_rgba(path):
+    # Decodes the unfiltered RGBA PNGs encode_png writes
+    data = open(path, 'rb').read()
+    idat = data[data.index(b'IDAT') + 4:data.index(b'IEND') - 8]
+    raw = np.frombuffer(zlib.decompress(idat), dtype=np.uint8).reshape(TILE_PX, 1 + 4 * TILE_PX)
+    return raw[:, 1:].reshape(TILE_PX, TILE_PX, 4)
+
+def only_tile(tile_dir, zoom):
+    column = os.path.join(tile_dir, str(zoom))
+    x, = os.listdir(column)
+    y, = os.listdir(os.path.join(column, x))
+    return read_png_rgba(os.path.join(column, x, y))
+
+def route(values):
+    return pd.DataFrame({'latitude': [33.7756] * len(values), 'longitude': [-84.3963] * len(values),
+                         'traffic_congestion': values})
+
+def test_missing_readings_stay_out_of_the_pixel_mean(tmp_path):
+    tile_dir = str(tmp_path / 'tiles')
+    render_tiles(route([3.5, 0.0]), 'traffic_congestion', tile_dir, TRAFFIC.palette, zooms=[16])
+    colors = {tuple(pixel[:3]) for pixel in only_tile(tile_dir, 16).reshape(-1, 4) if pixel[3]}
+    assert colors == {tuple(hex_rgb(TRAFFIC.color(3.5)))}
+
+def test_pixels_with_no_reading_are_gray(tmp_path):
+    tile_dir = str(tmp_path / 'tiles')
+    render_tiles(route([0.0, -1.0]), 'traffic_congestion', tile_dir, TRAFFIC.palette, zooms=[16])
+    colors = {tuple(pixel[:3]) for pixel in only_tile(tile_dir, 16).reshape(-1, 4) if pixel[3]}
+    assert colors == {tuple(hex_rgb(TRAFFIC.palette[0]))}
+
+def test_refuses_to_replace_a_directory_that_is_not_tiles(tmp_path):
+    (tmp_path / 'notes.txt').write_text('keep me')
+    with pytest.raises(ValueError):
+        render_tiles(route([1.0]), 'traffic_congestion', str(tmp_path), TRAFFIC.palette, zooms=[16])
+    assert (tmp_path / 'notes.txt').exists()
+
+def test_fixes_spread_over_several_tiles(tmp_path):
+    tile_dir = str(tmp_path / 'tiles')
+    df = pd.DataFrame({'latitude': np.linspace(33.77, 33.78, 50), 'longitude': np.linspace(-84.40, -84.39, 50),
+                       'traffic_congestion': np.full(50, 2.0)})
+    layer = render_tiles(df, 'traffic_congestion', tile_dir, TRAFFIC.palette, zooms=[17])
+    assert layer['tiles'][17] > 1
@@ -0,0 +1,19 @@
+import numpy as np
+import pandas as pd
+from route_geo import haversine_m
+from route_spatial import RouteSpatialIndex
+
+def test_queries_match_brute_force():
+    rng = np.random.default_rng(0)
+    df = pd.DataFrame({
+        'time': np.arange(2000.0),
+        'latitude': 33.77 + rng.uniform(0, 0.01, 2000),
+        'longitude': -84.40 + rng.uniform(0, 0.01, 2000),
+        'traffic_congestion': rng.uniform(0, 5, 2000),
+    })
+    index = RouteSpatialIndex(df)
+    for lat, lon in rng.uniform([33.77, -84.40], [33.78, -84.39], (20, 2)):
+        distance = haversine_m(lat, lon, df['latitude'].to_numpy(), df['longitude'].to_numpy())
+        position, nearest = index.nearest(lat, lon)
+        assert abs(nearest - distance.min()) < 0.5
+        assert sorted(index.radius(lat, lon, 100.0)['time']) == sorted(df['time'][distance <= 100.0])
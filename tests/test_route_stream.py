@@ -0,0 +1,18 @@
+import re
+from route_stream import render_streamed
+from synthetic_routes import write_synthetic_csv
+
+def test_run_pieces_are_written_inside_the_body(tmp_path):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 5000, 1)
+    output = str(tmp_path / 'stream.html')
+    render_streamed({'Blue Route': path}, output, chunk_rows=1000, block_rows=500)
+    with open(output, encoding='utf-8') as file:
+        html = file.read()
+    body_end = html.rindex('</body>')
+    calls = [match.start() for match in re.finditer(r'addRunPieces\("', html)]
+    assert len(calls) > 1
+    assert max(calls) < body_end
+    layer = re.search(r'addRunPieces\("(\w+)"', html).group(1)
+    # The queued layer is created by folium's script after the body
+    assert html.index(f'var {layer} = ', body_end) > body_end
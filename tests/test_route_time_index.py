@@ -0,0 +1,20 @@
+import numpy as np
+import pandas as pd
+from route_time_index import RouteTimeIndex, est_time_seconds
+
+def test_malformed_times_are_minus_one():
+    assert est_time_seconds(['01:02:03', 'bad', None]).tolist() == [3723, -1, -1]
+
+def test_hour_slices_match_a_scan():
+    rng = np.random.default_rng(0)
+    seconds = rng.integers(0, 86400, 500)
+    est_time = [f"{s // 3600:02d}:{s // 60 % 60:02d}:{s % 60:02d}" for s in seconds]
+    est_time[::50] = ['not a time'] * 10
+    df = pd.DataFrame({'est_time': est_time, 'row': np.arange(500)})
+    index = RouteTimeIndex(df)
+    parsed = est_time_seconds(df['est_time'])
+    for hour in range(24):
+        expected = np.flatnonzero(parsed // 3600 == hour)
+        assert sorted(index.hour(hour)['row']) == expected.tolist()
+    assert sum(len(index.hour(hour)) for hour in range(24)) == 490
+    assert sorted(index.window(3600, 7200)['row']) == np.flatnonzero(parsed // 3600 == 1).tolist()
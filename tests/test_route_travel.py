@@ -0,0 +1,25 @@
+import pytest
+from route_travel import main
+from synthetic_routes import write_synthetic_csv
+
+def test_route_with_one_fix_is_a_usage_error(tmp_path, capsys):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 1, 1)
+    with pytest.raises(SystemExit) as exit:
+        main([path])
+    assert exit.value.code == 2
+    assert 'two fixes' in capsys.readouterr().err
+
+def test_hours_out_of_range_is_a_usage_error(tmp_path):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 1000, 1)
+    with pytest.raises(SystemExit) as exit:
+        main([path, '--hours', '24'])
+    assert exit.value.code == 2
+
+def test_eta_table(tmp_path, capsys):
+    path = str(tmp_path / 'route.csv')
+    write_synthetic_csv(path, 5000, 1)
+    main([path, '--hours', '0', '23'])
+    out = capsys.readouterr().out
+    assert 'Hour 0:00' in out and 'Hour 23:00' in out
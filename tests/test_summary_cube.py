@@ -0,0 +1,38 @@
+import numpy as np
+import pandas as pd
+from summary_cube import HOURS, UNKNOWN_WEEKDAY, SummaryCube, main, weekdays_of
+from synthetic_routes import write_synthetic_csv
+
+def test_missing_times_and_malformed_est_time():
+    df = pd.DataFrame({
+        'time': [1.7e9, np.nan, 1.7e9],
+        'est_time': ['08:00:00', '09:15:00', 'not a time'],
+        'traffic_congestion': [1.0, 2.0, 3.0],
+    })
+    cube = SummaryCube()
+    cube.add('Blue Route', df)
+
+    weekday = weekdays_of(np.array([1.7e9]))[0]
+    assert cube.count.sum() == 2
+    assert cube.count[0, weekday, 8] == 1
+    assert cube.count[0, UNKNOWN_WEEKDAY, 9] == 1
+    assert cube.summary(weekdays=[UNKNOWN_WEEKDAY])['mean'] == 2.0
+    assert cube.summary(hours=range(HOURS))['max'] == 2.0
+
+def test_route_source_added_twice_is_counted_once(tmp_path, capsys):
+    csv = str(tmp_path / 'route.csv')
+    cube_path = str(tmp_path / 'cube.npz')
+    write_synthetic_csv(csv, 1000, 1)
+    main([cube_path, '--route', f'Blue Route={csv}'])
+    count = SummaryCube.load(cube_path).count.sum()
+    main([cube_path, '--route', f'Blue Route={csv}'])
+    assert SummaryCube.load(cube_path).count.sum() == count
+    assert 'already counted' in capsys.readouterr().out
+
+    # A changed source replaces what it added before
+    write_synthetic_csv(csv, 500, 2)
+    main([cube_path, '--route', f'Blue Route={csv}'])
+    cube = SummaryCube.load(cube_path)
+    fresh = SummaryCube()
+    fresh.add('Blue Route', pd.read_csv(csv))
+    assert cube.count.sum() == fresh.count.sum()